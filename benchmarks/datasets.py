@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+from typing import List
+
+from sqlalchemy.engine import Engine
+
+from datools.models import Column
+
+
+# Multipliers that scatter row numbers across each column's values.
+# They are coprime with 10, so they permute the row numbers modulo any
+# power of ten, and different multipliers leave columns roughly
+# independent of one another.
+MULTIPLIERS = (
+    2654435761, 40503, 2246822519, 3266489917, 668265263, 374761393,
+    1181783497, 3432918353, 461845907, 2869860233, 1540483477, 3575260447)
+# Every `ANOMALY_PERIOD`th row is an anomaly: a reading from
+# `ANOMALOUS_SENSOR` with a low voltage and a high temperature.
+ANOMALY_PERIOD = 50
+ANOMALOUS_SENSOR = 7
+ANOMALOUS_TEMPERATURE = 100
+
+
+@dataclass
+class SensorDataset:
+    """
+    A synthetic table of sensor readings in the style of the Intel
+    sensor dataset from the Scorpion paper (Wu & Madden, VLDB 2013),
+    with `num_rows` rows and `num_categorical_columns` text columns of
+    `cardinality` values each, in addition to a `sensor_id` column with
+    `num_sensors` values and `voltage`, `humidity`, and `temperature`
+    columns.
+
+    One in every `ANOMALY_PERIOD` rows is a planted anomaly, which a
+    diff of high temperatures against the rest should explain with
+    `sensor_id = ANOMALOUS_SENSOR` and low voltages.
+    """
+    num_rows: int
+    num_categorical_columns: int = 2
+    cardinality: int = 100
+    num_sensors: int = 1000
+    table_name: str = 'benchmark_readings'
+
+    @property
+    def categorical_columns(self) -> List[Column]:
+        return [Column(f'category_{index}')
+                for index in range(self.num_categorical_columns)]
+
+    @property
+    def relation(self) -> str:
+        return f'SELECT * FROM {self.table_name}'
+
+    @property
+    def test_condition(self) -> str:
+        return f'temperature >= {ANOMALOUS_TEMPERATURE}'
+
+    @property
+    def test_relation(self) -> str:
+        return f'{self.relation} WHERE {self.test_condition}'
+
+    @property
+    def control_relation(self) -> str:
+        return f'{self.relation} WHERE NOT ({self.test_condition})'
+
+    def _row_numbers(self, engine: Engine) -> str:
+        """A relation with a column `i` numbering `num_rows` rows."""
+        backend = engine.url.get_backend_name()
+        if backend == 'duckdb':
+            return f'SELECT range AS i FROM range({self.num_rows})'
+        if backend == 'postgresql':
+            return f'SELECT generate_series(0, {self.num_rows - 1}) AS i'
+        return (
+            f'WITH RECURSIVE numbers(i) AS ('
+            f'SELECT 0 UNION ALL '
+            f'SELECT i + 1 FROM numbers WHERE i < {self.num_rows - 1}) '
+            f'SELECT i FROM numbers')
+
+    def _scattered(self, column_index: int, num_values: int) -> str:
+        multiplier = MULTIPLIERS[column_index % len(MULTIPLIERS)]
+        return f'(i * {multiplier}) % {num_values}'
+
+    def load(self, engine: Engine):
+        """Generates the dataset in the database with a single query."""
+        categorical_columns = self.categorical_columns
+        definitions = [
+            'id BIGINT',
+            'sensor_id INTEGER',
+            *(f'{column.name} TEXT' for column in categorical_columns),
+            'voltage DOUBLE PRECISION',
+            'humidity DOUBLE PRECISION',
+            'temperature DOUBLE PRECISION']
+        anomaly = f'i % {ANOMALY_PERIOD} = 0'
+        expressions = [
+            'i',
+            f'CASE WHEN {anomaly} THEN {ANOMALOUS_SENSOR} '
+            f'ELSE {self._scattered(0, self.num_sensors)} END',
+            *(f"'value_' || CAST("
+              f'{self._scattered(index + 1, self.cardinality)} AS TEXT)'
+              for index in range(len(categorical_columns))),
+            # Anomalies have voltages in [2.0, 2.1), and other readings
+            # in [2.0, 3.0).
+            f'2.0 + CAST(CASE WHEN {anomaly} '
+            f'THEN {self._scattered(-1, 100)} '
+            f'ELSE {self._scattered(-1, 1000)} END '
+            f'AS DOUBLE PRECISION) / 1000',
+            f'CAST({self._scattered(-2, 1000)} AS DOUBLE PRECISION) / 1000',
+            f'CASE WHEN {anomaly} THEN {ANOMALOUS_TEMPERATURE} '
+            f'ELSE 20 + {self._scattered(-3, 30)} END']
+        with engine.begin() as connection:
+            connection.execute(f'DROP TABLE IF EXISTS {self.table_name}')
+            connection.execute(
+                f'CREATE TABLE {self.table_name} '
+                f'({", ".join(definitions)})')
+            connection.execute(
+                f'INSERT INTO {self.table_name} '
+                f'SELECT {", ".join(expressions)} '
+                f'FROM ({self._row_numbers(engine)}) AS numbers')
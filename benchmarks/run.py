@@ -0,0 +1,231 @@
+"""
+Times `diff` and `column_statistics` on synthetic sensor datasets of
+increasing size, and writes the timings as JSON so runs can be compared
+across versions. For example:
+
+    python -m benchmarks.run --db-type duckdb --rows 10000 1000000 \
+        --output results.json
+    python -m benchmarks.run --db-type duckdb --rows 10000 1000000 \
+        --baseline results.json
+
+With `--baseline`, phases that got more than `--tolerance` times slower
+than in the baseline results are reported, and the run exits with an
+error.
+"""
+import argparse
+import json
+import platform
+import sys
+
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+from sqlalchemy.engine import Engine
+
+from benchmarks.datasets import ANOMALOUS_SENSOR
+from benchmarks.datasets import SensorDataset
+from datools import __version__
+from datools.explanations import diff
+from datools.explanations import diff_by_condition
+from datools.models import Column
+from datools.models import GroupingSetsStrategy
+from datools.models import Table
+from datools.table_statistics import column_statistics
+from datools.sqlalchemy_utils import supports_grouping_sets
+from datools.table_statistics import range_valued_statistics
+from datools.tracing import Tracer
+from tests.db_engine_creators import DuckDbEngineCreator
+from tests.db_engine_creators import PostgresqlEngineCreator
+from tests.db_engine_creators import SqliteEngineCreator
+
+
+DB_TYPE_TO_ENGINE_CREATOR = {
+    'duckdb': DuckDbEngineCreator,
+    'sqlite': SqliteEngineCreator,
+    'postgresql': PostgresqlEngineCreator,
+}
+DEFAULT_ROWS = (10000, 1000000, 10000000)
+DEFAULT_TOLERANCE = 1.5
+# Phases faster than this are too noisy to flag as regressions.
+MIN_COMPARED_SECONDS = 0.1
+MIN_SUPPORT = 0.1
+MIN_RISK_RATIO = 2.0
+
+
+class PhaseTimer:
+    """Records how many seconds each named phase of a run took."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        yield
+        self.seconds[name] = perf_counter() - start
+
+
+def _found_anomaly(explanations) -> bool:
+    return any(
+        predicate.left == Column('sensor_id')
+        and predicate.right.value == ANOMALOUS_SENSOR
+        for explanation in explanations
+        for predicate in explanation.predicates)
+
+
+def run_benchmark(
+        engine: Engine,
+        dataset: SensorDataset,
+        max_order: int
+) -> Dict[str, Any]:
+    timer = PhaseTimer()
+    with timer.phase('load'):
+        dataset.load(engine)
+    with timer.phase('column_statistics'):
+        column_statistics(engine, Table(dataset.table_name), {Column('id')})
+    with timer.phase('column_statistics_approximate'):
+        column_statistics(
+            engine, Table(dataset.table_name), {Column('id')},
+            approximate=True)
+
+    on_column_values = {Column('sensor_id'), *dataset.categorical_columns}
+    on_column_ranges = {Column('voltage'), Column('humidity')}
+    with timer.phase('diff_range_statistics'):
+        range_valued_statistics(
+            engine, dataset.test_relation, on_column_ranges)
+    tracer = Tracer()
+    with timer.phase('diff'):
+        diff_explanations = diff(
+            engine, dataset.test_relation, dataset.control_relation,
+            on_column_values, on_column_ranges, MIN_SUPPORT, MIN_RISK_RATIO,
+            max_order, tracer=tracer)
+    for phase in tracer.phases:
+        name = f'diff.{phase.name}'
+        timer.seconds[name] = timer.seconds.get(name, 0.0) + phase.seconds
+    with timer.phase('diff_by_condition'):
+        condition_explanations = diff_by_condition(
+            engine, dataset.relation, dataset.test_condition,
+            on_column_values, on_column_ranges, MIN_SUPPORT, MIN_RISK_RATIO,
+            max_order)
+    # Each way of counting grouping sets, with and without copying the
+    # relation to a temporary table first, so defaults can be chosen
+    # by relation size and backend.
+    for strategy in GroupingSetsStrategy:
+        if (strategy == GroupingSetsStrategy.NATIVE
+                and not supports_grouping_sets(engine)):
+            continue
+        for materialize in (False, True):
+            name = (f'diff_by_condition.{strategy.name.lower()}'
+                    f'{".materialized" if materialize else ""}')
+            with timer.phase(name):
+                diff_by_condition(
+                    engine, dataset.relation, dataset.test_condition,
+                    on_column_values, on_column_ranges, MIN_SUPPORT,
+                    MIN_RISK_RATIO, max_order, materialize=materialize,
+                    strategy=strategy)
+    return {
+        'num_explanations': len(diff_explanations),
+        'found_anomaly': (_found_anomaly(diff_explanations)
+                          and _found_anomaly(condition_explanations)),
+        'phases': timer.seconds,
+    }
+
+
+def _result_key(result: Dict[str, Any]) -> Tuple[Any, ...]:
+    return (result['db_type'], result['num_rows'],
+            result['num_categorical_columns'], result['cardinality'],
+            result['max_order'])
+
+
+def regressions(
+        results: List[Dict[str, Any]],
+        baseline: List[Dict[str, Any]],
+        tolerance: float
+) -> List[str]:
+    """
+    Describes each phase of `results` that took more than `tolerance`
+    times as long as the same phase of a matching `baseline` result.
+    """
+    baseline_phases = {_result_key(result): result['phases']
+                       for result in baseline}
+    descriptions = []
+    for result in results:
+        phases = baseline_phases.get(_result_key(result), {})
+        for phase, seconds in result['phases'].items():
+            baseline_seconds = phases.get(phase)
+            if (baseline_seconds is not None
+                    and baseline_seconds >= MIN_COMPARED_SECONDS
+                    and seconds > tolerance * baseline_seconds):
+                descriptions.append(
+                    f'{result["db_type"]}, {result["num_rows"]} rows, '
+                    f'{phase}: {seconds:.3f}s '
+                    f'(baseline {baseline_seconds:.3f}s)')
+    return descriptions
+
+
+def main(arguments: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark datools on synthetic sensor data.')
+    parser.add_argument('--db-type', required=True,
+                        choices=DB_TYPE_TO_ENGINE_CREATOR.keys())
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=list(DEFAULT_ROWS))
+    parser.add_argument('--categorical-columns', type=int, default=2)
+    parser.add_argument('--cardinality', type=int, default=100)
+    parser.add_argument('--max-order', type=int, default=2)
+    parser.add_argument('--output',
+                        help='Write results to this file, not stdout.')
+    parser.add_argument('--baseline',
+                        help='Compare results to those in this file.')
+    parser.add_argument('--tolerance', type=float,
+                        default=DEFAULT_TOLERANCE)
+    options = parser.parse_args(arguments)
+
+    results = []
+    for num_rows in options.rows:
+        creator = DB_TYPE_TO_ENGINE_CREATOR[options.db_type]()
+        try:
+            result = run_benchmark(
+                creator.get_engine(),
+                SensorDataset(num_rows, options.categorical_columns,
+                              options.cardinality),
+                options.max_order)
+        finally:
+            creator.teardown_engine()
+        results.append({
+            'datools_version': __version__,
+            'python_version': platform.python_version(),
+            'timestamp': datetime.now().isoformat(),
+            'db_type': options.db_type,
+            'num_rows': num_rows,
+            'num_categorical_columns': options.categorical_columns,
+            'cardinality': options.cardinality,
+            'max_order': options.max_order,
+            **result})
+        print(f'{options.db_type}, {num_rows} rows: {result["phases"]}',
+              file=sys.stderr)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            slower_phases = regressions(
+                results, json.load(baseline_file), options.tolerance)
+        for description in slower_phases:
+            print(f'Regression: {description}', file=sys.stderr)
+        if slower_phases:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
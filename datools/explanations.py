@@ -1,43 +1,120 @@
+import numpy as np
 import sqlalchemy
 
 from collections import defaultdict
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import datetime
+from itertools import combinations
+from math import erf
+from math import exp
 from math import floor
+from math import sqrt
 from textwrap import dedent
 from textwrap import indent
+from typing import Any
 from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Set
 from typing import Tuple
+from typing import Union
 
 from datools.errors import DatoolsError
+from datools.in_process_counts import encode_relations
+from datools.in_process_counts import group_counts
 from datools.models import Aggregate
+from datools.models import AdaptiveRanges
 from datools.models import AggregateFunction
 from datools.models import Column
 from datools.models import Constant
 from datools.models import Explanation
+from datools.models import GroupingSetsStrategy
 from datools.models import Operator
 from datools.models import Predicate
+from datools.models import RangeBucketing
+from datools.models import Sample
+from datools.models import StatisticsSource
+from datools.planner import plan_grouping_sets
 from datools.sqlalchemy_utils import INDENT
+from datools.sqlalchemy_utils import TemporaryTables
+from datools.sqlalchemy_utils import bound_text
+from datools.sqlalchemy_utils import default_grouping_sets_strategy
+from datools.sqlalchemy_utils import execute_query
 from datools.sqlalchemy_utils import grouping_sets_query
+from datools.sqlalchemy_utils import null_safe_equals
+from datools.sqlalchemy_utils import pinned_connection
 from datools.sqlalchemy_utils import query_columns
 from datools.sqlalchemy_utils import query_rows
+from datools.sqlalchemy_utils import quote
+from datools.sqlalchemy_utils import sampled_query
+from datools.sqlalchemy_utils import supports_grouping_sets
+from datools.statistics_catalog import StatisticsCatalog
+from datools.table_statistics import equi_width_statistics
+from datools.table_statistics import NUMERIC_TYPES
+from datools.table_statistics import planner_range_valued_statistics
 from datools.table_statistics import range_valued_statistics
+from datools.table_statistics import sampled_distinct_values
 from datools.table_statistics import RangeValuedStatistics
+from datools.tracing import Tracer
+from datools.tracing import count_fetched
+from datools.tracing import counted_rows
+from datools.tracing import listening
+from datools.tracing import traced_phase
 
 
 NUM_RANGE_BUCKETS = 15
+# Row counts and thresholds are interpolated into queries either as
+# numbers or as SQL expressions that evaluate to them (e.g., the bind
+# parameters of a `DiffPlan`).
+SqlNumber = Union[float, str]
+# The columns `_labeled_relation` adds to a relation, and the aggregates
+# that count test and control rows in a grouping sets query over it.
+LABEL_COLUMNS = (Column('test_row'), Column('control_row'))
+LABEL_AGGREGATES = (
+    Aggregate(AggregateFunction.SUM, Column('test_row'),
+              Column('test_explanation_size')),
+    Aggregate(AggregateFunction.SUM, Column('control_row'),
+              Column('control_explanation_size')))
+# The columns `_labeled_relation` adds to a relation with the number of
+# test and control rows in each row's segment (see `diff_by_segment`),
+# and the aggregates that carry them through a grouping sets query
+# that groups on the segment.
+SEGMENT_SIZE_COLUMNS = (
+    Column('segment_test_rows'), Column('segment_control_rows'))
+SEGMENT_AGGREGATES = tuple(
+    Aggregate(AggregateFunction.MAX, column, column)
+    for column in SEGMENT_SIZE_COLUMNS)
 
 
 def _rewrite_query_with_ranges_as_buckets(
+        engine: sqlalchemy.engine.Connectable,
         query: str,
-        range_statistics: List[Tuple[Column, RangeValuedStatistics]]
-) -> Tuple[str, Dict[Column, List[Tuple[Predicate, ...]]]]:
+        range_statistics: List[Tuple[Column, RangeValuedStatistics]],
+        bucketing: RangeBucketing = RangeBucketing.CASE
+) -> Tuple[str, Dict[Column, List[Tuple[Predicate, ...]]], Dict[str, Any]]:
+    """
+    Adds a bucket column for each of `range_statistics`' columns to
+    `query`. Returns the rewritten query, the predicates of each bucket
+    column's buckets, and the bucket minimums to bind to the rewritten
+    query's parameters.
+    """
     # For each of the columns we've got range predicates on, create a
     # proxy column for the bucketed range values.
     bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]] = defaultdict(
         list)
-    for column, statistic in range_statistics:
+    bucket_statistics: Dict[Column, RangeValuedStatistics] = {}
+    bucket_bounds: Dict[Column, List[str]] = {}
+    parameters: Dict[str, Any] = {}
+    for column_index, (column, statistic) in enumerate(range_statistics):
+        bucket_column = Column(f'{column.name}__bucket')
+        bucket_statistics[bucket_column] = statistic
+        bucket_bounds[bucket_column] = []
+        for index, minimum in enumerate(statistic.bucket_minimums):
+            name = f'datools_bucket_{column_index}_{index}'
+            parameters[name] = minimum
+            bucket_bounds[bucket_column].append(name)
         # If the bucket minimums in the statistics are (a, b, c),
         # we want to generate the following ranges:
         # * < b [we leave out a in case the control relation
@@ -47,7 +124,6 @@ def _rewrite_query_with_ranges_as_buckets(
         pairs = zip([None] + statistic.bucket_minimums[1:],
                     statistic.bucket_minimums[1:] + [None])
         for first, second in pairs:
-            bucket_column = Column(f'{column.name}__bucket')
             first_predicate = Predicate(
                 column, Operator.GTEQ, Constant(first))
             second_predicate = Predicate(column, Operator.LT, Constant(second))
@@ -61,75 +137,422 @@ def _rewrite_query_with_ranges_as_buckets(
                 bucket_predicates[bucket_column].append(
                     (first_predicate, second_predicate))
 
-    # Create a CASE statement for each bucket column that converts
-    # each range within that column into a single bucketed value.
-    cases = []
-    for column, column_predicates in bucket_predicates.items():
-        whens = []
-        for index, predicate_group in enumerate(column_predicates):
-            clause = ' AND '.join(predicate.to_sql()
-                                  for predicate in predicate_group)
-            whens.append(f'WHEN {clause} THEN {index}')
-        when_lines = indent(f'\n'.join(whens), 4 * INDENT)
-        cases.append(f'CASE\n{when_lines}\nEND AS {column.name}')
+    if bucketing == RangeBucketing.CASE:
+        # Create a CASE statement for each bucket column that converts
+        # each range within that column into a single bucketed value.
+        cases = []
+        for column, column_predicates in bucket_predicates.items():
+            range_column = quote(engine, column_predicates[0][0].left.name)
+            bounds = [_bound_sql(name, parameters[name])
+                      for name in bucket_bounds[column]]
+            last_bucket = len(column_predicates) - 1
+            whens = [f'WHEN {range_column} < {bounds[1]} THEN 0']
+            whens += [f'WHEN {range_column} >= {bounds[index]} '
+                      f'AND {range_column} < {bounds[index + 1]} '
+                      f'THEN {index}'
+                      for index in range(1, last_bucket)]
+            whens.append(
+                f'WHEN {range_column} >= {bounds[last_bucket]} '
+                f'THEN {last_bucket}')
+            when_lines = indent(f'\n'.join(whens), 4 * INDENT)
+            cases.append(
+                f'CASE\n{when_lines}\nEND AS {quote(engine, column.name)}')
+        boundaries: List[str] = []
+        joins: List[str] = []
+    else:
+        cases, boundaries, joins = _bucket_lookups(
+            engine, bucket_predicates, bucket_statistics, bucket_bounds,
+            bucketing, parameters)
 
     # Generate SQL.
     case_lines = ',\n'.join(cases)
+    boundary_lines = ''.join(f',\n{boundary}' for boundary in boundaries)
+    join_lines = '\n'.join(joins)
     return dedent(
         f'''
         WITH original_query AS (
             {query}
-        )
+        ){boundary_lines}
         SELECT
             original_query.*{',' if case_lines else ''}
             {case_lines}
         FROM original_query
-        '''), bucket_predicates
+        {join_lines}
+        '''), bucket_predicates, parameters
+
+
+def _range_statistics(
+        engine: sqlalchemy.engine.Connectable,
+        relation: str,
+        columns: Set[Column],
+        num_buckets: int,
+        bucketing: RangeBucketing,
+        catalog: Optional[StatisticsCatalog] = None,
+        catalog_relation: Optional[str] = None,
+        source: StatisticsSource = StatisticsSource.SCAN,
+        planner_relation: Optional[str] = None,
+        parameters: Optional[Dict[str, Any]] = None
+) -> List[Tuple[Column, RangeValuedStatistics]]:
+    """
+    Computes the range statistics of `relation` (binding `parameters`
+    to it, which catalogs don't support), reusing those stored
+    in `catalog` for `catalog_relation` (the relation `relation` reads,
+    if it's a copy or subset of it) when there are any. With
+    `StatisticsSource.CATALOG`, statistics are first approximated from
+    the database planner's statistics about `planner_relation`.
+    """
+    statistics: List[Tuple[Column, RangeValuedStatistics]] = []
+    if (source == StatisticsSource.CATALOG and planner_relation is not None
+            and bucketing != RangeBucketing.EQUI_WIDTH):
+        planner_statistics = planner_range_valued_statistics(
+            engine, planner_relation, columns, num_buckets)
+        statistics += planner_statistics.items()
+        columns = {column for column in columns
+                   if column not in planner_statistics}
+    if catalog is not None and catalog_relation is not None:
+        if bucketing == RangeBucketing.EQUI_WIDTH:
+            return statistics + catalog.equi_width_statistics(
+                engine, relation, columns, num_buckets, catalog_relation)
+        return statistics + catalog.range_valued_statistics(
+            engine, relation, columns, num_buckets, catalog_relation)
+    if bucketing == RangeBucketing.EQUI_WIDTH:
+        return statistics + equi_width_statistics(
+            engine, relation, columns, num_buckets, parameters)
+    return statistics + range_valued_statistics(
+        engine, relation, columns, num_buckets, parameters=parameters)
+
+
+def _bound_sql(name: str, value: Any) -> str:
+    """
+    The SQL for bind parameter `name`, which is bound to `value`.
+    """
+    # A float might otherwise be read as a DECIMAL that rounds it
+    # differently from how it was compared in a predicate.
+    if isinstance(value, float):
+        return f'CAST(:{name} AS DOUBLE PRECISION)'
+    return f':{name}'
+
+
+def _bucket_lookups(
+        engine: sqlalchemy.engine.Connectable,
+        bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]],
+        bucket_statistics: Dict[Column, RangeValuedStatistics],
+        bucket_bounds: Dict[Column, List[str]],
+        bucketing: RangeBucketing,
+        parameters: Dict[str, Any]
+) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Assigns bucket IDs without testing every bucket of each row. Rows
+    below the second bucket minimum or above the last one are assigned
+    to the first or last bucket, and the remaining rows are assigned
+    either with a range join against a VALUES relation of bucket
+    boundaries (`RangeBucketing.BOUNDARY_JOIN`) or by dividing their
+    distance from the first bucket minimum by the bucket width
+    (`RangeBucketing.EQUI_WIDTH`, which requires statistics from
+    `equi_width_statistics`). Columns whose bucket widths are unknown
+    (e.g., `diff_by_window`'s timestamp windows) fall back to a range
+    join with `RangeBucketing.EQUI_WIDTH`. `bucket_bounds` names the
+    parameter of each bucket minimum in `parameters`, to which bucket
+    widths are added.
+
+    Returns the bucket ID expressions, the boundary relations, and the
+    joins against them.
+    """
+    cases = []
+    boundaries = []
+    joins = []
+    for column_index, (column, column_predicates) in enumerate(
+            bucket_predicates.items()):
+        range_column = (
+            f'original_query.'
+            f'{quote(engine, column_predicates[0][0].left.name)}')
+        bounds = [_bound_sql(name, parameters[name])
+                  for name in bucket_bounds[column]]
+        last_bucket = len(column_predicates) - 1
+        whens = [f'WHEN {range_column} < {bounds[1]} THEN 0',
+                 f'WHEN {range_column} >= {bounds[last_bucket]} '
+                 f'THEN {last_bucket}']
+        statistic = bucket_statistics[column]
+        if last_bucket < 2:
+            default = 'NULL'
+        elif (bucketing == RangeBucketing.BOUNDARY_JOIN
+              or statistic.bucket_width is None):
+            boundary_name = f'datools_boundaries_{column_index}'
+            # The first and last buckets are listed too (though the
+            # CASE expression assigns them) so that both bound columns
+            # contain the same values. Otherwise some databases (e.g.,
+            # DuckDB) infer differently-rounded types for each column,
+            # and adjacent buckets overlap.
+            values = ',\n'.join(
+                [f'(0, NULL, {bounds[1]})']
+                + [f'({index}, {bounds[index]}, {bounds[index + 1]})'
+                   for index in range(1, last_bucket)]
+                + [f'({last_bucket}, {bounds[last_bucket]}, NULL)'])
+            boundaries.append(
+                f'{boundary_name} (bucket, lower_bound, upper_bound) AS (\n'
+                f'{INDENT}VALUES\n{indent(values, 2 * INDENT)}\n)')
+            joins.append(
+                f'LEFT JOIN {boundary_name}\n'
+                f'ON {range_column} >= {boundary_name}.lower_bound\n'
+                f'AND {range_column} < {boundary_name}.upper_bound')
+            default = f'{boundary_name}.bucket'
+        else:
+            width_name = f'datools_bucket_width_{column_index}'
+            parameters[width_name] = statistic.bucket_width
+            default = (
+                f'CAST(FLOOR((CAST({range_column} AS DOUBLE PRECISION) - '
+                f'CAST(:{bucket_bounds[column][0]} AS DOUBLE PRECISION)) / '
+                f'CAST(:{width_name} AS DOUBLE PRECISION)) AS INTEGER)')
+        when_lines = indent('\n'.join(whens), INDENT)
+        cases.append(
+            f'CASE\n{when_lines}\n{INDENT}ELSE {default}\n'
+            f'END AS {quote(engine, column.name)}')
+    return cases, boundaries, joins
 
 
 def _explanation_counts_query(
         engine: sqlalchemy.engine.Engine,
         relation: str,
-        on_columns: Set[Column],
-        min_support_rows: Optional[int] = None
+        sets: Tuple[Tuple[Column, ...], ...],
+        min_support_rows: Optional[SqlNumber] = None,
+        flag_columns: Tuple[Column, ...] = (),
+        aggregates: Tuple[Aggregate, ...] = (
+            Aggregate(
+                AggregateFunction.COUNT,
+                Column('*'),
+                Column('explanation_size')), ),
+        support_column: Column = Column('explanation_size'),
+        strategy: Optional[GroupingSetsStrategy] = None
 ) -> Tuple[str, Dict[int, Tuple[Column, ...]]]:
     group_explanations_query, grouping_set_index = grouping_sets_query(
         engine,
         relation,
-        tuple((column, ) for column in on_columns),
-        (Aggregate(
-            AggregateFunction.COUNT,
-            Column('*'),
-            Column('explanation_size')), )
+        sets,
+        aggregates,
+        strategy=strategy
     )
+    # We filter outside of the grouping sets query rather than with a
+    # HAVING clause, since a HAVING clause would only apply to the
+    # last query in a synthetic (UNION ALL) grouping sets query. Each
+    # grouping set requires its own flag columns to be set, which we
+    # express in terms of the grouping ID since some databases (e.g.,
+    # DuckDB) incorrectly push filters on grouping set columns below
+    # the aggregation.
+    filters = []
+    flag_cases = [
+        f'WHEN {grouping_id} THEN '
+        + ' AND '.join(f'({quote(engine, column.name)} = 1)'
+                       for column in grouping_set if column in flag_columns)
+        for grouping_id, grouping_set in grouping_set_index.items()
+        if set(grouping_set) & set(flag_columns)]
+    if flag_cases:
+        case_lines = indent('\n'.join(flag_cases), INDENT)
+        filters.append(f'(CASE grouping_id\n{case_lines}\nELSE 1 = 1 END)')
     if min_support_rows is not None:
-        group_explanations_query += (
-            f'HAVING (1.0 * COUNT(*)) > {min_support_rows}\n')
+        filters.append(
+            f'((1.0 * {quote(engine, support_column.name)}) '
+            f'> {min_support_rows})')
+    if filters:
+        group_explanations_query = dedent(
+            f'''
+            SELECT *
+            FROM (
+                {indent(group_explanations_query, 4 * INDENT)}
+            ) AS counts
+            WHERE {' AND '.join(filters)}
+            ''')
     return group_explanations_query, grouping_set_index
 
 
+def _frequent_flag_column(column: Column) -> Column:
+    return Column(f'{column.name}__frequent')
+
+
+def _apriori_pruned_query(
+        engine: sqlalchemy.engine.Connectable,
+        relation: str,
+        on_columns: Tuple[Column, ...],
+        frequent_query: str,
+        frequent_index: Dict[int, Tuple[Column, ...]],
+        carried_columns: Tuple[Column, ...] = (),
+        partition_columns: Tuple[Column, ...] = ()
+) -> str:
+    """
+    Rewrites `relation` so that higher-order explanations can be pruned
+    Apriori-style: a combination of values can only be frequent if
+    each of its values is frequent on its own.
+
+    `frequent_query` produces the frequent one-column explanations,
+    and `frequent_index` is its grouping set index. Each row is
+    semi-joined against `frequent_query` to add a flag column (see
+    `_frequent_flag_column`) for each of `on_columns`. Values that are
+    not frequent are replaced with NULL so that they collapse into a
+    single group rather than each materializing a group of their
+    own. Only `on_columns`, their flag columns, and `carried_columns`
+    are projected. If there are `partition_columns` (e.g., the segment
+    column of `diff_by_segment`), a value is only frequent within the
+    partition it was counted in.
+    """
+    grouping_ids = {
+        grouping_set: grouping_id
+        for grouping_id, grouping_set in frequent_index.items()}
+
+    def quoted(column: Column) -> str:
+        return quote(engine, column.name)
+
+    flags = []
+    for column in on_columns:
+        conditions = (
+            [f'frequent.grouping_id = {grouping_ids[(column, )]}']
+            + [null_safe_equals(engine, f'frequent.{quoted(matched)}',
+                                f'candidate_query.{quoted(matched)}')
+               for matched in (column, ) + partition_columns])
+        flags.append(dedent(
+            f'''
+            CASE WHEN EXISTS (
+                SELECT 1
+                FROM frequent
+                WHERE {' AND '.join(conditions)}
+            ) THEN 1 ELSE 0 END AS {quoted(_frequent_flag_column(column))}'''))
+
+    flag_lines = ','.join(flags)
+    values = ',\n'.join(
+        f'CASE WHEN {quoted(_frequent_flag_column(column))} = 1 '
+        f'THEN {quoted(column)} END AS {quoted(column)}, '
+        f'{quoted(_frequent_flag_column(column))}'
+        for column in on_columns)
+    values += ''.join(f',\n{quoted(column)}' for column in carried_columns)
+    return dedent(
+        f'''
+        WITH candidate_query AS (
+            {relation}
+        ),
+        frequent AS (
+            {indent(frequent_query, 3 * INDENT)}
+        ),
+        flagged AS (
+            SELECT
+                candidate_query.*,
+                {indent(flag_lines, 4 * INDENT)}
+            FROM candidate_query
+        )
+        SELECT
+            {indent(values, 3 * INDENT)}
+        FROM flagged
+        ''')
+
+
+def _apriori_subsets_query(
+        engine: sqlalchemy.engine.Connectable,
+        explanations_query: str,
+        grouping_set_index: Dict[int, Tuple[Column, ...]],
+        frequent_query: str,
+        frequent_index: Dict[int, Tuple[Column, ...]],
+        on_columns: Tuple[Column, ...],
+        partition_columns: Tuple[Column, ...] = ()
+) -> str:
+    """
+    Filters the explanations in `explanations_query` down to the ones
+    for which every subset that is one column smaller is frequent.
+
+    `frequent_query` produces the frequent explanations that are one
+    column smaller, and `frequent_index` is its grouping set index. A
+    small VALUES relation maps each grouping set to each of its subsets
+    and the position in `on_columns` of the column that was dropped to
+    form it, and each explanation
+    is semi-joined against `frequent_query` through that relation.
+    Subsets have to be frequent within the same `partition_columns`
+    (see `_apriori_pruned_query`).
+    """
+    frequent_ids = {
+        grouping_set: grouping_id
+        for grouping_id, grouping_set in frequent_index.items()}
+    subsets = []
+    for grouping_id, grouping_set in grouping_set_index.items():
+        for dropped_column in grouping_set:
+            subset = tuple(column for column in grouping_set
+                           if column != dropped_column)
+            subsets.append(
+                f'({grouping_id}, {frequent_ids[subset]}, '
+                f'{on_columns.index(dropped_column)})')
+    conditions = (
+        ['subsets.grouping_id = explanations.grouping_id',
+         'frequent.grouping_id = subsets.subset_grouping_id']
+        + [f'((subsets.dropped_column = {index}) OR '
+           + null_safe_equals(engine, f'frequent.{quote(engine, column.name)}',
+                              f'explanations.{quote(engine, column.name)}')
+           + ')'
+           for index, column in enumerate(on_columns)]
+        + [null_safe_equals(engine, f'frequent.{quote(engine, column.name)}',
+                            f'explanations.{quote(engine, column.name)}')
+           for column in partition_columns])
+    order = len(next(iter(grouping_set_index.values())))
+    condition_lines = '\nAND '.join(conditions)
+    return dedent(
+        f'''
+        WITH explanations AS (
+            {indent(explanations_query, 3 * INDENT)}
+        ),
+        frequent AS (
+            {indent(frequent_query, 3 * INDENT)}
+        ),
+        subsets (grouping_id, subset_grouping_id, dropped_column) AS (
+            VALUES {', '.join(subsets)}
+        )
+        SELECT explanations.*
+        FROM explanations
+        WHERE (
+            SELECT COUNT(*)
+            FROM subsets, frequent
+            WHERE {indent(condition_lines, 3 * INDENT)}
+        ) = {order}
+        ''')
+
+
+def _risk_ratio_sql(
+        test_size: str,
+        control_size: str,
+        num_test_rows: SqlNumber,
+        num_control_rows: SqlNumber
+) -> str:
+    # TODO(marcua): Consult with someone better at statistics on how
+    # to avoid division by 0 in the risk ratio when a group encompases
+    # the entire relation. For now, make the relation size one larger
+    # than it actually is.
+    adjusted_test_rows = f'({num_test_rows} + 1)'
+    adjusted_control_rows = f'({num_control_rows} + 1)'
+    return dedent(
+        f'''
+        (1.0 * {test_size}
+         / ({test_size}
+           + COALESCE({control_size}, 0)))
+        /
+        (1.0 * ({adjusted_test_rows} - {test_size})
+         / (({adjusted_test_rows} - {test_size})
+            + ({adjusted_control_rows}
+               - COALESCE({control_size}, 0)))
+        )''')
+
+
 def _diff_query(
+        engine: sqlalchemy.engine.Connectable,
         test_explanations_query: str,
         control_explanations_query: str,
-        num_test_rows: float,
-        num_control_rows: float,
-        on_columns: Set[Column],
-        min_risk_ratio: float
+        num_test_rows: SqlNumber,
+        num_control_rows: SqlNumber,
+        on_columns: Tuple[Column, ...],
+        min_risk_ratio: SqlNumber
 ) -> str:
     join_conditions = (
         ['test.grouping_id = control.grouping_id']
-        + [f'((test.{column.name} = control.{column.name}) '
-           f' OR ((test.{column.name} IS NULL) '
-           f'     AND (control.{column.name} IS NULL)))'
+        + [null_safe_equals(
+            engine, f'test.{quote(engine, column.name)}',
+            f'control.{quote(engine, column.name)}')
            for column in on_columns])
     join_statement = ' AND '.join(join_conditions)
-
-    # TODO(marcua): Consult with someone better at statistics on how
-    # to avoid division by 0 in the risk ratio when a group encompases
-    # the entire relation. For now, make the relation size one larger
-    # than it actually is.
-    adjusted_test_rows = num_test_rows + 1
-    adjusted_control_rows = num_control_rows + 1
+    risk_ratio = _risk_ratio_sql(
+        'test.explanation_size', 'control.explanation_size',
+        num_test_rows, num_control_rows)
 
     diff_query = dedent(
         f'''
@@ -143,18 +566,11 @@ def _diff_query(
         comparison AS (
             SELECT
                 test.grouping_id,
-                {', '.join(f'test.{column.name}' for column in on_columns)},
+                {', '.join(f'test.{quote(engine, column.name)}'
+                           for column in on_columns)},
                 test.explanation_size AS test_explanation_size,
                 control.explanation_size AS control_explanation_size,
-                (1.0 * test.explanation_size
-                 / (test.explanation_size
-                   + COALESCE(control.explanation_size, 0)))
-                /
-                (1.0 * ({adjusted_test_rows} - test.explanation_size)
-                 / (({adjusted_test_rows} - test.explanation_size)
-                    + ({adjusted_control_rows}
-                       - COALESCE(control.explanation_size, 0)))
-                ) AS risk_ratio
+                {indent(risk_ratio, 4 * INDENT)} AS risk_ratio
             FROM test
             LEFT JOIN control ON {join_statement}
         )
@@ -166,6 +582,333 @@ def _diff_query(
     return diff_query
 
 
+def _condition_diff_query(
+        engine: sqlalchemy.engine.Connectable,
+        explanations_query: str,
+        num_test_rows: SqlNumber,
+        num_control_rows: SqlNumber,
+        on_columns: Tuple[Column, ...],
+        min_risk_ratio: SqlNumber,
+        partition_columns: Tuple[Column, ...] = ()
+) -> str:
+    """
+    The equivalent of `_diff_query` for an `explanations_query` that
+    counts test and control rows side by side (see
+    `_labeled_relation`), which requires no join. `partition_columns`
+    are passed through alongside `on_columns`.
+    """
+    risk_ratio = _risk_ratio_sql(
+        'labeled_explanations.test_explanation_size',
+        'labeled_explanations.control_explanation_size',
+        num_test_rows, num_control_rows)
+    return dedent(
+        f'''
+        WITH
+        labeled_explanations AS (
+            {indent(explanations_query, 3 * INDENT)}
+        ),
+        comparison AS (
+            SELECT
+                labeled_explanations.grouping_id,
+                {', '.join(f'labeled_explanations.{quote(engine, column.name)}'
+                           for column in partition_columns + on_columns)},
+                labeled_explanations.test_explanation_size,
+                labeled_explanations.control_explanation_size,
+                {indent(risk_ratio, 4 * INDENT)} AS risk_ratio
+            FROM labeled_explanations
+        )
+        SELECT *
+        FROM comparison
+        WHERE risk_ratio > {min_risk_ratio}
+        ORDER BY risk_ratio DESC
+        ''')
+
+
+def _labeled_relation(
+        engine: sqlalchemy.engine.Connectable,
+        relation: str,
+        test_condition: str,
+        segment_column: Optional[Column] = None
+) -> str:
+    """
+    Adds a `test_row` and a `control_row` column to `relation` that are
+    1 for rows that do and don't match `test_condition`, respectively.
+    If there is a `segment_column`, the number of test and control rows
+    in each row's segment are added as well (see
+    `SEGMENT_SIZE_COLUMNS`).
+    """
+    test_row = f'CASE WHEN ({test_condition}) THEN 1 ELSE 0 END'
+    control_row = f'CASE WHEN ({test_condition}) THEN 0 ELSE 1 END'
+    segment_sizes = ''
+    if segment_column is not None:
+        segment_test_rows, segment_control_rows = SEGMENT_SIZE_COLUMNS
+        window = f'OVER (PARTITION BY {quote(engine, segment_column.name)})'
+        segment_sizes = (
+            f',\nSUM({test_row}) {window} AS {segment_test_rows.name},'
+            f'\nSUM({control_row}) {window} AS {segment_control_rows.name}')
+    return dedent(
+        f'''
+        WITH labeled_query AS (
+            {relation}
+        )
+        SELECT
+            labeled_query.*,
+            {test_row} AS test_row,
+            {control_row} AS control_row{indent(segment_sizes, 3 * INDENT)}
+        FROM labeled_query
+        ''')
+
+
+def _labeled_rows(
+        engine: sqlalchemy.engine.Connectable,
+        labeled_relation: str,
+        tracer: Optional[Tracer] = None
+) -> Tuple[int, int]:
+    """
+    Returns the number of test and control rows in `labeled_relation`
+    (see `_labeled_relation`), counted in a single pass.
+    """
+    results = execute_query(
+        engine,
+        f'WITH query AS ({labeled_relation}) '
+        f'SELECT SUM(test_row) AS num_test_rows, '
+        f'SUM(control_row) AS num_control_rows FROM query')
+    row = results.first()
+    results.close()
+    count_fetched(tracer, 1)
+    return (row.num_test_rows or 0, row.num_control_rows or 0)
+
+
+def _validate_on_columns(
+        column_names: Tuple[str, ...],
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column]
+) -> Tuple[str, ...]:
+    """
+    Ensures that `on_column_values` and `on_column_ranges` are columns
+    of a relation with columns named `column_names`, and returns their
+    names in the order they appear in the relation.
+    """
+    on_column_names = ({column.name for column in on_column_values} |
+                       {column.name for column in on_column_ranges})
+    if on_column_names - set(column_names):
+        raise DatoolsError('on_columns is not a subset of test_relation')
+    return tuple(name for name in column_names if name in on_column_names)
+
+
+def _on_columns(
+        on_column_values: Set[Column],
+        bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]]
+) -> Tuple[Tuple[Column, ...], Dict[Column, Column]]:
+    """
+    Returns the columns that explanations are generated on, in a
+    deterministic order, and a mapping from each of them to the column
+    it was derived from (range bucket proxy columns are derived from
+    their range-valued column).
+    """
+    on_columns = tuple(sorted(
+        on_column_values | set(bucket_predicates.keys()),
+        key=lambda column: column.name))
+    source_columns = {column: column for column in on_column_values}
+    source_columns.update({
+        column: predicates[0][0].left
+        for column, predicates in bucket_predicates.items()})
+    return on_columns, source_columns
+
+
+def _order_sets(
+        on_columns: Tuple[Column, ...],
+        source_columns: Dict[Column, Column],
+        order: int
+) -> Tuple[Tuple[Tuple[Column, ...], ...], Tuple[Column, ...]]:
+    """
+    Returns the grouping sets for explanations of size `order` and the
+    flag columns they rely on (see `_apriori_pruned_query`).
+    """
+    # A range column's bucket proxy column is never combined with the
+    # range column itself.
+    sets = tuple(
+        grouping_set for grouping_set in combinations(on_columns, order)
+        if len({source_columns[column] for column in grouping_set}) == order)
+    if order == 1:
+        return sets, ()
+    # Grouping on each column's flag alongside the column keeps
+    # infrequent values that were collapsed into NULL apart from true
+    # NULL values.
+    flagged_sets = tuple(
+        grouping_set + tuple(_frequent_flag_column(column)
+                             for column in grouping_set)
+        for grouping_set in sets)
+    flag_columns = tuple(
+        _frequent_flag_column(column) for column in on_columns)
+    return flagged_sets, flag_columns
+
+
+def _explanation_sets(
+        on_columns: Tuple[Column, ...],
+        source_columns: Dict[Column, Column],
+        max_order: int
+) -> Tuple[Tuple[Column, ...], ...]:
+    """
+    Returns the grouping sets for explanations of every size up to
+    `max_order`, without flag columns.
+    """
+    return tuple(
+        flagged_set[:order]
+        for order in range(1, min(max_order, len(on_columns)) + 1)
+        for flagged_set in _order_sets(on_columns, source_columns, order)[0])
+
+
+def _unflagged_set_index(
+        grouping_set_index: Dict[int, Tuple[Column, ...]],
+        on_columns: Tuple[Column, ...]
+) -> Dict[int, Tuple[Column, ...]]:
+    return {
+        grouping_id: tuple(column for column in grouping_set
+                           if column in on_columns)
+        for grouping_id, grouping_set in grouping_set_index.items()}
+
+
+def _normal_quantile(probability: float) -> float:
+    """
+    Returns the value below which `probability` of a standard normal
+    distribution lies, found by bisection on its CDF.
+    """
+    low, high = -10.0, 10.0
+    for _ in range(100):
+        middle = (low + high) / 2
+        if (1 + erf(middle / sqrt(2))) / 2 < probability:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def _sample_fraction(
+        connection: sqlalchemy.engine.Connection,
+        sample: Sample,
+        relations: Tuple[str, ...]
+) -> float:
+    """
+    Returns the fraction of the rows of `relations` that `sample`
+    describes. A fixed number of rows is spread across all of
+    `relations` so that they are sampled at the same rate.
+    """
+    if sample.fraction is not None and sample.rows is None:
+        fraction = sample.fraction
+    elif sample.rows is not None and sample.fraction is None:
+        num_rows = sum(
+            query_rows(connection, relation) for relation in relations)
+        fraction = 1.0 * sample.rows / num_rows if num_rows else 1.0
+    else:
+        raise DatoolsError('A sample needs exactly one of fraction or rows')
+    if fraction <= 0:
+        raise DatoolsError('A sample must contain a positive number of rows')
+    return min(fraction, 1.0)
+
+
+@dataclass
+class _SampleEstimator:
+    """
+    Scales explanations computed on a `fraction` of the test and control
+    rows back up to the full relations, and adds confidence intervals.
+    `num_test_rows` and `num_control_rows` are the sizes of the samples.
+    """
+    fraction: float
+    num_test_rows: float
+    num_control_rows: float
+    confidence: float
+
+    def estimate(self, explanation: Explanation) -> Explanation:
+        z = _normal_quantile((1 + self.confidence) / 2)
+        test_size = 1.0 * (explanation.test_support or 0)
+        control_size = 1.0 * (explanation.control_support or 0)
+        # The standard error of the sampled test support, scaled up.
+        support_error = (
+            z * sqrt(test_size * (1 - self.fraction)) / self.fraction)
+        # The standard error of the log of the risk ratio (Katz et al.,
+        # 1978), using the same adjusted relation sizes as
+        # `_risk_ratio_sql`.
+        other_test_size = self.num_test_rows + 1 - test_size
+        other_control_size = self.num_control_rows + 1 - control_size
+        log_error = z * sqrt(
+            1 / test_size - 1 / (test_size + control_size)
+            + 1 / other_test_size
+            - 1 / (other_test_size + other_control_size))
+        return Explanation(
+            explanation.predicates,
+            explanation.risk_ratio,
+            test_support=test_size / self.fraction,
+            control_support=control_size / self.fraction,
+            test_support_interval=(
+                max(test_size / self.fraction - support_error, 0.0),
+                test_size / self.fraction + support_error),
+            risk_ratio_interval=(
+                explanation.risk_ratio * exp(-log_error),
+                explanation.risk_ratio * exp(log_error)))
+
+
+def _diff_queries(
+        engine: sqlalchemy.engine.Engine,
+        test_relation: str,
+        control_relation: str,
+        on_columns: Tuple[Column, ...],
+        source_columns: Dict[Column, Column],
+        max_order: int,
+        min_support_rows: SqlNumber,
+        num_test_rows: SqlNumber,
+        num_control_rows: SqlNumber,
+        min_risk_ratio: SqlNumber,
+        strategy: GroupingSetsStrategy
+) -> List[Tuple[str, Dict[int, Tuple[Column, ...]]]]:
+    """
+    Returns a query for each order of explanation, along with its
+    grouping set index. Each query GROUPs BY all combinations of
+    `order` of `on_columns` (in a grouping sets query, see
+    `GroupingSetsStrategy`), removes ones with a size less than
+    `min_support_rows`, and joins the test and control counts to
+    compute each explanation's risk ratio.
+    """
+    frequent_queries: Dict[
+        int, Tuple[str, Dict[int, Tuple[Column, ...]]]] = {}
+    queries: List[Tuple[str, Dict[int, Tuple[Column, ...]]]] = []
+    for order in range(1, min(max_order, len(on_columns)) + 1):
+        sets, flag_columns = _order_sets(
+            on_columns, source_columns, order)
+        if not sets:
+            break
+        if order == 1:
+            test_order_relation = test_relation
+            control_order_relation = control_relation
+        else:
+            test_order_relation = _apriori_pruned_query(
+                engine, test_relation, on_columns, *frequent_queries[1])
+            control_order_relation = _apriori_pruned_query(
+                engine, control_relation, on_columns, *frequent_queries[1])
+        test_explanations_query, flagged_set_index = (
+            _explanation_counts_query(
+                engine, test_order_relation, sets, min_support_rows,
+                flag_columns, strategy=strategy))
+        control_explanations_query, _ = _explanation_counts_query(
+            engine, control_order_relation, sets, None, flag_columns,
+            strategy=strategy)
+        grouping_set_index = _unflagged_set_index(
+            flagged_set_index, on_columns)
+        if order > 2:
+            test_explanations_query = _apriori_subsets_query(
+                engine, test_explanations_query, grouping_set_index,
+                *frequent_queries[order - 1], on_columns)
+        frequent_queries[order] = (
+            test_explanations_query, grouping_set_index)
+        queries.append((
+            _diff_query(
+                engine, test_explanations_query, control_explanations_query,
+                num_test_rows, num_control_rows,
+                on_columns, min_risk_ratio),
+            grouping_set_index))
+    return queries
+
+
 def diff(
         engine: sqlalchemy.engine.Engine,
         test_relation: str,
@@ -174,7 +917,16 @@ def diff(
         on_column_ranges: Set[Column],
         min_support: float,
         min_risk_ratio: float,
-        max_order: int
+        max_order: int,
+        materialize: bool = False,
+        sample: Optional[Sample] = None,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE,
+        adaptive_ranges: Optional[AdaptiveRanges] = None,
+        catalog: Optional[StatisticsCatalog] = None,
+        statistics_source: StatisticsSource = StatisticsSource.SCAN,
+        tracer: Optional[Tracer] = None
 ) -> List[Explanation]:
     """
     Generates candidate explanations for why records are more likely to appear
@@ -218,71 +970,2132 @@ def diff(
     :param max_order: The largest number of columns on which to consider
                       an explanation. For example, a 2-column explanation could
                       be that (category='dog walker' AND signup_day='sunday').
-                      The current implementation only supports 1-column
-                      explanations.
-    """
-    if max_order != 1:
-        raise DatoolsError('Only one-column predicates are supported for now')
-
-    # Get all column names from test_relation and control_relation,
-    # ensure they are the same.
-    # TODO(marcua): compare types.
-    test_column_names = query_columns(engine, test_relation)
-    control_column_names = query_columns(engine, control_relation)
-    if test_column_names != control_column_names:
+                      Higher-order explanations are pruned Apriori-style:
+                      only combinations of values whose lower-order
+                      subsets meet `min_support` are considered.
+    :param materialize: If True, `test_relation` and `control_relation` are
+                        each executed once into a temporary table that
+                        contains only the columns explanations are
+                        generated on (and their range buckets), and every
+                        subsequent query reads from those tables. This
+                        helps when the relations are expensive to compute.
+    :param sample: If provided, explanations are computed on a sample of
+                   `test_relation` and `control_relation` (which implies
+                   `materialize`). Support counts are scaled back up to
+                   estimate the full relations' counts, and each
+                   explanation carries confidence intervals on its test
+                   support and risk ratio so you can judge whether it
+                   would survive an exact run.
+    :param strategy: How to count explanations across grouping sets
+                     (see `GroupingSetsStrategy`). Defaults to the
+                     database's native grouping sets, or for databases
+                     without them (e.g., SQLite), to whichever of a
+                     UNION ALL query and counting in process
+                     `datools.planner.plan_grouping_sets` estimates is
+                     faster for the relations' sizes and the number of
+                     grouping sets. Adaptive ranges are refined with
+                     the database's default strategy.
+    :param num_range_buckets: The number of buckets each column in
+                              `on_column_ranges` is split into.
+    :param range_bucketing: How rows are assigned to range buckets (see
+                            `RangeBucketing`). `RangeBucketing.CASE`
+                            tests every bucket of every row, and is
+                            fine for a few buckets. With many buckets,
+                            `RangeBucketing.BOUNDARY_JOIN` finds each
+                            row's bucket with a range join instead
+                            (which helps on databases with efficient
+                            range joins, e.g., DuckDB), and
+                            `RangeBucketing.EQUI_WIDTH` computes it
+                            arithmetically from buckets of equal width
+                            (rather than equal height) on numeric
+                            columns.
+    :param adaptive_ranges: If provided, columns in `on_column_ranges`
+                            are bucketed coarse-to-fine (see
+                            `AdaptiveRanges`) rather than into
+                            `num_range_buckets` buckets: only buckets
+                            whose explanations meet `min_support` and
+                            `min_risk_ratio` are split into finer ones.
+    :param catalog: If provided, the range statistics of
+                    `test_relation` are reused from (or stored in)
+                    this `StatisticsCatalog` as long as
+                    `test_relation` is unchanged (see
+                    `StatisticsCatalog` for which relations it can
+                    tell are unchanged). Sampled and adaptive range
+                    statistics are not cached.
+    :param statistics_source: With `StatisticsSource.CATALOG`, range
+                              buckets are approximated from the
+                              database planner's statistics about
+                              `test_relation` where it has them (see
+                              `range_valued_statistics`), rather than
+                              by scanning it. This doesn't apply to
+                              adaptive or equal-width buckets.
+    :param tracer: If provided, this `Tracer` records how long each
+                   phase of the diff took (e.g., `range_statistics`,
+                   or `order_2` within `explanations`), along with the
+                   SQL statements each phase ran.
+    """
+    if max_order < 1:
+        raise DatoolsError('max_order must be at least 1')
+    if (adaptive_ranges is not None
+            and range_bucketing == RangeBucketing.EQUI_WIDTH):
         raise DatoolsError(
-            'test_relation and control_relation have different schemas')
+            'Adaptive ranges are not split into buckets of equal width')
 
-    # Ensure on_columns are a subset of the test/control columns.
-    on_column_names = ({column.name for column in on_column_values} |
-                       {column.name for column in on_column_ranges})
-    if on_column_names - set(test_column_names):
-        raise DatoolsError('on_columns is not a subset of test_relation')
+    # Run every query on a single connection so that temporary tables
+    # are visible to all of them.
+    with listening(tracer, engine), engine.connect() as connection, \
+            TemporaryTables(connection) as temporary_tables:
+        # Get all column names from test_relation and control_relation,
+        # ensure they are the same.
+        # TODO(marcua): compare types.
+        catalog_relation: Optional[str] = test_relation
+        planner_relation = test_relation
+        with traced_phase(tracer, 'validate'):
+            test_column_names = query_columns(connection, test_relation)
+            control_column_names = query_columns(
+                connection, control_relation)
+        if test_column_names != control_column_names:
+            raise DatoolsError(
+                'test_relation and control_relation have different schemas')
 
-    # Get size of test_relation, control_relation.
-    num_test_rows = 1.0 * query_rows(engine, test_relation)
-    num_control_rows = 1.0 * query_rows(engine, control_relation)
-    min_support_rows = floor(num_test_rows * min_support)
-
-    # Transform ranges in on_column_ranges into bucket IDs.
-    range_statistics = range_valued_statistics(
-        engine, test_relation, on_column_ranges,
-        num_buckets=NUM_RANGE_BUCKETS)
-    rewritten_test_relation, test_bucket_predicates = (
-        _rewrite_query_with_ranges_as_buckets(
-            test_relation, range_statistics))
-    rewritten_control_relation, control_bucket_predicates = (
-        _rewrite_query_with_ranges_as_buckets(
-            control_relation, range_statistics))
-
-    # GROUP BY all test_relation columns, remove ones with a size less
-    # than min_support_rows.
-    on_columns = (on_column_values |
-                  {column for column in test_bucket_predicates.keys()})
-    test_explanations_query, grouping_set_index = _explanation_counts_query(
-        engine, rewritten_test_relation, on_columns, min_support_rows)
-    control_explanations_query, _ = _explanation_counts_query(
-        engine, rewritten_control_relation, on_columns, min_support_rows=None)
-    diff_query = _diff_query(
-        test_explanations_query, control_explanations_query,
-        num_test_rows, num_control_rows,
-        on_columns, min_risk_ratio)
-
-    result = engine.execute(diff_query)
-    explanations = []
-    for row in result:
-        predicates = []
-        for column in grouping_set_index[row.grouping_id]:
-            if column in on_column_values:
-                predicates.append(Predicate(
-                    column, Operator.EQUALS, Constant(row[column.name])))
+        # Ensure on_columns are a subset of the test/control columns.
+        on_column_names = _validate_on_columns(
+            test_column_names, on_column_values, on_column_ranges)
+
+        if sample is not None:
+            with traced_phase(tracer, 'sample'):
+                fraction = _sample_fraction(
+                    connection, sample, (test_relation, control_relation))
+            if fraction < 1:
+                test_relation = sampled_query(
+                    connection, test_relation, fraction, sample.seed)
+                control_relation = sampled_query(
+                    connection, control_relation, fraction, sample.seed)
+                catalog_relation = None
+            # A sample might differ each time it's queried, so we
+            # materialize it to ensure every query sees the same rows.
+            materialize = True
+
+        if materialize:
+            with traced_phase(tracer, 'materialize'):
+                test_rows_table = temporary_tables.create(
+                    test_relation,
+                    tuple(Column(name) for name in on_column_names))
+            test_relation = f'SELECT * FROM {test_rows_table}'
+            control_columns = ', '.join(
+                quote(engine, name) for name in on_column_names)
+            control_relation = (
+                f'SELECT {control_columns} '
+                f'FROM ({control_relation}) AS control_relation')
+
+        # Get size of test_relation.
+        with traced_phase(tracer, 'count_rows'):
+            num_test_rows = 1.0 * query_rows(
+                connection, test_relation, tracer=tracer)
+        min_support_rows = floor(num_test_rows * min_support)
+
+        # Transform ranges in on_column_ranges into bucket IDs.
+        with traced_phase(tracer, 'range_statistics'):
+            if adaptive_ranges is None:
+                range_statistics = _range_statistics(
+                    connection, test_relation, on_column_ranges,
+                    num_range_buckets, range_bucketing, catalog,
+                    catalog_relation, statistics_source, planner_relation)
             else:
-                # Turn the proxy range bucket column back into a predicate on
-                # the range-valued column.
-                predicates += test_bucket_predicates[column][row[column.name]]
-        # Some databases (e.g., PostgreSQL) cast `risk_ratio` as
-        # Decimal, so we cast to float.
-        explanations.append(
-            Explanation(tuple(predicates), float(row.risk_ratio)))
+                range_statistics = _RangeRefiner(
+                    engine, connection,
+                    ((test_relation, True), (control_relation, False)),
+                    test_relation, min_support_rows, num_test_rows,
+                    1.0 * query_rows(connection, control_relation),
+                    min_risk_ratio,
+                    strategy or default_grouping_sets_strategy(engine),
+                    range_bucketing,
+                    adaptive_ranges).refine(on_column_ranges)
+        rewritten_test_relation, test_bucket_predicates, bucket_parameters = (
+            _rewrite_query_with_ranges_as_buckets(
+                engine, test_relation, range_statistics, range_bucketing))
+        rewritten_control_relation, _, _ = (
+            _rewrite_query_with_ranges_as_buckets(
+                engine, control_relation, range_statistics, range_bucketing))
+        if materialize:
+            with traced_phase(tracer, 'materialize_buckets'):
+                rewritten_test_relation = (
+                    'SELECT * FROM ' + temporary_tables.create(
+                        rewritten_test_relation,
+                        parameters=bucket_parameters))
+                rewritten_control_relation = (
+                    'SELECT * FROM ' + temporary_tables.create(
+                        rewritten_control_relation,
+                        parameters=bucket_parameters))
+                temporary_tables.drop(test_rows_table)
+
+        # Get size of control_relation.
+        with traced_phase(tracer, 'count_rows'):
+            num_control_rows = 1.0 * query_rows(
+                connection, rewritten_control_relation, bucket_parameters,
+                tracer)
+
+        on_columns, source_columns = _on_columns(
+            on_column_values, test_bucket_predicates)
+        with traced_phase(tracer, 'explanations'):
+            explanations = _explanations(
+                engine, connection,
+                ((rewritten_test_relation, True),
+                 (rewritten_control_relation, False)),
+                on_columns, source_columns, max_order, min_support_rows,
+                num_test_rows, num_control_rows, min_risk_ratio,
+                on_column_values, test_bucket_predicates, strategy, tracer,
+                bucket_parameters)
+
+    if sample is not None:
+        estimator = _SampleEstimator(
+            fraction, num_test_rows, num_control_rows, sample.confidence)
+        explanations = [estimator.estimate(explanation)
+                        for explanation in explanations]
+    # Each order is sorted by risk ratio, but we want the combined list
+    # to be sorted as well.
+    explanations.sort(key=lambda explanation: explanation.risk_ratio,
+                      reverse=True)
+    return explanations
+
+
+def _condition_queries(
+        engine: sqlalchemy.engine.Engine,
+        labeled_relation: str,
+        on_columns: Tuple[Column, ...],
+        source_columns: Dict[Column, Column],
+        max_order: int,
+        min_support_rows: SqlNumber,
+        num_test_rows: SqlNumber,
+        num_control_rows: SqlNumber,
+        min_risk_ratio: SqlNumber,
+        strategy: GroupingSetsStrategy,
+        segment_column: Optional[Column] = None
+) -> List[Tuple[str, Dict[int, Tuple[Column, ...]]]]:
+    """
+    Like `_diff_queries`, but counts the test and control rows of
+    `labeled_relation` (see `_labeled_relation`) side by side. With a
+    `segment_column`, every grouping set also groups on it, so each
+    explanation is counted within each segment, and the segment sizes
+    of `labeled_relation` are carried through as well so that
+    `min_support_rows`, `num_test_rows`, and `num_control_rows` can
+    refer to them.
+    """
+    partition_columns: Tuple[Column, ...] = ()
+    carried_columns: Tuple[Column, ...] = LABEL_COLUMNS
+    aggregates: Tuple[Aggregate, ...] = LABEL_AGGREGATES
+    if segment_column is not None:
+        partition_columns = (segment_column, )
+        carried_columns += partition_columns + SEGMENT_SIZE_COLUMNS
+        aggregates += SEGMENT_AGGREGATES
+    frequent_queries: Dict[
+        int, Tuple[str, Dict[int, Tuple[Column, ...]]]] = {}
+    queries: List[Tuple[str, Dict[int, Tuple[Column, ...]]]] = []
+    for order in range(1, min(max_order, len(on_columns)) + 1):
+        sets, flag_columns = _order_sets(
+            on_columns, source_columns, order)
+        if not sets:
+            break
+        sets = tuple(partition_columns + grouping_set
+                     for grouping_set in sets)
+        order_relation = labeled_relation
+        if order > 1:
+            order_relation = _apriori_pruned_query(
+                engine, labeled_relation, on_columns, *frequent_queries[1],
+                carried_columns=carried_columns,
+                partition_columns=partition_columns)
+        explanations_query, flagged_set_index = _explanation_counts_query(
+            engine, order_relation, sets, min_support_rows, flag_columns,
+            aggregates=aggregates,
+            support_column=Column('test_explanation_size'),
+            strategy=strategy)
+        grouping_set_index = _unflagged_set_index(
+            flagged_set_index, on_columns)
+        if order > 2:
+            explanations_query = _apriori_subsets_query(
+                engine, explanations_query, grouping_set_index,
+                *frequent_queries[order - 1], on_columns, partition_columns)
+        frequent_queries[order] = (explanations_query, grouping_set_index)
+        queries.append((
+            _condition_diff_query(
+                engine, explanations_query, num_test_rows, num_control_rows,
+                on_columns, min_risk_ratio, partition_columns),
+            grouping_set_index))
+    return queries
+
+
+def diff_by_condition(
+        engine: sqlalchemy.engine.Engine,
+        relation: str,
+        test_condition: str,
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column],
+        min_support: float,
+        min_risk_ratio: float,
+        max_order: int,
+        materialize: bool = False,
+        sample: Optional[Sample] = None,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE,
+        adaptive_ranges: Optional[AdaptiveRanges] = None,
+        catalog: Optional[StatisticsCatalog] = None,
+        statistics_source: StatisticsSource = StatisticsSource.SCAN,
+        tracer: Optional[Tracer] = None
+) -> List[Explanation]:
+    """
+    Like `diff`, but for the common case where the test and control
+    sets are a single relation split by a condition: rows of `relation`
+    that match `test_condition` are the test set, and all other rows
+    are the control set.
+
+    Rather than grouping the test and control sets separately and
+    joining the results, test and control rows are counted side by side
+    with conditional aggregation in a single grouping sets query, so
+    `relation` is scanned once per order of explanation rather than
+    twice.
+
+    :param relation: A SQL query resulting in both test and control rows.
+    :param test_condition: A SQL boolean expression over the columns of
+                           `relation` that is true for rows whose presence
+                           you would like to explain.
+    :param statistics_source: As in `diff`, but the planner's
+                              statistics describe all of `relation`
+                              rather than just its test rows.
+
+    See `diff` for the remaining parameters.
+    """
+    if max_order < 1:
+        raise DatoolsError('max_order must be at least 1')
+    if (adaptive_ranges is not None
+            and range_bucketing == RangeBucketing.EQUI_WIDTH):
+        raise DatoolsError(
+            'Adaptive ranges are not split into buckets of equal width')
+
+    with listening(tracer, engine), engine.connect() as connection, \
+            TemporaryTables(connection) as temporary_tables:
+        with traced_phase(tracer, 'validate'):
+            on_column_names = _validate_on_columns(
+                query_columns(connection, relation),
+                on_column_values, on_column_ranges)
+        catalog_relation: Optional[str] = (
+            f'SELECT * FROM ({relation}) AS relation '
+            f'WHERE {test_condition}')
+        planner_relation = relation
+
+        if sample is not None:
+            with traced_phase(tracer, 'sample'):
+                fraction = _sample_fraction(
+                    connection, sample, (relation, ))
+            if fraction < 1:
+                relation = sampled_query(
+                    connection, relation, fraction, sample.seed)
+                catalog_relation = None
+            # A sample might differ each time it's queried, so we
+            # materialize it to ensure every query sees the same rows.
+            materialize = True
+
+        labeled_relation = _labeled_relation(
+            engine, relation, test_condition)
+        if materialize:
+            with traced_phase(tracer, 'materialize'):
+                labeled_rows_table = temporary_tables.create(
+                    labeled_relation,
+                    tuple(Column(name) for name in on_column_names)
+                    + LABEL_COLUMNS)
+            labeled_relation = f'SELECT * FROM {labeled_rows_table}'
+
+        with traced_phase(tracer, 'count_rows'):
+            num_test_rows, num_control_rows = (
+                1.0 * rows for rows in _labeled_rows(
+                    connection, labeled_relation, tracer))
+        min_support_rows = floor(num_test_rows * min_support)
+
+        # Transform ranges in on_column_ranges into bucket IDs.
+        test_rows_relation = (
+            f'SELECT * FROM ({labeled_relation}) AS labeled_relation '
+            f'WHERE test_row = 1')
+        with traced_phase(tracer, 'range_statistics'):
+            if adaptive_ranges is None:
+                range_statistics = _range_statistics(
+                    connection, test_rows_relation, on_column_ranges,
+                    num_range_buckets, range_bucketing, catalog,
+                    catalog_relation, statistics_source, planner_relation)
+            else:
+                range_statistics = _RangeRefiner(
+                    engine, connection, ((labeled_relation, None), ),
+                    test_rows_relation, min_support_rows, num_test_rows,
+                    num_control_rows, min_risk_ratio,
+                    strategy or default_grouping_sets_strategy(engine),
+                    range_bucketing, adaptive_ranges).refine(
+                        on_column_ranges)
+        rewritten_relation, bucket_predicates, bucket_parameters = (
+            _rewrite_query_with_ranges_as_buckets(
+                engine, labeled_relation, range_statistics, range_bucketing))
+        if materialize:
+            with traced_phase(tracer, 'materialize_buckets'):
+                rewritten_relation = (
+                    'SELECT * FROM ' + temporary_tables.create(
+                        rewritten_relation, parameters=bucket_parameters))
+                temporary_tables.drop(labeled_rows_table)
+
+        on_columns, source_columns = _on_columns(
+            on_column_values, bucket_predicates)
+        with traced_phase(tracer, 'explanations'):
+            explanations = _explanations(
+                engine, connection, ((rewritten_relation, None), ),
+                on_columns, source_columns, max_order, min_support_rows,
+                num_test_rows, num_control_rows, min_risk_ratio,
+                on_column_values, bucket_predicates, strategy, tracer,
+                bucket_parameters)
+
+    if sample is not None:
+        estimator = _SampleEstimator(
+            fraction, num_test_rows, num_control_rows, sample.confidence)
+        explanations = [estimator.estimate(explanation)
+                        for explanation in explanations]
+    explanations.sort(key=lambda explanation: explanation.risk_ratio,
+                      reverse=True)
+    return explanations
+
+
+def diff_by_segment(
+        engine: sqlalchemy.engine.Engine,
+        relation: str,
+        segment_column: Column,
+        test_condition: str,
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column],
+        min_support: float,
+        min_risk_ratio: float,
+        max_order: int,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE,
+        tracer: Optional[Tracer] = None
+) -> Dict[Any, List[Explanation]]:
+    """
+    Runs `diff_by_condition` separately for each value of
+    `segment_column` (e.g., for each customer or region), but counts
+    the explanations of every segment in the same grouping sets queries
+    by adding `segment_column` to each grouping set. Each segment's
+    minimum support and risk ratios are relative to the number of test
+    and control rows in that segment, and Apriori pruning happens
+    within each segment.
+
+    Returns each segment's explanations, sorted by risk ratio. Segments
+    without explanations are left out.
+
+    :param segment_column: The column of `relation` whose values
+                           split it into segments. It can not be one
+                           of the columns explanations are generated
+                           on.
+
+    See `diff_by_condition` for the remaining parameters. Range
+    buckets are computed from the test rows of all segments together.
+    Explanations of segments are counted in SQL, so
+    `GroupingSetsStrategy.IN_PROCESS` isn't supported, and databases
+    without grouping sets (e.g., SQLite) default to
+    `GroupingSetsStrategy.UNION_ALL`.
+    """
+    if max_order < 1:
+        raise DatoolsError('max_order must be at least 1')
+    if segment_column in on_column_values | on_column_ranges:
+        raise DatoolsError(
+            'segment_column can not be one of the on_columns')
+    strategy = _sql_strategy(engine, strategy)
+
+    with listening(tracer, engine), engine.connect() as connection:
+        with traced_phase(tracer, 'validate'):
+            column_names = query_columns(connection, relation)
+        if segment_column.name not in column_names:
+            raise DatoolsError('segment_column is not a column of relation')
+        _validate_on_columns(
+            column_names, on_column_values, on_column_ranges)
+
+        labeled_relation = _labeled_relation(
+            engine, relation, test_condition, segment_column)
+        with traced_phase(tracer, 'range_statistics'):
+            range_statistics = _range_statistics(
+                connection,
+                f'SELECT * FROM ({labeled_relation}) AS labeled_relation '
+                f'WHERE test_row = 1',
+                on_column_ranges, num_range_buckets, range_bucketing)
+        rewritten_relation, bucket_predicates, parameters = (
+            _rewrite_query_with_ranges_as_buckets(
+                engine, labeled_relation, range_statistics, range_bucketing))
+        parameters.update({'datools_min_support': min_support,
+                           'datools_min_risk_ratio': min_risk_ratio})
+
+        on_columns, source_columns = _on_columns(
+            on_column_values, bucket_predicates)
+        segment_test_rows, segment_control_rows = SEGMENT_SIZE_COLUMNS
+        # An explanation's support is compared to its segment's size
+        # (`_explanation_counts_query` filters on `min_support_rows`
+        # with a strict inequality, so flooring the product as `diff`
+        # does is unnecessary).
+        queries = _condition_queries(
+            engine, rewritten_relation, on_columns, source_columns,
+            max_order,
+            f'({PLAN_PARAMETERS["min_support"]} * {segment_test_rows.name})',
+            f'labeled_explanations.{segment_test_rows.name}',
+            f'labeled_explanations.{segment_control_rows.name}',
+            PLAN_PARAMETERS['min_risk_ratio'], strategy, segment_column)
+        explanations: Dict[Any, List[Explanation]] = defaultdict(list)
+        with traced_phase(tracer, 'explanations'):
+            for order, (diff_query, grouping_set_index) in enumerate(
+                    queries, 1):
+                with traced_phase(tracer, f'order_{order}'):
+                    results = execute_query(
+                        connection, diff_query, parameters)
+                    for row in counted_rows(tracer, results):
+                        explanations[row[segment_column.name]].append(
+                            _explanation_from_row(
+                                row, grouping_set_index, on_column_values,
+                                bucket_predicates))
+                    results.close()
+
+    for segment_explanations in explanations.values():
+        segment_explanations.sort(
+            key=lambda explanation: explanation.risk_ratio, reverse=True)
+    return dict(explanations)
+
+
+def _window_diff_query(
+        engine: sqlalchemy.engine.Connectable,
+        counts_query: str,
+        window_column: Column,
+        window_grouping_id: int,
+        on_columns: Tuple[Column, ...],
+        baseline_windows: int,
+        min_support: SqlNumber,
+        min_risk_ratio: SqlNumber
+) -> str:
+    """
+    Compares the explanation counts of each window in `counts_query`
+    (a grouping sets query whose every grouping set contains
+    `window_column`) with their total over the `baseline_windows`
+    windows before it. The grouping set of `window_column` alone, whose
+    ID is `window_grouping_id`, holds the size of each window.
+    """
+    window = quote(engine, window_column.name)
+    partition = ', '.join(
+        ['counts.grouping_id']
+        + [f'counts.{quote(engine, column.name)}' for column in on_columns])
+    baseline = (f'ORDER BY counts.{window} '
+                f'RANGE BETWEEN {int(baseline_windows)} PRECEDING '
+                f'AND 1 PRECEDING')
+    risk_ratio = _risk_ratio_sql(
+        'windowed.test_explanation_size',
+        'windowed.control_explanation_size',
+        'window_sizes.num_test_rows', 'window_sizes.num_control_rows')
+    return dedent(
+        f'''
+        WITH
+        counts AS (
+            {indent(counts_query, 3 * INDENT)}
+        ),
+        windowed AS (
+            SELECT
+                counts.*,
+                counts.explanation_size AS test_explanation_size,
+                SUM(counts.explanation_size) OVER (
+                    PARTITION BY {partition}
+                    {baseline}
+                ) AS control_explanation_size
+            FROM counts
+        ),
+        window_sizes AS (
+            SELECT
+                counts.{window},
+                counts.explanation_size AS num_test_rows,
+                SUM(counts.explanation_size) OVER (
+                    {baseline}
+                ) AS num_control_rows
+            FROM counts
+            WHERE counts.grouping_id = {window_grouping_id}
+        ),
+        comparison AS (
+            SELECT
+                windowed.grouping_id,
+                {', '.join(f'windowed.{quote(engine, column.name)}'
+                           for column in (window_column, ) + on_columns)},
+                windowed.test_explanation_size,
+                windowed.control_explanation_size,
+                {indent(risk_ratio, 4 * INDENT)} AS risk_ratio
+            FROM windowed
+            JOIN window_sizes
+            ON windowed.{window} = window_sizes.{window}
+            WHERE windowed.grouping_id <> {window_grouping_id}
+            AND (1.0 * windowed.test_explanation_size)
+                > ({min_support} * window_sizes.num_test_rows)
+        )
+        SELECT *
+        FROM comparison
+        WHERE risk_ratio > {min_risk_ratio}
+        ORDER BY risk_ratio DESC
+        ''')
+
+
+def _window_minimums(
+        connection: sqlalchemy.engine.Connection,
+        relation: str,
+        time_column: Column,
+        window_width: Any,
+        start: Optional[Any],
+        parameters: Dict[str, Any]
+) -> List[Any]:
+    """
+    Returns the start of each window of `window_width` that covers the
+    values of `time_column` in `relation` (binding `parameters` to
+    it), beginning at `start` (or at its smallest value).
+    """
+    results = execute_query(
+        connection,
+        f'SELECT MIN({quote(connection, time_column.name)}) AS minimum, '
+        f'MAX({quote(connection, time_column.name)}) AS maximum '
+        f'FROM ({relation}) AS window_query',
+        parameters)
+    row = results.first()
+    results.close()
+    if row.maximum is None:
+        return []
+    minimum, maximum = row.minimum, row.maximum
+    # SQLite returns timestamps as text.
+    if isinstance(maximum, str):
+        minimum = datetime.fromisoformat(minimum)
+        maximum = datetime.fromisoformat(maximum)
+    minimums = [minimum if start is None else start]
+    while minimums[-1] + window_width <= maximum:
+        minimums.append(minimums[-1] + window_width)
+    return minimums
+
+
+def diff_by_window(
+        engine: sqlalchemy.engine.Engine,
+        relation: str,
+        time_column: Column,
+        window_width: Any,
+        baseline_windows: int,
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column],
+        min_support: float,
+        min_risk_ratio: float,
+        max_order: int,
+        start: Optional[Any] = None,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE,
+        tracer: Optional[Tracer] = None
+) -> Dict[Any, List[Explanation]]:
+    """
+    Detects drift by splitting `relation` into consecutive windows of
+    `time_column` and running a `diff` of each window (the test rows)
+    against the `baseline_windows` windows before it (the control
+    rows). For example, with hourly windows and a baseline of 24
+    windows, each hour is compared to the day before it.
+
+    Windows are assigned like range buckets (see
+    `_rewrite_query_with_ranges_as_buckets`), and the window column is
+    added to every grouping set of every order so that a single
+    grouping sets query counts every explanation in every window.
+    Window functions then add up each explanation's counts over its
+    baseline windows. Because an explanation that is infrequent in one
+    window still counts toward the baseline of the windows after it,
+    higher-order explanations aren't pruned Apriori-style.
+
+    Returns each window's explanations, keyed by the start of the
+    window and sorted by risk ratio. Windows without explanations
+    (including the first one, which has no baseline) are left out.
+
+    :param time_column: The column of `relation` to split into
+                        windows, e.g., a timestamp.
+    :param window_width: The width of each window, e.g., a
+                         `datetime.timedelta` for a timestamp column.
+    :param baseline_windows: The number of windows before each window
+                             whose rows are its control rows.
+    :param start: The start of the first window. Rows before it are
+                  left out. Defaults to the smallest value of
+                  `time_column`.
+
+    See `diff` for the remaining parameters. Range buckets are computed
+    from all of `relation`. With `RangeBucketing.EQUI_WIDTH`, numeric
+    windows are assigned arithmetically, and other windows (e.g., of
+    timestamps) with a range join. Like `diff_by_segment`, explanations are
+    counted in SQL, so `GroupingSetsStrategy.IN_PROCESS` isn't
+    supported.
+    """
+    if max_order < 1:
+        raise DatoolsError('max_order must be at least 1')
+    if baseline_windows < 1:
+        raise DatoolsError('baseline_windows must be at least 1')
+    if time_column in on_column_values | on_column_ranges:
+        raise DatoolsError('time_column can not be one of the on_columns')
+    strategy = _sql_strategy(engine, strategy)
+
+    with listening(tracer, engine), engine.connect() as connection:
+        with traced_phase(tracer, 'validate'):
+            column_names = query_columns(connection, relation)
+        if time_column.name not in column_names:
+            raise DatoolsError('time_column is not a column of relation')
+        _validate_on_columns(
+            column_names, on_column_values, on_column_ranges)
+
+        # Rows before the first window would otherwise be counted in
+        # it, since its bucket has no lower bound.
+        window_parameters: Dict[str, Any] = {}
+        if start is not None:
+            relation = (
+                f'SELECT * FROM ({relation}) AS windowed_relation '
+                f'WHERE {quote(engine, time_column.name)} '
+                f'>= :datools_window_start')
+            window_parameters['datools_window_start'] = start
+        with traced_phase(tracer, 'range_statistics'):
+            window_minimums = _window_minimums(
+                connection, relation, time_column, window_width, start,
+                window_parameters)
+            range_statistics = _range_statistics(
+                connection, relation, on_column_ranges, num_range_buckets,
+                range_bucketing, parameters=window_parameters)
+        # With a single window, nothing precedes it to compare it to.
+        if len(window_minimums) < 2:
+            return {}
+        rewritten_relation, bucket_predicates, parameters = (
+            _rewrite_query_with_ranges_as_buckets(
+                engine, relation,
+                range_statistics + [
+                    (time_column, RangeValuedStatistics(
+                        window_minimums, window_width
+                        if isinstance(window_width, NUMERIC_TYPES)
+                        else None))],
+                range_bucketing))
+        parameters.update({**window_parameters,
+                           'datools_min_support': min_support,
+                           'datools_min_risk_ratio': min_risk_ratio})
+        window_column = Column(f'{time_column.name}__bucket')
+        del bucket_predicates[window_column]
+
+        on_columns, source_columns = _on_columns(
+            on_column_values, bucket_predicates)
+        sets = ((window_column, ), ) + tuple(
+            (window_column, ) + grouping_set
+            for grouping_set in _explanation_sets(
+                on_columns, source_columns, max_order))
+        counts_query, grouping_set_index = _explanation_counts_query(
+            engine, rewritten_relation, sets, strategy=strategy)
+        window_grouping_id = next(
+            grouping_id
+            for grouping_id, grouping_set in grouping_set_index.items()
+            if grouping_set == (window_column, ))
+        diff_query = _window_diff_query(
+            engine, counts_query, window_column, window_grouping_id,
+            on_columns, baseline_windows, PLAN_PARAMETERS['min_support'],
+            PLAN_PARAMETERS['min_risk_ratio'])
+        grouping_set_index = _unflagged_set_index(
+            grouping_set_index, on_columns)
+        explanations: Dict[Any, List[Explanation]] = defaultdict(list)
+        with traced_phase(tracer, 'explanations'):
+            results = execute_query(connection, diff_query, parameters)
+            for row in counted_rows(tracer, results):
+                window_start = window_minimums[row[window_column.name]]
+                explanations[window_start].append(
+                    _explanation_from_row(
+                        row, grouping_set_index, on_column_values,
+                        bucket_predicates))
+            results.close()
+    return dict(explanations)
+
+
+def _risk_ratio(
+        test_size: float,
+        control_size: float,
+        num_test_rows: float,
+        num_control_rows: float
+) -> float:
+    """The risk ratio that `_risk_ratio_sql` computes, in Python."""
+    adjusted_test_rows = num_test_rows + 1
+    adjusted_control_rows = num_control_rows + 1
+    return ((1.0 * test_size / (test_size + control_size))
+            / (1.0 * (adjusted_test_rows - test_size)
+               / ((adjusted_test_rows - test_size)
+                  + (adjusted_control_rows - control_size))))
+
+
+@dataclass
+class IncrementalDiff:
+    """
+    The state of a `diff_by_condition` over an append-only relation,
+    which `refresh` keeps up to date by only counting the rows
+    appended since it last ran. Rows are appended in order of
+    `watermark_column` (e.g., an auto-incrementing ID or an insertion
+    timestamp), and `watermark` is the largest value counted so far.
+
+    The test and control counts of every explanation up to `max_order`
+    are kept in `counts`, keyed by grouping set ID (see
+    `grouping_set_index`) and the explanation's values, so
+    `explanations` can recompute risk ratios for any thresholds
+    without querying the relation. An explanation that is infrequent
+    today might be frequent after the next refresh, so explanations
+    aren't pruned Apriori-style, and `counts` holds every combination
+    of values that has appeared.
+
+    The range buckets of `on_column_ranges` are computed from the test
+    rows of the first refresh and reused afterward. The state can be
+    pickled to persist it between processes.
+
+    Rows that are committed with a `watermark_column` smaller than one
+    that has already been counted (e.g., by concurrent transactions
+    that commit out of order) are never counted.
+    """
+    relation: str
+    test_condition: str
+    watermark_column: Column
+    on_column_values: Set[Column]
+    on_column_ranges: Set[Column]
+    max_order: int
+    strategy: Optional[GroupingSetsStrategy] = None
+    num_range_buckets: int = NUM_RANGE_BUCKETS
+    range_bucketing: RangeBucketing = RangeBucketing.CASE
+    watermark: Optional[Any] = None
+    num_test_rows: int = 0
+    num_control_rows: int = 0
+    counts: Dict[Tuple[int, Tuple[Any, ...]], List[int]] = field(
+        default_factory=dict)
+    range_statistics: Optional[
+        List[Tuple[Column, RangeValuedStatistics]]] = None
+    grouping_set_index: Dict[int, Tuple[Column, ...]] = field(
+        default_factory=dict)
+    bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]] = field(
+        default_factory=dict)
+
+    def refresh(
+            self,
+            engine: sqlalchemy.engine.Engine,
+            tracer: Optional[Tracer] = None
+    ) -> int:
+        """
+        Counts the rows of `relation` appended since the last refresh
+        in a single grouping sets query, adds their counts to `counts`,
+        and returns the number of rows counted.
+        """
+        if self.max_order < 1:
+            raise DatoolsError('max_order must be at least 1')
+        strategy = _sql_strategy(engine, self.strategy)
+        watermark = quote(engine, self.watermark_column.name)
+        new_rows = f'SELECT * FROM ({self.relation}) AS appended_rows'
+        parameters: Dict[str, Any] = {}
+        if self.watermark is not None:
+            new_rows += f' WHERE {watermark} > :datools_watermark'
+            parameters['datools_watermark'] = self.watermark
+
+        with listening(tracer, engine), engine.connect() as connection, \
+                TemporaryTables(connection) as temporary_tables:
+            # Rows appended while we count are left for the next
+            # refresh.
+            with traced_phase(tracer, 'watermark'):
+                results = execute_query(
+                    connection,
+                    f'SELECT MAX({watermark}) AS watermark '
+                    f'FROM ({new_rows}) AS new_rows', parameters)
+                new_watermark = results.first().watermark
+                results.close()
+            if new_watermark is None:
+                return 0
+            new_rows = (
+                f'SELECT * FROM ({new_rows}) AS new_rows '
+                f'WHERE {watermark} <= :datools_new_watermark')
+            parameters['datools_new_watermark'] = new_watermark
+            labeled_relation = _labeled_relation(
+                engine, new_rows, self.test_condition)
+
+            if self.range_statistics is None:
+                with traced_phase(tracer, 'validate'):
+                    _validate_on_columns(
+                        query_columns(connection, self.relation),
+                        self.on_column_values, self.on_column_ranges)
+                with traced_phase(tracer, 'range_statistics'):
+                    # The statistics are computed without parameters, so
+                    # the new test rows are copied out first.
+                    test_rows_table = temporary_tables.create(
+                        f'SELECT * FROM ({labeled_relation}) '
+                        f'AS labeled_relation WHERE test_row = 1',
+                        parameters=parameters)
+                    self.range_statistics = _range_statistics(
+                        connection, f'SELECT * FROM {test_rows_table}',
+                        self.on_column_ranges, self.num_range_buckets,
+                        self.range_bucketing)
+            rewritten_relation, self.bucket_predicates, bucket_parameters = (
+                _rewrite_query_with_ranges_as_buckets(
+                    engine, labeled_relation, self.range_statistics,
+                    self.range_bucketing))
+            parameters.update(bucket_parameters)
+            on_columns, source_columns = _on_columns(
+                self.on_column_values, self.bucket_predicates)
+            sets = _explanation_sets(
+                on_columns, source_columns, self.max_order)
+            counts_query, self.grouping_set_index = (
+                _explanation_counts_query(
+                    engine, rewritten_relation, sets,
+                    aggregates=LABEL_AGGREGATES, strategy=strategy))
+
+            # Every row is in exactly one group of each grouping set,
+            # so the first grouping set's counts add up to the number
+            # of new rows.
+            first_grouping_id = min(self.grouping_set_index)
+            num_rows = 0
+            with traced_phase(tracer, 'count'):
+                results = execute_query(connection, counts_query, parameters)
+                for row in counted_rows(tracer, results):
+                    grouping_set = self.grouping_set_index[row.grouping_id]
+                    test_size = row.test_explanation_size or 0
+                    control_size = row.control_explanation_size or 0
+                    key = (row.grouping_id,
+                           tuple(row[column.name]
+                                 for column in grouping_set))
+                    sizes = self.counts.setdefault(key, [0, 0])
+                    sizes[0] += test_size
+                    sizes[1] += control_size
+                    if row.grouping_id == first_grouping_id:
+                        self.num_test_rows += test_size
+                        self.num_control_rows += control_size
+                        num_rows += test_size + control_size
+                results.close()
+        self.watermark = new_watermark
+        return num_rows
+
+    def explanations(
+            self,
+            min_support: float,
+            min_risk_ratio: float
+    ) -> List[Explanation]:
+        """
+        Returns the explanations of every row counted so far, as
+        `diff_by_condition` would with these thresholds.
+        """
+        min_support_rows = floor(self.num_test_rows * min_support)
+        explanations = []
+        for (grouping_id, values), (test_size, control_size) in (
+                self.counts.items()):
+            if test_size <= min_support_rows:
+                continue
+            risk_ratio = _risk_ratio(
+                test_size, control_size, self.num_test_rows,
+                self.num_control_rows)
+            if risk_ratio <= min_risk_ratio:
+                continue
+            explanations.append(Explanation(
+                _explanation_predicates(
+                    self.grouping_set_index[grouping_id], values,
+                    self.on_column_values, self.bucket_predicates),
+                risk_ratio, test_support=test_size,
+                control_support=control_size))
+        explanations.sort(key=lambda explanation: explanation.risk_ratio,
+                          reverse=True)
+        return explanations
+
+
+COUNT_CUBE_TABLE = 'datools_count_cube'
+
+
+@dataclass
+class CountCube:
+    """
+    A table (named `table_name`) of precomputed explanation counts,
+    built by `build_count_cube`, that answers diffs in a single
+    aggregation over the table rather than by scanning the relation it
+    was built from. It holds the number of rows for each value (or
+    range bucket) of each grouping set of `on_columns`, and for each
+    combination of values of `dimensions` alongside it.
+
+    `grouping_set_index` maps each grouping set ID in the table to its
+    columns (without `dimensions`), and `bucket_predicates` turns range
+    buckets back into predicates. The cube can be pickled to use it in
+    another process.
+    """
+    table_name: str
+    dimensions: Tuple[Column, ...]
+    on_columns: Tuple[Column, ...]
+    on_column_values: Set[Column]
+    grouping_set_index: Dict[int, Tuple[Column, ...]]
+    bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]]
+
+    def diff(
+            self,
+            engine: sqlalchemy.engine.Connectable,
+            test_condition: str,
+            min_support: float,
+            min_risk_ratio: float,
+            max_order: Optional[int] = None,
+            tracer: Optional[Tracer] = None
+    ) -> List[Explanation]:
+        """
+        Returns the explanations `diff_by_condition` would for the
+        cube's relation split by `test_condition`, which can only refer
+        to the cube's `dimensions`.
+
+        :param max_order: The largest explanations to consider, up to
+                          the `max_order` the cube was built with
+                          (the default).
+
+        See `diff` for the remaining parameters.
+        """
+        grouping_ids = [
+            grouping_id
+            for grouping_id, grouping_set in self.grouping_set_index.items()
+            if max_order is None or len(grouping_set) <= max_order]
+        if not grouping_ids:
+            raise DatoolsError('max_order must be at least 1')
+        columns = ', '.join(
+            quote(engine, column.name) for column in self.on_columns)
+        # Every row is in exactly one group of each grouping set, so
+        # the first grouping set's counts add up to the relation's
+        # size.
+        explanations_query = dedent(
+            f'''
+            WITH labeled_cube AS (
+                SELECT
+                    grouping_id,
+                    {columns},
+                    CASE WHEN ({test_condition})
+                        THEN explanation_size ELSE 0 END AS test_rows,
+                    CASE WHEN ({test_condition})
+                        THEN 0 ELSE explanation_size END AS control_rows
+                FROM {quote(engine, self.table_name)}
+            ),
+            sizes AS (
+                SELECT
+                    SUM(test_rows) AS num_test_rows,
+                    SUM(control_rows) AS num_control_rows
+                FROM labeled_cube
+                WHERE grouping_id = {min(self.grouping_set_index)}
+            ),
+            counts AS (
+                SELECT
+                    grouping_id,
+                    {columns},
+                    SUM(test_rows) AS test_explanation_size,
+                    SUM(control_rows) AS control_explanation_size
+                FROM labeled_cube
+                WHERE grouping_id IN ({', '.join(map(str, grouping_ids))})
+                GROUP BY grouping_id, {columns}
+            )
+            SELECT counts.*, sizes.num_test_rows, sizes.num_control_rows
+            FROM counts
+            CROSS JOIN sizes
+            WHERE (1.0 * counts.test_explanation_size)
+                > ({PLAN_PARAMETERS['min_support']} * sizes.num_test_rows)
+            ''')
+        diff_query = _condition_diff_query(
+            engine, explanations_query, 'labeled_explanations.num_test_rows',
+            'labeled_explanations.num_control_rows', self.on_columns,
+            PLAN_PARAMETERS['min_risk_ratio'])
+        with listening(tracer, engine), \
+                pinned_connection(engine) as connection:
+            with traced_phase(tracer, 'explanations'):
+                explanations = _explanations_from_query(
+                    connection, bound_text(diff_query),
+                    self.grouping_set_index,
+                    self.on_column_values, self.bucket_predicates,
+                    {'datools_min_support': min_support,
+                     'datools_min_risk_ratio': min_risk_ratio},
+                    tracer)
+        return explanations
+
+    def drop(self, engine: sqlalchemy.engine.Connectable):
+        """Drops the cube's table."""
+        engine.execute(
+            f'DROP TABLE IF EXISTS {quote(engine, self.table_name)}')
+
+
+def build_count_cube(
+        engine: sqlalchemy.engine.Engine,
+        relation: str,
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column],
+        max_order: int,
+        dimensions: Set[Column] = set(),
+        table_name: str = COUNT_CUBE_TABLE,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE,
+        tracer: Optional[Tracer] = None
+) -> CountCube:
+    """
+    Scans `relation` once to build a `CountCube` in a table named
+    `table_name` (replacing any table of that name), for analysts who
+    repeatedly diff the same relation and columns with different
+    thresholds and different splits into test and control rows.
+    Splits can be on any of `dimensions`: e.g., with a `hot` column
+    that is 1 for anomalous rows as a dimension, `cube.diff(engine,
+    'hot = 1', ...)` is equivalent to `diff_by_condition(engine,
+    relation, 'hot = 1', ...)`.
+
+    Since thresholds aren't known when the cube is built, it contains
+    every combination of values up to `max_order`, without Apriori
+    pruning, and for every combination of values of `dimensions`, so
+    its size grows quickly with both. The range buckets of
+    `on_column_ranges` are computed from all of `relation`.
+
+    See `diff` for the remaining parameters. Cubes are counted in SQL,
+    so `GroupingSetsStrategy.IN_PROCESS` isn't supported.
+    """
+    if max_order < 1:
+        raise DatoolsError('max_order must be at least 1')
+    if dimensions & (on_column_values | on_column_ranges):
+        raise DatoolsError('dimensions can not be on_columns')
+    strategy = _sql_strategy(engine, strategy)
+    dimension_columns = tuple(
+        sorted(dimensions, key=lambda column: column.name))
+
+    with listening(tracer, engine), engine.connect() as connection:
+        with traced_phase(tracer, 'validate'):
+            column_names = query_columns(connection, relation)
+        if {column.name for column in dimensions} - set(column_names):
+            raise DatoolsError('dimensions are not a subset of relation')
+        _validate_on_columns(
+            column_names, on_column_values, on_column_ranges)
+        with traced_phase(tracer, 'range_statistics'):
+            range_statistics = _range_statistics(
+                connection, relation, on_column_ranges, num_range_buckets,
+                range_bucketing)
+        rewritten_relation, bucket_predicates, parameters = (
+            _rewrite_query_with_ranges_as_buckets(
+                engine, relation, range_statistics, range_bucketing))
+        on_columns, source_columns = _on_columns(
+            on_column_values, bucket_predicates)
+        sets = tuple(
+            dimension_columns + grouping_set
+            for grouping_set in _explanation_sets(
+                on_columns, source_columns, max_order))
+        counts_query, grouping_set_index = _explanation_counts_query(
+            engine, rewritten_relation, sets, strategy=strategy)
+        with traced_phase(tracer, 'build'), connection.begin():
+            connection.execute(
+                f'DROP TABLE IF EXISTS {quote(engine, table_name)}')
+            execute_query(
+                connection,
+                f'CREATE TABLE {quote(engine, table_name)} AS '
+                f'SELECT * FROM ({counts_query}) AS cube_query',
+                parameters)
+    return CountCube(
+        table_name, dimension_columns, on_columns, on_column_values,
+        _unflagged_set_index(grouping_set_index, on_columns),
+        bucket_predicates)
+
+
+@dataclass
+class ExplanationFrame:
+    """
+    Explanations stored column by column in numpy arrays rather than as
+    `Explanation` objects, for post-processing many explanations (see
+    `DiffPlan.frame`). Row `i` is an explanation on the columns
+    `grouping_sets[grouping_set[i]]`, whose values are in `values` (a
+    range-valued column's value is its bucket's index into
+    `bucket_predicates`), and whose other columns' values are None.
+    Explanations are sorted by decreasing risk ratio.
+
+    Indexing or iterating over a frame creates `Explanation` objects
+    one at a time. `to_arrow` and `to_pandas` export the frame's
+    arrays, which requires the optional `pyarrow` or `pandas`
+    dependencies.
+    """
+    grouping_sets: List[Tuple[Column, ...]]
+    grouping_set: np.ndarray
+    risk_ratio: np.ndarray
+    test_support: np.ndarray
+    control_support: np.ndarray
+    values: Dict[Column, np.ndarray]
+    on_column_values: Set[Column]
+    bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]]
+
+    def __len__(self) -> int:
+        return len(self.risk_ratio)
+
+    def __getitem__(self, index: int) -> Explanation:
+        grouping_set = self.grouping_sets[self.grouping_set[index]]
+        predicates = _explanation_predicates(
+            grouping_set,
+            tuple(self.values[column][index] for column in grouping_set),
+            self.on_column_values, self.bucket_predicates)
+        return Explanation(
+            predicates, float(self.risk_ratio[index]),
+            test_support=int(self.test_support[index]),
+            control_support=int(self.control_support[index]))
+
+    def __iter__(self) -> Iterator[Explanation]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """
+        The frame's arrays by name, with a column for each value column
+        or range bucket explanations are on.
+        """
+        return {
+            'grouping_set': self.grouping_set,
+            'risk_ratio': self.risk_ratio,
+            'test_support': self.test_support,
+            'control_support': self.control_support,
+            **{column.name: values for column, values in self.values.items()},
+        }
+
+    def to_arrow(self) -> Any:
+        """
+        Returns the frame as a `pyarrow.Table`. Numeric columns are
+        converted without copying.
+        """
+        try:
+            import pyarrow
+        except ImportError:
+            raise DatoolsError('to_arrow requires pyarrow')
+        return pyarrow.table(self.columns())
+
+    def to_pandas(self) -> Any:
+        """
+        Returns the frame as a `pandas.DataFrame`, without copying its
+        arrays where pandas allows.
+        """
+        try:
+            import pandas
+        except ImportError:
+            raise DatoolsError('to_pandas requires pandas')
+        return pandas.DataFrame(self.columns(), copy=False)
+
+
+def _grouping_set_key(order: Any, grouping_id: Any) -> Any:
+    """
+    Combines an explanation's order and grouping ID into a single
+    integer (or array of them) for looking up its grouping set.
+    """
+    return (order << 32) | grouping_id
+
+
+def _explanation_frame(
+        batches: Iterator[List[Any]],
+        order_indices: List[Dict[int, Tuple[Column, ...]]],
+        on_column_values: Set[Column],
+        bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]]
+) -> ExplanationFrame:
+    """
+    Builds an `ExplanationFrame` from `batches` of rows of
+    `DiffPlan._ranked_batches`. `order_indices` holds the grouping set
+    index of each order of explanation.
+    """
+    grouping_sets: List[Tuple[Column, ...]] = []
+    set_keys: List[int] = []
+    for order, grouping_set_index in enumerate(order_indices, 1):
+        for grouping_id, grouping_set in grouping_set_index.items():
+            set_keys.append(_grouping_set_key(order, grouping_id))
+            grouping_sets.append(grouping_set)
+    # Rows' grouping sets are looked up by binary search over their
+    # sorted keys, so that whole batches are numbered at once.
+    key_order = np.argsort(np.array(set_keys, dtype=np.int64))
+    sorted_keys = np.array(set_keys, dtype=np.int64)[key_order]
+    on_columns = tuple(sorted(
+        {column for grouping_set in grouping_sets for column in grouping_set},
+        key=lambda column: column.name))
+
+    arrays: Dict[str, List[np.ndarray]] = defaultdict(list)
+    for rows in batches:
+        if not rows:
+            continue
+        # Transposing a batch gives each column's values as a tuple,
+        # which numpy converts in a single call.
+        batch = dict(zip(rows[0]._fields, zip(*rows)))
+        keys = _grouping_set_key(
+            np.array(batch['explanation_order'], dtype=np.int64),
+            np.array(batch['grouping_id'], dtype=np.int64))
+        arrays['grouping_set'].append(
+            key_order[np.searchsorted(sorted_keys, keys)])
+        arrays['risk_ratio'].append(
+            np.array(batch['risk_ratio'], dtype=np.float64))
+        arrays['test_support'].append(
+            np.array(batch['test_explanation_size'], dtype=np.int64))
+        # Explanations that never occur in the control rows have a NULL
+        # control size, which converts to NaN.
+        arrays['control_support'].append(np.nan_to_num(np.array(
+            batch['control_explanation_size'], dtype=np.float64)
+        ).astype(np.int64))
+        for column in on_columns:
+            # Assigning a list to an empty object array keeps values
+            # like tuples from being unpacked into extra dimensions.
+            values = np.empty(len(rows), dtype=object)
+            values[:] = list(batch[column.name])
+            arrays[column.name].append(values)
+
+    def concatenated(name: str, dtype: Any) -> np.ndarray:
+        if not arrays[name]:
+            return np.empty(0, dtype=dtype)
+        return np.concatenate(arrays[name])
+    return ExplanationFrame(
+        grouping_sets,
+        concatenated('grouping_set', np.int64),
+        concatenated('risk_ratio', np.float64),
+        concatenated('test_support', np.int64),
+        concatenated('control_support', np.int64),
+        {column: concatenated(column.name, object) for column in on_columns},
+        on_column_values, bucket_predicates)
+
+
+# How many explanations `DiffPlan.iterate` fetches at a time.
+STREAM_BATCH_SIZE = 1000
+# The bind parameters of explanation queries (see `_explanations` and
+# `DiffPlan`), which are prefixed so they don't collide with the
+# parameters of a plan's relations.
+PLAN_PARAMETERS = {
+    name: f'CAST(:datools_{name} AS DOUBLE PRECISION)'
+    for name in ('min_support', 'min_support_rows', 'num_test_rows',
+                 'num_control_rows', 'min_risk_ratio')}
+
+
+@dataclass
+class DiffPlan:
+    """
+    The queries of a diff (see `compile_diff` and
+    `compile_diff_by_condition`), generated once and executed as many
+    times as you like. The minimum support and risk ratio, the row
+    counts they depend on, and any `:name` parameters of the relations
+    (e.g., the bounds of a time window) are bind parameters, so the
+    queries' text never changes and both SQLAlchemy and the database
+    can cache how they compile and plan them.
+
+    `count_statement` counts the test and control rows, and
+    `order_statements` holds the query for each order of explanation
+    along with its grouping set index. The range bucket minimums the
+    queries are bound to are in `bucket_parameters`.
+    """
+    count_statement: sqlalchemy.sql.expression.TextClause
+    order_statements: List[Tuple[
+        sqlalchemy.sql.expression.TextClause,
+        Dict[int, Tuple[Column, ...]]]]
+    on_column_values: Set[Column]
+    bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]]
+    bucket_parameters: Dict[str, Any] = field(default_factory=dict)
+
+    def execute(
+            self,
+            engine: sqlalchemy.engine.Connectable,
+            min_support: float,
+            min_risk_ratio: float,
+            parameters: Optional[Dict[str, Any]] = None,
+            tracer: Optional[Tracer] = None
+    ) -> List[Explanation]:
+        """
+        Returns the same explanations as `diff` would for the plan's
+        relations with `parameters` bound to them.
+
+        :param min_support: As in `diff`.
+        :param min_risk_ratio: As in `diff`.
+        :param parameters: Values for the `:name` parameters of the
+                           plan's relations.
+        :param tracer: As in `diff`.
+        """
+        with listening(tracer, engine), \
+                pinned_connection(engine) as connection:
+            parameters = self._bound_parameters(
+                connection, min_support, min_risk_ratio, parameters,
+                tracer)
+            explanations: List[Explanation] = []
+            with traced_phase(tracer, 'explanations'):
+                for order, (statement, grouping_set_index) in enumerate(
+                        self.order_statements, 1):
+                    with traced_phase(tracer, f'order_{order}'):
+                        explanations += _explanations_from_query(
+                            connection, statement, grouping_set_index,
+                            self.on_column_values, self.bucket_predicates,
+                            parameters, tracer)
+        explanations.sort(key=lambda explanation: explanation.risk_ratio,
+                          reverse=True)
+        return explanations
+
+    def iterate(
+            self,
+            engine: sqlalchemy.engine.Connectable,
+            min_support: float,
+            min_risk_ratio: float,
+            parameters: Optional[Dict[str, Any]] = None,
+            top_k: Optional[int] = None,
+            batch_size: int = STREAM_BATCH_SIZE,
+            tracer: Optional[Tracer] = None
+    ) -> Iterator[Explanation]:
+        """
+        Like `execute`, but yields explanations in order of decreasing
+        risk ratio as they are fetched, `batch_size` rows at a time,
+        rather than returning them all at once. Every order of
+        explanation is ranked by a single query whose results are
+        streamed from a server-side cursor where the database supports
+        them (e.g., PostgreSQL), so only a batch of explanations is held
+        in memory at a time. A connection is held until the iterator is
+        exhausted or closed.
+
+        :param top_k: If provided, only the `top_k` explanations with
+                      the highest risk ratios are ranked and yielded.
+
+        See `execute` for the remaining parameters.
+        """
+        for rows in self._ranked_batches(
+                engine, min_support, min_risk_ratio, parameters, top_k,
+                batch_size, tracer):
+            for row in rows:
+                yield _explanation_from_row(
+                    row,
+                    self.order_statements[row.explanation_order - 1][1],
+                    self.on_column_values, self.bucket_predicates)
+
+    def frame(
+            self,
+            engine: sqlalchemy.engine.Connectable,
+            min_support: float,
+            min_risk_ratio: float,
+            parameters: Optional[Dict[str, Any]] = None,
+            top_k: Optional[int] = None,
+            batch_size: int = STREAM_BATCH_SIZE,
+            tracer: Optional[Tracer] = None
+    ) -> ExplanationFrame:
+        """
+        Like `iterate`, but collects the explanations into an
+        `ExplanationFrame` as they are fetched, without creating an
+        `Explanation` for each.
+        """
+        return _explanation_frame(
+            self._ranked_batches(
+                engine, min_support, min_risk_ratio, parameters, top_k,
+                batch_size, tracer),
+            [grouping_set_index
+             for _, grouping_set_index in self.order_statements],
+            self.on_column_values, self.bucket_predicates)
+
+    def _ranked_batches(
+            self,
+            engine: sqlalchemy.engine.Connectable,
+            min_support: float,
+            min_risk_ratio: float,
+            parameters: Optional[Dict[str, Any]],
+            top_k: Optional[int],
+            batch_size: int,
+            tracer: Optional[Tracer]
+    ) -> Iterator[List[Any]]:
+        """
+        Yields batches of the explanation rows of every order, ranked
+        by risk ratio, with an `explanation_order` column for finding
+        each row's grouping set index.
+        """
+        with listening(tracer, engine), \
+                pinned_connection(engine) as connection:
+            parameters = self._bound_parameters(
+                connection, min_support, min_risk_ratio, parameters,
+                tracer)
+            order_queries = '\nUNION ALL\n'.join(
+                f'SELECT {order} AS explanation_order, order_{order}.*\n'
+                f'FROM (\n{indent(statement.text, INDENT)}\n) '
+                f'AS order_{order}'
+                for order, (statement, _) in enumerate(
+                    self.order_statements, 1))
+            if top_k is not None:
+                parameters['datools_top_k'] = int(top_k)
+            statement = bound_text(
+                f'SELECT *\nFROM (\n{indent(order_queries, INDENT)}\n) '
+                f'AS explanations\nORDER BY risk_ratio DESC'
+                + ('' if top_k is None else '\nLIMIT :datools_top_k'),
+                parameters)
+            with traced_phase(tracer, 'explanations'):
+                results = connection.execution_options(
+                    stream_results=True).execute(statement, parameters)
+            try:
+                for rows in results.partitions(batch_size):
+                    count_fetched(tracer, len(rows))
+                    yield rows
+            finally:
+                results.close()
+
+    def _bound_parameters(
+            self,
+            connection: sqlalchemy.engine.Connection,
+            min_support: float,
+            min_risk_ratio: float,
+            parameters: Optional[Dict[str, Any]],
+            tracer: Optional[Tracer]
+    ) -> Dict[str, Any]:
+        """
+        Counts the test and control rows, and returns `parameters` along
+        with the parameters of the plan's queries.
+        """
+        bound_parameters = {**self.bucket_parameters, **(parameters or {})}
+        with traced_phase(tracer, 'count_rows'):
+            results = connection.execute(
+                self.count_statement, bound_parameters)
+            row = results.first()
+            results.close()
+            count_fetched(tracer, 1)
+        num_test_rows = 1.0 * (row.num_test_rows or 0)
+        num_control_rows = 1.0 * (row.num_control_rows or 0)
+        bound_parameters.update({
+            'datools_min_support_rows': floor(num_test_rows * min_support),
+            'datools_num_test_rows': num_test_rows,
+            'datools_num_control_rows': num_control_rows,
+            'datools_min_risk_ratio': min_risk_ratio})
+        return bound_parameters
+
+
+def _sql_strategy(
+        engine: sqlalchemy.engine.Engine,
+        strategy: Optional[GroupingSetsStrategy]
+) -> GroupingSetsStrategy:
+    """
+    Resolves `strategy` for explanations that have to be counted in
+    SQL (see `DiffPlan` and `diff_by_segment`).
+    """
+    if strategy is None:
+        strategy = default_grouping_sets_strategy(engine)
+        if strategy == GroupingSetsStrategy.IN_PROCESS:
+            return GroupingSetsStrategy.UNION_ALL
+    if strategy == GroupingSetsStrategy.IN_PROCESS:
+        raise DatoolsError(
+            'Plans and segments can not count explanations in process')
+    return strategy
+
+
+def _compile_plan(
+        engine: sqlalchemy.engine.Engine,
+        relations: Tuple[Tuple[str, Optional[bool]], ...],
+        count_query: str,
+        range_statistics: List[Tuple[Column, RangeValuedStatistics]],
+        on_column_values: Set[Column],
+        max_order: int,
+        range_bucketing: RangeBucketing,
+        strategy: GroupingSetsStrategy,
+        parameters: Optional[Dict[str, Any]]
+) -> DiffPlan:
+    rewritten_relations = []
+    for relation, is_test in relations:
+        rewritten_relation, bucket_predicates, bucket_parameters = (
+            _rewrite_query_with_ranges_as_buckets(
+                engine, relation, range_statistics, range_bucketing))
+        rewritten_relations.append((rewritten_relation, is_test))
+    on_columns, source_columns = _on_columns(
+        on_column_values, bucket_predicates)
+    queries = _explanation_queries(
+        engine, tuple(rewritten_relations), on_columns, source_columns,
+        max_order, PLAN_PARAMETERS['min_support_rows'],
+        PLAN_PARAMETERS['num_test_rows'], PLAN_PARAMETERS['num_control_rows'],
+        PLAN_PARAMETERS['min_risk_ratio'], strategy)
+    return DiffPlan(
+        bound_text(count_query, parameters or {}),
+        [(bound_text(query, parameters or {}), grouping_set_index)
+         for query, grouping_set_index in queries],
+        on_column_values, bucket_predicates, bucket_parameters)
+
+
+def compile_diff(
+        engine: sqlalchemy.engine.Engine,
+        test_relation: str,
+        control_relation: str,
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column],
+        max_order: int,
+        parameters: Optional[Dict[str, Any]] = None,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE
+) -> DiffPlan:
+    """
+    Generates the queries of `diff` once, so that they can be executed
+    repeatedly with `DiffPlan.execute` (e.g., by a dashboard that
+    refreshes a diff every minute). `test_relation` and
+    `control_relation` can contain `:name` parameters whose values are
+    provided on each execution. Only the names in `parameters` are
+    bound, so other colons in the relations are left as they are.
+
+    The range buckets of `on_column_ranges` are computed once, from
+    `test_relation` with `parameters` bound to it, and are part of the
+    plan. Compile a new plan when the distribution of a range-valued
+    column drifts enough to warrant new buckets.
+
+    See `diff` for the remaining parameters. Plans count explanations
+    in their queries, so `GroupingSetsStrategy.IN_PROCESS` isn't
+    supported, and databases without grouping sets (e.g., SQLite)
+    default to `GroupingSetsStrategy.UNION_ALL`.
+    """
+    if max_order < 1:
+        raise DatoolsError('max_order must be at least 1')
+    strategy = _sql_strategy(engine, strategy)
+    with engine.connect() as connection, \
+            TemporaryTables(connection) as temporary_tables:
+        test_column_names = query_columns(
+            connection, test_relation, parameters)
+        control_column_names = query_columns(
+            connection, control_relation, parameters)
+        if test_column_names != control_column_names:
+            raise DatoolsError(
+                'test_relation and control_relation have different schemas')
+        _validate_on_columns(
+            test_column_names, on_column_values, on_column_ranges)
+        statistics_relation = test_relation
+        if parameters is not None and on_column_ranges:
+            statistics_table = temporary_tables.create(
+                test_relation, parameters=parameters)
+            statistics_relation = f'SELECT * FROM {statistics_table}'
+        range_statistics = _range_statistics(
+            connection, statistics_relation, on_column_ranges,
+            num_range_buckets, range_bucketing)
+    count_query = dedent(
+        f'''
+        SELECT
+            (SELECT COUNT(*) FROM ({test_relation}) AS test_query)
+                AS num_test_rows,
+            (SELECT COUNT(*) FROM ({control_relation}) AS control_query)
+                AS num_control_rows
+        ''')
+    return _compile_plan(
+        engine, ((test_relation, True), (control_relation, False)),
+        count_query, range_statistics, on_column_values, max_order,
+        range_bucketing, strategy, parameters)
+
+
+def compile_diff_by_condition(
+        engine: sqlalchemy.engine.Engine,
+        relation: str,
+        test_condition: str,
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column],
+        max_order: int,
+        parameters: Optional[Dict[str, Any]] = None,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE
+) -> DiffPlan:
+    """
+    Like `compile_diff`, but generates the queries of
+    `diff_by_condition`. Both `relation` and `test_condition` can
+    contain `:name` parameters.
+    """
+    if max_order < 1:
+        raise DatoolsError('max_order must be at least 1')
+    strategy = _sql_strategy(engine, strategy)
+    labeled_relation = _labeled_relation(engine, relation, test_condition)
+    test_rows_relation = (
+        f'SELECT * FROM ({labeled_relation}) AS labeled_relation '
+        f'WHERE test_row = 1')
+    with engine.connect() as connection, \
+            TemporaryTables(connection) as temporary_tables:
+        _validate_on_columns(
+            query_columns(connection, relation, parameters),
+            on_column_values, on_column_ranges)
+        statistics_relation = test_rows_relation
+        if parameters is not None and on_column_ranges:
+            statistics_table = temporary_tables.create(
+                test_rows_relation, parameters=parameters)
+            statistics_relation = f'SELECT * FROM {statistics_table}'
+        range_statistics = _range_statistics(
+            connection, statistics_relation, on_column_ranges,
+            num_range_buckets, range_bucketing)
+    count_query = (
+        f'WITH query AS ({labeled_relation}) '
+        f'SELECT SUM(test_row) AS num_test_rows, '
+        f'SUM(control_row) AS num_control_rows FROM query')
+    return _compile_plan(
+        engine, ((labeled_relation, None), ), count_query,
+        range_statistics, on_column_values, max_order, range_bucketing,
+        strategy, parameters)
+
+
+def iter_diff(
+        engine: sqlalchemy.engine.Engine,
+        test_relation: str,
+        control_relation: str,
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column],
+        min_support: float,
+        min_risk_ratio: float,
+        max_order: int,
+        top_k: Optional[int] = None,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE,
+        batch_size: int = STREAM_BATCH_SIZE,
+        tracer: Optional[Tracer] = None
+) -> Iterator[Explanation]:
+    """
+    Yields the explanations of `diff` in order of decreasing risk
+    ratio, for diffs with too many explanations to hold in memory at
+    once (e.g., with a low `min_risk_ratio` on columns with many
+    distinct values). See `DiffPlan.iterate`.
+
+    :param top_k: If provided, only the `top_k` explanations with the
+                  highest risk ratios are yielded, which the database
+                  ranks with `ORDER BY ... LIMIT`.
+    :param batch_size: How many explanations to fetch at a time.
+
+    See `diff` for the remaining parameters. Explanations are counted
+    in SQL, so `GroupingSetsStrategy.IN_PROCESS` isn't supported, and
+    databases without grouping sets (e.g., SQLite) default to
+    `GroupingSetsStrategy.UNION_ALL`.
+    """
+    plan = compile_diff(
+        engine, test_relation, control_relation, on_column_values,
+        on_column_ranges, max_order, strategy=strategy,
+        num_range_buckets=num_range_buckets,
+        range_bucketing=range_bucketing)
+    return plan.iterate(
+        engine, min_support, min_risk_ratio, top_k=top_k,
+        batch_size=batch_size, tracer=tracer)
+
+
+def diff_frame(
+        engine: sqlalchemy.engine.Engine,
+        test_relation: str,
+        control_relation: str,
+        on_column_values: Set[Column],
+        on_column_ranges: Set[Column],
+        min_support: float,
+        min_risk_ratio: float,
+        max_order: int,
+        top_k: Optional[int] = None,
+        strategy: Optional[GroupingSetsStrategy] = None,
+        num_range_buckets: int = NUM_RANGE_BUCKETS,
+        range_bucketing: RangeBucketing = RangeBucketing.CASE,
+        batch_size: int = STREAM_BATCH_SIZE,
+        tracer: Optional[Tracer] = None
+) -> ExplanationFrame:
+    """
+    Returns the explanations of `diff` as an `ExplanationFrame`. See
+    `iter_diff` for the parameters.
+    """
+    plan = compile_diff(
+        engine, test_relation, control_relation, on_column_values,
+        on_column_ranges, max_order, strategy=strategy,
+        num_range_buckets=num_range_buckets,
+        range_bucketing=range_bucketing)
+    return plan.frame(
+        engine, min_support, min_risk_ratio, top_k=top_k,
+        batch_size=batch_size, tracer=tracer)
+
+
+def _explanation_predicates(
+        columns: Tuple[Column, ...],
+        values: Tuple[Any, ...],
+        on_column_values: Set[Column],
+        bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]]
+) -> Tuple[Predicate, ...]:
+    predicates: List[Predicate] = []
+    for column, value in zip(columns, values):
+        if column in on_column_values:
+            predicates.append(Predicate(
+                column, Operator.EQUALS, Constant(value)))
+        else:
+            # Turn the proxy range bucket column back into a predicate on
+            # the range-valued column.
+            predicates += bucket_predicates[column][value]
+    return tuple(predicates)
+
+
+def _explanations_from_query(
+        engine: sqlalchemy.engine.Connectable,
+        diff_query: sqlalchemy.sql.expression.TextClause,
+        grouping_set_index: Dict[int, Tuple[Column, ...]],
+        on_column_values: Set[Column],
+        bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]],
+        parameters: Optional[Dict[str, Any]] = None,
+        tracer: Optional[Tracer] = None
+) -> List[Explanation]:
+    result = engine.execute(diff_query, parameters or {})
+    explanations = [
+        _explanation_from_row(
+            row, grouping_set_index, on_column_values, bucket_predicates)
+        for row in counted_rows(tracer, result)]
     result.close()
     return explanations
+
+
+def _explanation_from_row(
+        row: Any,
+        grouping_set_index: Dict[int, Tuple[Column, ...]],
+        on_column_values: Set[Column],
+        bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]]
+) -> Explanation:
+    grouping_set = grouping_set_index[row.grouping_id]
+    predicates = _explanation_predicates(
+        grouping_set, tuple(row[column.name] for column in grouping_set),
+        on_column_values, bucket_predicates)
+    # Some databases (e.g., PostgreSQL) cast `risk_ratio` as Decimal,
+    # so we cast to float.
+    return Explanation(predicates, float(row.risk_ratio),
+                       test_support=row.test_explanation_size,
+                       control_support=row.control_explanation_size or 0)
+
+
+def _in_process_explanations(
+        engine: sqlalchemy.engine.Connectable,
+        relations: Tuple[Tuple[str, Optional[bool]], ...],
+        on_columns: Tuple[Column, ...],
+        source_columns: Dict[Column, Column],
+        max_order: int,
+        min_support_rows: int,
+        num_test_rows: float,
+        num_control_rows: float,
+        min_risk_ratio: float,
+        on_column_values: Set[Column],
+        bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]],
+        tracer: Optional[Tracer] = None,
+        parameters: Optional[Dict[str, Any]] = None
+) -> List[Explanation]:
+    """
+    Computes the same explanations as the SQL grouping sets queries in
+    `diff`, but from a single scan of `relations` (see
+    `datools.in_process_counts.encode_relations`) whose rows are
+    dictionary-encoded and counted with numpy.
+
+    Apriori pruning mirrors the SQL: at higher orders, rows are limited
+    to the ones whose values are all frequent on their own, and at
+    orders above two, each explanation's subsets that are one column
+    smaller must be frequent.
+    """
+    with traced_phase(tracer, 'encode'):
+        rows = encode_relations(
+            engine, relations, on_columns, parameters=parameters,
+            tracer=tracer)
+    column_indices = {column: index for index, column in enumerate(on_columns)}
+    # TODO(marcua): Consult with someone better at statistics on how
+    # to avoid division by 0 in the risk ratio when a group encompases
+    # the entire relation. For now, make the relation size one larger
+    # than it actually is (see `_risk_ratio_sql`).
+    adjusted_test_rows = num_test_rows + 1
+    adjusted_control_rows = num_control_rows + 1
+    # The frequent explanations of each order, as tuples of
+    # (column index, code) pairs, and for each column, whether each of
+    # its codes is frequent on its own.
+    frequent: Dict[int, Set[Tuple[Tuple[int, int], ...]]] = {}
+    frequent_codes: List[np.ndarray] = []
+    explanations: List[Explanation] = []
+    for order in range(1, min(max_order, len(on_columns)) + 1):
+        sets, _ = _order_sets(on_columns, source_columns, order)
+        if not sets:
+            break
+        with traced_phase(tracer, f'order_{order}'):
+            frequent[order] = set()
+            order_explanations: List[Explanation] = []
+            # Rows with infrequent values are dropped rather than flagged,
+            # so we don't group on flag columns.
+            for grouping_set in (flagged_set[:order] for flagged_set in sets):
+                indices = [column_indices[column] for column in grouping_set]
+                decoders: List[Optional[np.ndarray]]
+                if order == 1:
+                    codes = rows.codes[indices]
+                    is_test = rows.is_test
+                    dimensions = tuple(
+                        len(rows.values[index]) for index in indices)
+                    decoders = [None for _ in indices]
+                else:
+                    # Only count rows whose values are all frequent, and
+                    # densely re-encode those values so there are fewer
+                    # possible combinations of codes to count.
+                    mask = np.logical_and.reduce(
+                        [frequent_codes[index][rows.codes[index]]
+                         for index in indices])
+                    decoders = [np.flatnonzero(frequent_codes[index])
+                                for index in indices]
+                    codes = np.stack(
+                        [(np.cumsum(frequent_codes[index]) - 1)[
+                            rows.codes[index][mask]]
+                         for index in indices])
+                    is_test = rows.is_test[mask]
+                    dimensions = tuple(
+                        int(frequent_codes[index].sum()) for index in indices)
+                group_codes, test_counts, control_counts = group_counts(
+                    codes, dimensions, is_test)
+                supported = test_counts > min_support_rows
+                group_codes = group_codes[supported]
+                test_counts = test_counts[supported]
+                control_counts = control_counts[supported]
+                for position, decoder in enumerate(decoders):
+                    if decoder is not None:
+                        group_codes[:, position] = decoder[
+                            group_codes[:, position]]
+                risk_ratios = (
+                    (1.0 * test_counts / (test_counts + control_counts))
+                    / (1.0 * (adjusted_test_rows - test_counts)
+                       / ((adjusted_test_rows - test_counts)
+                          + (adjusted_control_rows - control_counts))))
+                for group, test_size, control_size, risk_ratio in zip(
+                        group_codes.tolist(), test_counts.tolist(),
+                        control_counts.tolist(), risk_ratios.tolist()):
+                    explanation = tuple(zip(indices, group))
+                    if order > 2 and any(
+                            subset not in frequent[order - 1]
+                            for subset in combinations(
+                                explanation, order - 1)):
+                        continue
+                    frequent[order].add(explanation)
+                    if risk_ratio <= min_risk_ratio:
+                        continue
+                    predicates = _explanation_predicates(
+                        grouping_set,
+                        tuple(rows.values[index][code]
+                              for index, code in explanation),
+                        on_column_values, bucket_predicates)
+                    order_explanations.append(Explanation(
+                        predicates, risk_ratio, test_support=test_size,
+                        control_support=control_size))
+            if order == 1:
+                frequent_codes = [
+                    np.zeros(len(values), dtype=bool)
+                    for values in rows.values]
+                for ((index, code), ) in frequent[1]:
+                    frequent_codes[index][code] = True
+            order_explanations.sort(
+                key=lambda explanation: explanation.risk_ratio, reverse=True)
+            explanations += order_explanations
+    return explanations
+
+
+def _explanations(
+        engine: sqlalchemy.engine.Engine,
+        connection: sqlalchemy.engine.Connection,
+        relations: Tuple[Tuple[str, Optional[bool]], ...],
+        on_columns: Tuple[Column, ...],
+        source_columns: Dict[Column, Column],
+        max_order: int,
+        min_support_rows: int,
+        num_test_rows: float,
+        num_control_rows: float,
+        min_risk_ratio: float,
+        on_column_values: Set[Column],
+        bucket_predicates: Dict[Column, List[Tuple[Predicate, ...]]],
+        strategy: Optional[GroupingSetsStrategy],
+        tracer: Optional[Tracer] = None,
+        parameters: Optional[Dict[str, Any]] = None
+) -> List[Explanation]:
+    """
+    Computes explanations with `strategy`, or with the strategy
+    `plan_grouping_sets` chooses. `relations` is either a pair of test
+    and control relations, or a single labeled relation (see
+    `datools.in_process_counts.encode_relations`), and `parameters` are
+    bound to them.
+    """
+    if strategy is None:
+        # The number of range buckets is known, and the distinct values
+        # of other columns are estimated from a few of their rows,
+        # unless the database groups with grouping sets regardless.
+        num_rows = num_test_rows + num_control_rows
+        distinct_values: Dict[Column, float] = {
+            column: len(predicates)
+            for column, predicates in bucket_predicates.items()}
+        if not supports_grouping_sets(engine):
+            distinct_values.update(sampled_distinct_values(
+                connection,
+                '\nUNION ALL\n'.join(
+                    f'SELECT * FROM ({relation}) AS relation_{index}'
+                    for index, (relation, _) in enumerate(relations)),
+                {column for column in on_columns
+                 if column not in bucket_predicates},
+                num_rows, parameters=parameters))
+        strategy = plan_grouping_sets(
+            engine, num_rows,
+            _explanation_sets(on_columns, source_columns, max_order),
+            distinct_values, min_support_rows).strategy
+    if strategy == GroupingSetsStrategy.IN_PROCESS:
+        return _in_process_explanations(
+            connection, relations, on_columns, source_columns, max_order,
+            min_support_rows, num_test_rows, num_control_rows,
+            min_risk_ratio, on_column_values, bucket_predicates, tracer,
+            parameters)
+    # Thresholds and row counts are bound as parameters, so that
+    # repeated diffs of the same relations run the same statements,
+    # which SQLAlchemy and the database can cache.
+    explanations: List[Explanation] = []
+    queries = _explanation_queries(
+        engine, relations, on_columns, source_columns, max_order,
+        PLAN_PARAMETERS['min_support_rows'],
+        PLAN_PARAMETERS['num_test_rows'], PLAN_PARAMETERS['num_control_rows'],
+        PLAN_PARAMETERS['min_risk_ratio'], strategy)
+    parameters = {
+        **(parameters or {}),
+        'datools_min_support_rows': min_support_rows,
+        'datools_num_test_rows': num_test_rows,
+        'datools_num_control_rows': num_control_rows,
+        'datools_min_risk_ratio': min_risk_ratio}
+    for order, (diff_query, grouping_set_index) in enumerate(queries, 1):
+        with traced_phase(tracer, f'order_{order}'):
+            explanations += _explanations_from_query(
+                connection, bound_text(diff_query), grouping_set_index,
+                on_column_values, bucket_predicates, parameters, tracer)
+    return explanations
+
+
+def _explanation_queries(
+        engine: sqlalchemy.engine.Engine,
+        relations: Tuple[Tuple[str, Optional[bool]], ...],
+        on_columns: Tuple[Column, ...],
+        source_columns: Dict[Column, Column],
+        max_order: int,
+        min_support_rows: SqlNumber,
+        num_test_rows: SqlNumber,
+        num_control_rows: SqlNumber,
+        min_risk_ratio: SqlNumber,
+        strategy: GroupingSetsStrategy
+) -> List[Tuple[str, Dict[int, Tuple[Column, ...]]]]:
+    """
+    Returns the query for each order of explanation of `relations`
+    (see `_explanations`), along with its grouping set index.
+    """
+    if len(relations) == 1:
+        return _condition_queries(
+            engine, relations[0][0], on_columns, source_columns,
+            max_order, min_support_rows, num_test_rows, num_control_rows,
+            min_risk_ratio, strategy)
+    (test_relation, _), (control_relation, _) = relations
+    return _diff_queries(
+        engine, test_relation, control_relation, on_columns,
+        source_columns, max_order, min_support_rows, num_test_rows,
+        num_control_rows, min_risk_ratio, strategy)
+
+
+def _bucket_ranges(
+        bucket_minimums: List[Any]
+) -> List[Tuple[Optional[Any], Optional[Any]]]:
+    """
+    The (inclusive lower, exclusive upper) bound of each bucket that
+    `_rewrite_query_with_ranges_as_buckets` creates from
+    `bucket_minimums`, where None is unbounded.
+    """
+    return [(lower, upper) for lower, upper in zip(
+                [None] + bucket_minimums[1:], bucket_minimums[1:] + [None])
+            if lower is not None or upper is not None]
+
+
+def _range_contains(
+        outer: Tuple[Optional[Any], Optional[Any]],
+        inner: Tuple[Optional[Any], Optional[Any]]
+) -> bool:
+    outer_lower, outer_upper = outer
+    inner_lower, inner_upper = inner
+    return ((outer_lower is None
+             or (inner_lower is not None and inner_lower >= outer_lower))
+            and (outer_upper is None
+                 or (inner_upper is not None
+                     and inner_upper <= outer_upper)))
+
+
+@dataclass
+class _RangeRefiner:
+    """
+    Buckets range-valued columns coarse-to-fine (see `AdaptiveRanges`).
+    Each round of splitting computes single-column explanations on the
+    current buckets of `relations` (see `_explanations`), and splits
+    each bucket that produced one into equal-height buckets of
+    `statistics_relation`'s rows in that bucket. Splits in which no
+    finer bucket produces an explanation are undone, since the coarser
+    bucket was a better explanation.
+    """
+    engine: sqlalchemy.engine.Engine
+    connection: sqlalchemy.engine.Connection
+    relations: Tuple[Tuple[str, Optional[bool]], ...]
+    statistics_relation: str
+    min_support_rows: int
+    num_test_rows: float
+    num_control_rows: float
+    min_risk_ratio: float
+    strategy: GroupingSetsStrategy
+    bucketing: RangeBucketing
+    adaptive_ranges: AdaptiveRanges
+
+    def refine(
+            self, columns: Set[Column]
+    ) -> List[Tuple[Column, RangeValuedStatistics]]:
+        bucket_minimums = {
+            column: statistic.bucket_minimums
+            for column, statistic in range_valued_statistics(
+                self.connection, self.statistics_relation, columns,
+                self.adaptive_ranges.initial_buckets)}
+        promising = self._promising_ranges(bucket_minimums)
+        for _ in range(self.adaptive_ranges.max_depth):
+            splits = []
+            for column, bucket_range in promising:
+                added_minimums = self._split_minimums(
+                    column, bucket_range, bucket_minimums[column])
+                if added_minimums:
+                    bucket_minimums[column] = sorted(
+                        bucket_minimums[column] + added_minimums)
+                    splits.append((column, bucket_range, added_minimums))
+            if not splits:
+                break
+            refined = self._promising_ranges(bucket_minimums)
+            promising = []
+            for column, bucket_range, added_minimums in splits:
+                finer_ranges = [
+                    (refined_column, refined_range)
+                    for refined_column, refined_range in refined
+                    if refined_column == column
+                    and _range_contains(bucket_range, refined_range)]
+                if finer_ranges:
+                    promising += finer_ranges
+                else:
+                    bucket_minimums[column] = [
+                        minimum for minimum in bucket_minimums[column]
+                        if minimum not in added_minimums]
+        return [(column, RangeValuedStatistics(bucket_minimums[column]))
+                for column in columns]
+
+    def _promising_ranges(
+            self, bucket_minimums: Dict[Column, List[Any]]
+    ) -> List[Tuple[Column, Tuple[Optional[Any], Optional[Any]]]]:
+        """
+        Returns the column and range of each bucket that is a
+        single-column explanation.
+        """
+        range_statistics = [
+            (column, RangeValuedStatistics(minimums))
+            for column, minimums in bucket_minimums.items()]
+        rewritten_relations = []
+        for relation, is_test in self.relations:
+            rewritten_relation, bucket_predicates, parameters = (
+                _rewrite_query_with_ranges_as_buckets(
+                    self.engine, relation, range_statistics, self.bucketing))
+            rewritten_relations.append((rewritten_relation, is_test))
+        on_columns, source_columns = _on_columns(set(), bucket_predicates)
+        explanations = _explanations(
+            self.engine, self.connection, tuple(rewritten_relations),
+            on_columns, source_columns, 1, self.min_support_rows,
+            self.num_test_rows, self.num_control_rows, self.min_risk_ratio,
+            set(), bucket_predicates, self.strategy, parameters=parameters)
+        ranges = []
+        for explanation in explanations:
+            column = explanation.predicates[0].left
+            index = bucket_predicates[
+                Column(f'{column.name}__bucket')].index(
+                    explanation.predicates)
+            ranges.append(
+                (column, _bucket_ranges(bucket_minimums[column])[index]))
+        return ranges
+
+    def _split_minimums(
+            self,
+            column: Column,
+            bucket_range: Tuple[Optional[Any], Optional[Any]],
+            bucket_minimums: List[Any]
+    ) -> List[Any]:
+        """
+        Returns the minimums of the equal-height buckets that
+        `bucket_range` of `column` splits into, other than its own.
+        """
+        lower, upper = bucket_range
+        range_column = quote(self.connection, column.name)
+        conditions = []
+        parameters: Dict[str, Any] = {}
+        if lower is not None:
+            conditions.append(
+                f'{range_column} >= {_bound_sql("datools_lower", lower)}')
+            parameters['datools_lower'] = lower
+        if upper is not None:
+            conditions.append(
+                f'{range_column} < {_bound_sql("datools_upper", upper)}')
+            parameters['datools_upper'] = upper
+        [(_, statistic)] = range_valued_statistics(
+            self.connection,
+            f'SELECT * FROM ({self.statistics_relation}) AS bucket_relation '
+            f'WHERE {" AND ".join(conditions)}',
+            {column}, self.adaptive_ranges.buckets_per_split,
+            parameters=parameters)
+        return [minimum for minimum in statistic.bucket_minimums
+                if (lower is None or minimum > lower)
+                and minimum not in bucket_minimums]
@@ -0,0 +1,149 @@
+import numpy as np
+import sqlalchemy
+
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from datools.models import Column
+from datools.sqlalchemy_utils import execute_query
+from datools.sqlalchemy_utils import quote
+from datools.tracing import Tracer
+from datools.tracing import count_fetched
+
+
+BATCH_SIZE = 100000
+# We count groups with `np.bincount` over every possible combination of
+# grouping keys when there are at most this many combinations (or this
+# many per input row).
+MIN_BINCOUNT_KEYS = 2 ** 20
+BINCOUNT_KEYS_PER_ROW = 4
+
+
+@dataclass
+class EncodedRows:
+    """
+    Dictionary-encoded test and control rows. `codes` has a row of
+    integer codes for each column, `values` maps each column's codes
+    back to the values they encode, and `is_test` is true for each
+    test row.
+    """
+    columns: Tuple[Column, ...]
+    codes: np.ndarray
+    values: List[List[Any]]
+    is_test: np.ndarray
+
+
+def encode_relations(
+        engine: sqlalchemy.engine.Connectable,
+        relations: Tuple[Tuple[str, Optional[bool]], ...],
+        columns: Tuple[Column, ...],
+        batch_size: int = BATCH_SIZE,
+        parameters: Optional[Dict[str, Any]] = None,
+        tracer: Optional[Tracer] = None
+) -> EncodedRows:
+    """
+    Fetches `columns` of each of `relations` (binding `parameters`) in
+    batches of `batch_size` rows, and dictionary-encodes them into
+    integer arrays. The fetched rows are counted with `tracer`, if
+    there is one.
+
+    `relations` is a tuple of (query, is_test) pairs. If `is_test` is
+    None, the query's rows are labeled by an additional `test_row`
+    column that is 1 for test rows (see
+    `datools.explanations._labeled_relation`).
+
+    Results are streamed (with a server-side cursor on databases that
+    have them), so only one batch of fetched rows is held at a time.
+    The encoded rows take 8 bytes per column per row (twice that while
+    the batches are concatenated), plus the distinct values of each
+    column, so callers should bound the number of rows they encode
+    (see `datools.planner.MAX_IN_PROCESS_BYTES`).
+    """
+    dictionaries: List[Dict[Any, int]] = [{} for _ in columns]
+    code_batches: List[np.ndarray] = []
+    label_batches: List[np.ndarray] = []
+    column_names = ', '.join(quote(engine, column.name) for column in columns)
+    for relation, is_test in relations:
+        label_column = ', test_row' if is_test is None else ''
+        results = execute_query(
+            engine.execution_options(stream_results=True),
+            f'SELECT {column_names}{label_column} '
+            f'FROM ({relation}) AS encoded_relation',
+            parameters)
+        while True:
+            rows = results.fetchmany(batch_size)
+            if not rows:
+                break
+            count_fetched(tracer, len(rows))
+            batch_columns = list(zip(*rows))
+            codes = np.empty((len(columns), len(rows)), dtype=np.int64)
+            for index, dictionary in enumerate(dictionaries):
+                codes[index] = np.fromiter(
+                    (dictionary.setdefault(value, len(dictionary))
+                     for value in batch_columns[index]),
+                    dtype=np.int64, count=len(rows))
+            code_batches.append(codes)
+            if is_test is None:
+                label_batches.append(
+                    np.array(batch_columns[len(columns)]) == 1)
+            else:
+                label_batches.append(np.full(len(rows), is_test))
+        results.close()
+
+    values = [list(dictionary.keys()) for dictionary in dictionaries]
+    if not code_batches:
+        return EncodedRows(
+            columns, np.empty((len(columns), 0), dtype=np.int64), values,
+            np.empty(0, dtype=bool))
+    return EncodedRows(
+        columns, np.concatenate(code_batches, axis=1), values,
+        np.concatenate(label_batches))
+
+
+def group_counts(
+        codes: np.ndarray,
+        dimensions: Tuple[int, ...],
+        is_test: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counts the test and control rows in each group of `codes`, which
+    has a row of integer codes for each grouping column and a column
+    for each input row. `dimensions` holds the number of distinct codes
+    in each grouping column, and `is_test` is true for each test row.
+
+    Returns a tuple with
+      * an array with a row of codes for each group that contains at
+        least one row, and a column for each grouping column,
+      * the number of test rows in each group, and
+      * the number of control rows in each group.
+    """
+    # Combine each row's codes into a single key, either arithmetically
+    # when there are few enough possible keys to count them all, or by
+    # finding unique rows of codes otherwise.
+    dimensions = tuple(max(dimension, 1) for dimension in dimensions)
+    combined_cardinality = 1
+    for dimension in dimensions:
+        combined_cardinality *= dimension
+    arithmetic_keys = combined_cardinality <= max(
+        MIN_BINCOUNT_KEYS, BINCOUNT_KEYS_PER_ROW * codes.shape[1])
+    if arithmetic_keys:
+        keys = np.ravel_multi_index(tuple(codes), dimensions)
+        num_keys = combined_cardinality
+    else:
+        unique_codes, keys = np.unique(codes, axis=1, return_inverse=True)
+        keys = keys.reshape(-1)
+        num_keys = unique_codes.shape[1]
+
+    test_counts = np.bincount(keys[is_test], minlength=num_keys)
+    control_counts = np.bincount(keys[~is_test], minlength=num_keys)
+    groups = np.flatnonzero(test_counts + control_counts)
+    if arithmetic_keys:
+        group_codes = np.stack(
+            np.unravel_index(groups, dimensions), axis=1)
+    else:
+        group_codes = unique_codes[:, groups].T
+    return group_codes, test_counts[groups], control_counts[groups]
@@ -1,12 +1,16 @@
 from dataclasses import dataclass
+from dataclasses import field
+from datetime import date
+from datetime import time
 from enum import Enum
 from typing import Any
+from typing import Optional
 from typing import Tuple
 
 
 AggregateFunction = Enum(
     'AggregateFunction',
-    'SUM COUNT AVERAGE')
+    'SUM COUNT AVERAGE MAX')
 
 
 Operator = Enum(
@@ -14,6 +18,34 @@ Operator = Enum(
     'EQUALS NOT_EQUALS GT LT GTEQ LTEQ')
 
 
+# How explanation counts over many grouping sets are computed: with
+# the database's GROUPING SETS support, with a UNION ALL of GROUP BY
+# queries for databases that lack it, with a single GROUP BY over a
+# copy of each row per grouping set (which evaluates the relation
+# once rather than once per grouping set), or by fetching the rows and
+# counting them in process.
+GroupingSetsStrategy = Enum(
+    'GroupingSetsStrategy',
+    'NATIVE UNION_ALL UNPIVOT IN_PROCESS')
+
+
+# How range-valued columns are assigned to buckets: with a CASE
+# expression that tests each bucket in turn, by joining against a
+# relation of bucket boundaries, or arithmetically for buckets of
+# equal width.
+RangeBucketing = Enum(
+    'RangeBucketing',
+    'CASE BOUNDARY_JOIN EQUI_WIDTH')
+
+
+# Where column statistics come from: scanning the relation they
+# describe, or the statistics the database's planner already keeps
+# about it (falling back to a scan when there are none).
+StatisticsSource = Enum(
+    'StatisticsSource',
+    'SCAN CATALOG')
+
+
 OPERATOR_TO_SQL = {
     Operator.EQUALS: '=',
     Operator.NOT_EQUALS: '<>',
@@ -39,6 +71,15 @@ class Column:
 class Constant:
     value: Any
 
+    def to_sql(self):
+        # Text and temporal values are written as string literals, which
+        # databases compare with (or cast to) the type of the column
+        # they are compared to.
+        if isinstance(self.value, (str, date, time)):
+            escaped = str(self.value).replace("'", "''")
+            return f"'{escaped}'"
+        return str(self.value)
+
 
 @dataclass
 class Aggregate:
@@ -62,7 +103,7 @@ class Predicate:
 
     def to_sql(self):
         return (f'{self.left.name} '
-                f'{OPERATOR_TO_SQL[self.operator]} {self.right.value}')
+                f'{OPERATOR_TO_SQL[self.operator]} {self.right.to_sql()}')
 
     def __repr__(self):
         return f'Predicate({self.to_sql()})'
@@ -77,3 +118,44 @@ class Table:
 class Explanation:
     predicates: Tuple[Predicate, ...]
     risk_ratio: float
+    # The number of test and control rows the explanation describes.
+    # When an explanation was computed on a sample, these are scaled
+    # back up to estimate the full relations' counts, and intervals
+    # hold the lower and upper bounds of their confidence intervals.
+    # Explanations are compared on their predicates and risk ratio
+    # only.
+    test_support: Optional[float] = field(default=None, compare=False)
+    control_support: Optional[float] = field(default=None, compare=False)
+    test_support_interval: Optional[Tuple[float, float]] = field(
+        default=None, compare=False)
+    risk_ratio_interval: Optional[Tuple[float, float]] = field(
+        default=None, compare=False)
+
+
+@dataclass
+class Sample:
+    """
+    Describes a sample of a relation: either a `fraction` of its rows
+    or approximately a fixed number of `rows`. `seed` makes samples
+    repeatable, and `confidence` is the level of the confidence
+    intervals reported for estimates computed on the sample.
+    """
+    fraction: Optional[float] = None
+    rows: Optional[int] = None
+    seed: int = 0
+    confidence: float = 0.95
+
+
+@dataclass
+class AdaptiveRanges:
+    """
+    Describes coarse-to-fine bucketing of range-valued columns. Each
+    column starts out with `initial_buckets` equal-height buckets.
+    Buckets whose explanations meet the minimum support and risk ratio
+    are split into `buckets_per_split` equal-height buckets, up to
+    `max_depth` times, so that promising ranges are narrowed down
+    without evaluating every bucket at the finest resolution.
+    """
+    initial_buckets: int = 4
+    buckets_per_split: int = 4
+    max_depth: int = 3
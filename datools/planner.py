@@ -0,0 +1,135 @@
+import logging
+import sqlalchemy
+
+from dataclasses import dataclass
+from typing import Dict
+from typing import Mapping
+from typing import Sequence
+from typing import Tuple
+
+from datools.models import Column
+from datools.models import GroupingSetsStrategy
+from datools.sqlalchemy_utils import supports_grouping_sets
+
+
+logger = logging.getLogger(__name__)
+
+# Estimated microseconds per row, measured with `benchmarks.run` on
+# SQLite. A UNION ALL query scans the relation once per grouping set,
+# and each column of a grouping set adds to the cost of grouping it.
+# Counting in process costs roughly the same for any number of
+# grouping sets, but fetching and encoding each row's columns is
+# expensive.
+UNION_ALL_COLUMN_COST = 0.7
+IN_PROCESS_ROW_COST = 2.0
+IN_PROCESS_COLUMN_COST = 0.4
+# Counting in process allocates numpy arrays with an entry per group
+# (see `datools.in_process_counts.group_counts`), so relations that
+# might have more groups than this are counted in SQL.
+MAX_IN_PROCESS_GROUPS = 5000000
+# Encoded rows take 8 bytes per column per row, twice that while their
+# batches are concatenated (see `encode_relations`), so relations whose
+# encoded rows might take more memory than this are counted in SQL.
+MAX_IN_PROCESS_BYTES = 2 ** 30
+IN_PROCESS_COLUMN_BYTES = 16
+
+
+@dataclass
+class GroupingSetsPlan:
+    """
+    The strategy chosen to count explanations, why it was chosen, and
+    the estimated seconds each strategy that was considered would
+    take.
+    """
+    strategy: GroupingSetsStrategy
+    reason: str
+    costs: Dict[GroupingSetsStrategy, float]
+
+
+def _estimated_groups(
+        num_rows: float,
+        sets: Sequence[Tuple[Column, ...]],
+        distinct_values: Mapping[Column, float],
+        min_support_rows: float
+) -> float:
+    """
+    Estimates how many groups counting `sets` in process keeps
+    counters for. Larger grouping sets only count combinations of
+    values that met `min_support_rows` (see `_apriori_pruned_query`),
+    of which there are at most `num_rows / (min_support_rows + 1)` per
+    column. Columns without a distinct value estimate might have a
+    distinct value per row.
+    """
+    max_frequent_values = num_rows / (min_support_rows + 1)
+    groups = 0.0
+    for grouping_set in sets:
+        values = [distinct_values.get(column, num_rows)
+                  for column in grouping_set]
+        if len(grouping_set) > 1:
+            values = [min(value, max_frequent_values) for value in values]
+        set_groups = 1.0
+        for value in values:
+            set_groups *= value
+        groups += min(num_rows, set_groups)
+    return groups
+
+
+def plan_grouping_sets(
+        engine: sqlalchemy.engine.Connectable,
+        num_rows: float,
+        sets: Sequence[Tuple[Column, ...]],
+        distinct_values: Mapping[Column, float],
+        min_support_rows: float = 0
+) -> GroupingSetsPlan:
+    """
+    Chooses how to count `num_rows` rows in each of `sets`, and logs
+    the decision. Databases with GROUPING SETS always use them, since
+    they group every set in a single scan. Otherwise, the estimated
+    costs of a UNION ALL query and of counting in process are compared,
+    and counting in process is only considered if its counters fit in
+    `MAX_IN_PROCESS_GROUPS` (estimated from `distinct_values`, the
+    estimated number of distinct values of each column) and its
+    encoded rows fit in `MAX_IN_PROCESS_BYTES`.
+
+    `GroupingSetsStrategy.UNPIVOT` isn't considered, since it was
+    slower than a UNION ALL query in every benchmark.
+    """
+    num_columns = len({column for grouping_set in sets
+                       for column in grouping_set})
+    if supports_grouping_sets(engine):
+        plan = GroupingSetsPlan(
+            GroupingSetsStrategy.NATIVE,
+            'the database supports grouping sets', {})
+    else:
+        # Ties go to counting in process, which is the default without
+        # grouping sets (see `default_grouping_sets_strategy`).
+        costs = {
+            GroupingSetsStrategy.IN_PROCESS: (
+                num_rows * (IN_PROCESS_ROW_COST
+                            + IN_PROCESS_COLUMN_COST * num_columns) / 1e6),
+            GroupingSetsStrategy.UNION_ALL: (
+                num_rows * UNION_ALL_COLUMN_COST
+                * sum(len(grouping_set) for grouping_set in sets) / 1e6),
+        }
+        groups = _estimated_groups(
+            num_rows, sets, distinct_values, min_support_rows)
+        encoded_bytes = num_rows * num_columns * IN_PROCESS_COLUMN_BYTES
+        if groups > MAX_IN_PROCESS_GROUPS:
+            plan = GroupingSetsPlan(
+                GroupingSetsStrategy.UNION_ALL,
+                f'up to {groups:.0f} groups might not fit in memory', costs)
+        elif encoded_bytes > MAX_IN_PROCESS_BYTES:
+            plan = GroupingSetsPlan(
+                GroupingSetsStrategy.UNION_ALL,
+                f'{encoded_bytes / 2 ** 20:.0f} MiB of encoded rows might '
+                f'not fit in memory', costs)
+        else:
+            strategy = min(costs, key=lambda strategy: costs[strategy])
+            plan = GroupingSetsPlan(
+                strategy, 'it has the lowest estimated cost', costs)
+    logger.info(
+        'Counting %d grouping sets over %d rows with %s, since %s '
+        '(estimated seconds: %s)', len(sets), num_rows, plan.strategy.name,
+        plan.reason, {strategy.name: round(cost, 3)
+                      for strategy, cost in plan.costs.items()})
+    return plan
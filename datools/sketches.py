@@ -0,0 +1,221 @@
+import heapq
+
+from math import log
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+
+DEFAULT_QUANTILE_CAPACITY = 8192
+# 2 ** 14 registers estimate distinct counts with a standard error of
+# about 0.8%.
+DEFAULT_HYPERLOGLOG_PRECISION = 14
+HASH_MASK = 2 ** 64 - 1
+
+
+class QuantileSketch:
+    """
+    A streaming approximate quantile sketch in the style of KLL
+    ("Optimal Quantile Approximation in Streams" by Zohar Karnin,
+    Kevin Lang, and Edo Liberty), simplified so that every level
+    holds up to `capacity` values.
+
+    Values are added to level 0. When a level fills up, its values are
+    sorted and every other one is promoted to the next level, where
+    each value stands in for twice as many input values. The sketch
+    is exact until `capacity` values have been added, and uses memory
+    logarithmic in the number of values after that.
+
+    `key` orders values the same way `sorted` would.
+    """
+
+    def __init__(
+            self,
+            capacity: int = DEFAULT_QUANTILE_CAPACITY,
+            key: Optional[Callable[[Any], Any]] = None):
+        self.capacity = capacity
+        self.key = key
+        self.count = 0
+        self.levels: List[List[Any]] = [[]]
+        self._compactions = 0
+
+    def add(self, value: Any):
+        self.levels[0].append(value)
+        self.count += 1
+        if len(self.levels[0]) >= self.capacity:
+            self._compact(0)
+
+    def _compact(self, level: int):
+        values = sorted(self.levels[level], key=self.key)
+        # With an odd number of values, one stays behind at this level.
+        num_promoted = len(values) - len(values) % 2
+        self.levels[level] = values[num_promoted:]
+        # Alternating between promoting the even and odd values keeps
+        # the rank errors of successive compactions from accumulating
+        # in the same direction.
+        offset = self._compactions % 2
+        self._compactions += 1
+        if level + 1 == len(self.levels):
+            self.levels.append([])
+        self.levels[level + 1] += values[offset:num_promoted:2]
+        if len(self.levels[level + 1]) >= self.capacity:
+            self._compact(level + 1)
+
+    def ranked_values(self, ranks: List[int]) -> List[Any]:
+        """
+        Returns the (approximate) value at each of `ranks`, which are
+        ascending 0-based positions in the sorted order of the added
+        values.
+        """
+        key = self.key or (lambda value: value)
+        weighted_values = sorted(
+            ((value, 2 ** level)
+             for level, values in enumerate(self.levels)
+             for value in values),
+            key=lambda weighted_value: key(weighted_value[0]))
+        values: List[Any] = []
+        seen = 0
+        for value, weight in weighted_values:
+            seen += weight
+            while len(values) < len(ranks) and ranks[len(values)] < seen:
+                values.append(value)
+        return values
+
+
+def _mixed_hash(value: Any) -> int:
+    """
+    A 64-bit hash of `value` whose bits are all well mixed. Python's
+    `hash` is consistent with equality (e.g., `hash(1) == hash(1.0)`),
+    but hashes integers to themselves, so we mix it with SplitMix64's
+    finalizer.
+    """
+    hashed = (hash(value) + 0x9e3779b97f4a7c15) & HASH_MASK
+    hashed = ((hashed ^ (hashed >> 30)) * 0xbf58476d1ce4e5b9) & HASH_MASK
+    hashed = ((hashed ^ (hashed >> 27)) * 0x94d049bb133111eb) & HASH_MASK
+    return hashed ^ (hashed >> 31)
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct values added to it in memory
+    that doesn't grow with the number of values, as described in
+    "HyperLogLog: the analysis of a near-optimal cardinality estimation
+    algorithm" by Philippe Flajolet, Éric Fusy, Olivier Gandouet, and
+    Frédéric Meunier.
+
+    Each value's hash picks one of 2 ** `precision` registers, which
+    keeps the longest run of leading zeros seen in the rest of the
+    hashes it was picked by. Small counts are corrected with linear
+    counting of the empty registers. Until there are a quarter as many
+    distinct hashes as registers, the hashes themselves are kept (like
+    HyperLogLog++'s sparse representation), so small counts are exact.
+    """
+
+    def __init__(self, precision: int = DEFAULT_HYPERLOGLOG_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+        self.hashes: Optional[Set[int]] = set()
+
+    def add(self, value: Any):
+        hashed = _mixed_hash(value)
+        if self.hashes is not None:
+            self.hashes.add(hashed)
+            if len(self.hashes) > len(self.registers) // 4:
+                for sparse_hash in self.hashes:
+                    self._add_hash(sparse_hash)
+                self.hashes = None
+            return
+        self._add_hash(hashed)
+
+    def _add_hash(self, hashed: int):
+        register = hashed >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        remainder = hashed & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - remainder.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def count(self) -> int:
+        if self.hashes is not None:
+            return len(self.hashes)
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = alpha * num_registers ** 2 / sum(
+            2.0 ** -rank for rank in self.registers)
+        empty_registers = self.registers.count(0)
+        if estimate <= 2.5 * num_registers and empty_registers:
+            estimate = num_registers * log(num_registers / empty_registers)
+        return round(estimate)
+
+
+class SpaceSaving:
+    """
+    Tracks the most common values added to it with at most `capacity`
+    counters, as described in "Efficient Computation of Frequent and
+    Top-k Elements in Data Streams" by Ahmed Metwally, Divyakant
+    Agrawal, and Amr El Abbadi.
+
+    When every counter is taken, a new value replaces the value with
+    the smallest count and inherits that count plus one, so counts
+    overestimate by at most the smallest count. Any value that makes up
+    more than 1 / `capacity` of the added values is guaranteed to be
+    tracked.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[Any, int] = {}
+        # A min-heap of (count, insertion, value) entries, some of which
+        # are stale because their value's count has since grown. The
+        # insertion number keeps values from ever being compared.
+        self._heap: List[Tuple[int, int, Any]] = []
+        self._insertions = 0
+
+    def add(self, value: Any):
+        count = self.counts.get(value)
+        if count is None:
+            if len(self.counts) < self.capacity:
+                count = 0
+            else:
+                count = self._evict_smallest()
+        self.counts[value] = count + 1
+        self._push(count + 1, value)
+
+    def _push(self, count: int, value: Any):
+        heapq.heappush(self._heap, (count, self._insertions, value))
+        self._insertions += 1
+        # Rebuild the heap from the current counts once stale entries
+        # outnumber current ones, which keeps its size proportional to
+        # `capacity`.
+        if len(self._heap) > 2 * self.capacity:
+            self._heap = [(count, index, value) for index, (value, count)
+                          in enumerate(self.counts.items())]
+            heapq.heapify(self._heap)
+            self._insertions = len(self._heap)
+
+    def _evict_smallest(self) -> int:
+        while True:
+            count, _, value = heapq.heappop(self._heap)
+            if self.counts.get(value) == count:
+                del self.counts[value]
+                return count
+
+    def most_common(
+            self,
+            num_values: int,
+            key: Optional[Callable[[Any], Any]] = None
+    ) -> List[Any]:
+        """
+        Returns the `num_values` values with the largest counts. Values
+        with the same count are ordered by `key` (the way `sorted`
+        would), if provided.
+        """
+        values = list(self.counts)
+        if key is not None:
+            values.sort(key=key)
+        values.sort(key=lambda value: self.counts[value], reverse=True)
+        return values[:num_values]
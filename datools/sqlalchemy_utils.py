@@ -1,48 +1,236 @@
+import hashlib
+import re
 import sqlalchemy
+from contextlib import contextmanager
+from math import floor
 from tabulate import tabulate
 from textwrap import dedent
+from textwrap import indent
+from typing import Any
+from typing import Collection
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
+from uuid import uuid4
 
+from datools.errors import DatoolsError
 from datools.models import Aggregate
 from datools.models import Column
+from datools.models import GroupingSetsStrategy
+from datools.tracing import Tracer
+from datools.tracing import count_fetched
 
 INDENT = '    '
+# SQLite's `IS` compares NULLs as equal, and predates its support for
+# `IS NOT DISTINCT FROM`. PostgreSQL can't hash or sort on `IS NOT
+# DISTINCT FROM`, so it would compare every pair of rows that match on
+# the join's other conditions, but arrays compare NULL elements as
+# equal and can be joined on with a hash or merge join.
+NULL_SAFE_EQUALS_EXPRESSIONS = {
+    'duckdb': '({left} IS NOT DISTINCT FROM {right})',
+    'postgresql': '(ARRAY[{left}] = ARRAY[{right}])',
+    'sqlite': '({left} IS {right})',
+}
+# PostgreSQL's GROUPING accepts at most 31 arguments.
+MAX_GROUPING_ARGUMENTS = 31
+TABLE_QUERY = re.compile(
+    r'^\s*SELECT\s+\*\s+FROM\s+((?:"[^"]+"|[A-Za-z_][A-Za-z0-9_]*)'
+    r'(?:\.(?:"[^"]+"|[A-Za-z_][A-Za-z0-9_]*))*)\s*$',
+    re.IGNORECASE)
+# The `:name` placeholders that `sqlalchemy.text` binds.
+PLACEHOLDER = re.compile(r'(?<![:\w\\]):(\w+)(?!:)')
+# The parameters of the queries datools generates are named with this
+# prefix, so that they aren't mistaken for the colons of relations.
+PARAMETER_PREFIX = 'datools_'
+
+
+@contextmanager
+def pinned_connection(
+        engine: sqlalchemy.engine.Connectable
+) -> Iterator[sqlalchemy.engine.Connection]:
+    """
+    Yields a single connection to run several statements on, which is
+    `engine` itself if it is already a connection.
+    """
+    if isinstance(engine, sqlalchemy.engine.Connection):
+        yield engine
+    else:
+        with engine.connect() as connection:
+            yield connection
+
+
+def quote(engine: sqlalchemy.engine.Connectable, name: str) -> str:
+    """
+    Returns `name` as an identifier of `engine`'s dialect, quoting it
+    if it has to be (e.g., `order`, `Voltage`, or `created at`).
+    """
+    return engine.dialect.identifier_preparer.quote(name)
+
+
+def aggregate_sql(
+        engine: sqlalchemy.engine.Connectable,
+        aggregate: Aggregate
+) -> str:
+    argument = ('*' if aggregate.column == Column('*')
+                else quote(engine, aggregate.column.name))
+    return (f'{aggregate.function.name}({argument}) '
+            f'AS {quote(engine, aggregate.as_name.name)}')
+
+
+def bound_text(
+        query: str,
+        parameter_names: Collection[str] = ()
+) -> sqlalchemy.sql.expression.TextClause:
+    """
+    Returns `query` as a `sqlalchemy.text` clause that only binds the
+    `:name` placeholders of datools' own parameters (named with
+    `PARAMETER_PREFIX`) and of `parameter_names`. Any other colon (e.g.,
+    in a string literal of a relation, like `'12:30'`) is escaped, so
+    relations are passed to the database as they were written.
+    """
+    def escaped(placeholder: re.Match) -> str:
+        name = placeholder.group(1)
+        if name.startswith(PARAMETER_PREFIX) or name in parameter_names:
+            return placeholder.group(0)
+        return '\\' + placeholder.group(0)
+    return sqlalchemy.text(PLACEHOLDER.sub(escaped, query))
+
+
+def execute_query(
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        parameters: Optional[Dict[str, Any]] = None
+) -> sqlalchemy.engine.ResultProxy:
+    """
+    Executes `query`, binding `parameters` to its `:name` placeholders
+    (see `bound_text`).
+    """
+    parameters = parameters or {}
+    return engine.execute(bound_text(query, parameters), parameters)
 
 
 def query_columns(
-        engine: sqlalchemy.engine.Engine, query: str
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        parameters: Optional[Dict[str, Any]] = None
 ) -> Tuple[str, ...]:
-    results = engine.execute(query)
+    # LIMIT 0 lets the database describe the query's columns without
+    # computing its results.
+    results = execute_query(
+        engine, f'SELECT * FROM ({query}) AS query LIMIT 0', parameters)
     columns = tuple(column[0] for column in results.cursor.description)
     results.close()
     return columns
 
 
+def queried_table(query: str) -> Optional[str]:
+    """
+    Returns the name of the table `query` reads in its entirety, if it
+    is simply `SELECT * FROM <table>`.
+    """
+    table_query = TABLE_QUERY.match(query)
+    return None if table_query is None else table_query.group(1)
+
+
 def query_results_pretty_print(
         engine: sqlalchemy.engine.Engine, query: str,
         label: Optional[str] = None
 ) -> None:
     if label:
         print(f'*** {label} ***')
-    result = engine.execute(query)
+    result = execute_query(engine, query)
     all_rows = (dict(row) for row in result)
     print(tabulate(all_rows, headers='keys', tablefmt='psql'))
     result.close()
 
 
-def query_rows(engine: sqlalchemy.engine.Engine, query: str) -> int:
+def query_rows(
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        parameters: Optional[Dict[str, Any]] = None,
+        tracer: Optional[Tracer] = None
+) -> int:
     count_query = (
         f'WITH query AS ({query}) '
         f'SELECT COUNT(*) AS num_rows FROM query')
-    results = engine.execute(count_query)
+    results = execute_query(engine, count_query, parameters)
     rows = results.first().num_rows
     results.close()
+    count_fetched(tracer, 1)
     return rows
 
 
+class TemporaryTables:
+    """
+    Materializes queries into temporary tables on a single connection,
+    and drops them when used as a context manager exits. Temporary
+    tables are only visible to the connection that created them, so
+    every query that reads from them has to run on `connection`.
+    """
+
+    def __init__(self, connection: sqlalchemy.engine.Connection):
+        self.connection = connection
+        self.names: List[str] = []
+
+    def create(
+            self,
+            query: str,
+            columns: Optional[Iterable[Column]] = None,
+            parameters: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        Executes `query` once (binding `parameters`, if provided),
+        storing `columns` of its results (or all of them) in a new
+        temporary table, and returns the name of that table.
+        """
+        name = f'datools_{uuid4().hex}'
+        column_names = ('*' if columns is None else ', '.join(
+            quote(self.connection, column.name) for column in columns))
+        execute_query(
+            self.connection,
+            f'CREATE TEMPORARY TABLE {name} AS '
+            f'SELECT {column_names} FROM ({query}) AS query',
+            parameters)
+        self.names.append(name)
+        return name
+
+    def drop(self, name: str):
+        self.connection.execute(f'DROP TABLE IF EXISTS {name}')
+        self.names.remove(name)
+
+    def __enter__(self) -> 'TemporaryTables':
+        return self
+
+    def __exit__(self, *args):
+        for name in list(self.names):
+            self.drop(name)
+
+
+def null_safe_equals(
+        engine: sqlalchemy.engine.Connectable,
+        left: str,
+        right: str
+) -> str:
+    """
+    Returns a SQL expression that is true when `left` and `right` are
+    equal, treating two NULLs as equal to one another.
+
+    Databases get an expression they can join on with a hash join (see
+    `NULL_SAFE_EQUALS_EXPRESSIONS`), whereas an `OR` of equality and
+    both sides being NULL results in a nested loop join (e.g., DuckDB's
+    `BLOCKWISE_NL_JOIN`).
+    """
+    backend = engine.engine.url.get_backend_name()
+    if backend in NULL_SAFE_EQUALS_EXPRESSIONS:
+        return NULL_SAFE_EQUALS_EXPRESSIONS[backend].format(
+            left=left, right=right)
+    return (f'(({left} = {right}) '
+            f'OR (({left} IS NULL) AND ({right} IS NULL)))')
+
+
 def _native_grouping_sets_query(
         engine: sqlalchemy.engine.Engine,
         query: str,
@@ -60,31 +248,45 @@ def _native_grouping_sets_query(
     """
     column_indices: Dict[str, int] = {}
     set_strings: List[str] = []
-    set_indices: Dict[int, Tuple[Column, ...]] = {}
-    # A grouping ID with a binary representation of all 1s indicates
-    # no grouping set is used. Below, we will create grouping IDs by
-    # subtracting the 1 for the appropriate position for the grouping
-    # set being used.
-    no_sets_id = int('1' * len(sets), 2)
-    for set_index, grouping_set in enumerate(sets):
-        set_strings.append(', '.join(column.name for column in grouping_set))
-        # Subtract (2 ** set ID) from `no_sets_id` to flip its bit to 0.
-        set_indices[no_sets_id
-                    - (2 ** (len(sets) - set_index - 1))] = grouping_set
+    for grouping_set in sets:
+        set_strings.append(', '.join(
+            quote(engine, column.name) for column in grouping_set))
         for column in grouping_set:
             index = column_indices.get(column.name)
             if index is None:
                 column_indices[column.name] = len(column_indices)
 
+    # GROUPING(column1, ..., columnN) returns an integer whose binary
+    # representation has a 1 for each column that is not part of the
+    # grouping set, with column1 as the most significant bit.
+    set_indices: Dict[int, Tuple[Column, ...]] = {}
+    for grouping_set in sets:
+        set_id = sum(
+            2 ** (len(column_indices) - index - 1)
+            for name, index in column_indices.items()
+            if Column(name) not in grouping_set)
+        set_indices[set_id] = grouping_set
+
     sets_string = ', '.join(f'({group_string})'
                             for group_string in set_strings)
-    group_columns = ', '.join(column_indices.keys())
-    aggregate_columns = ', '.join(agg.to_sql() for agg in aggregates)
+    group_columns = ', '.join(
+        quote(engine, name) for name in column_indices.keys())
+    if len(column_indices) <= MAX_GROUPING_ARGUMENTS:
+        grouping = f'GROUPING({group_columns})'
+    else:
+        # Some databases limit the number of arguments to GROUPING, so
+        # we assemble the same bitmask one column at a time.
+        grouping = ' + '.join(
+            f'({2 ** (len(column_indices) - index - 1)} '
+            f'* GROUPING({quote(engine, name)}))'
+            for name, index in column_indices.items())
+    aggregate_columns = ', '.join(
+        aggregate_sql(engine, agg) for agg in aggregates)
     return dedent(
             f'''
             WITH query AS ({query})
             SELECT
-                GROUPING({group_columns}) AS {grouping_id_key},
+                {grouping} AS {quote(engine, grouping_id_key)},
                 {group_columns},
                 {aggregate_columns}
             FROM query
@@ -114,16 +316,19 @@ def _synthetic_grouping_sets_query(
             if index is None:
                 column_indices[column] = len(column_indices)
 
-    aggregate_columns = ', '.join(agg.to_sql() for agg in aggregates)
+    aggregate_columns = ', '.join(
+        aggregate_sql(engine, agg) for agg in aggregates)
     queries = []
     set_index: Dict[int, Tuple[Column, ...]] = {}
     for set_id, grouping_set in enumerate(sets):
         set_index[set_id] = grouping_set
-        group_columns = [f'NULL AS {column.name}'
+        group_columns = [f'NULL AS {quote(engine, column.name)}'
                          for column in column_indices.keys()]
         for column in grouping_set:
-            group_columns[column_indices[column]] = column.name
-        grouping_set_names = tuple(column.name for column in grouping_set)
+            group_columns[column_indices[column]] = quote(
+                engine, column.name)
+        grouping_set_names = tuple(
+            quote(engine, column.name) for column in grouping_set)
         group_by_columns = ', '.join(grouping_set_names)
         group_by = (
             f'{"GROUP BY" if len(group_by_columns) else ""} '
@@ -131,7 +336,7 @@ def _synthetic_grouping_sets_query(
         queries.append(dedent(
             f'''
             SELECT
-                {str(set_id)} AS {grouping_id_key},
+                {str(set_id)} AS {quote(engine, grouping_id_key)},
                 {', '.join(group_columns)},
                 {aggregate_columns}
             FROM query
@@ -147,12 +352,70 @@ def _synthetic_grouping_sets_query(
         '''), set_index
 
 
+def _unpivoted_grouping_sets_query(
+        engine: sqlalchemy.engine.Engine,
+        query: str,
+        sets: Tuple[Tuple[Column, ...], ...],
+        aggregates: Tuple[Aggregate, ...],
+        grouping_id_key: str
+) -> Tuple[str, Dict[int, Tuple[Column, ...]]]:
+    """
+    Another synthetic version of a GROUPING SETs query, which pairs
+    each row of `query` with each grouping set's ID, keeps the columns
+    of the row's grouping set (setting the others to NULL), and groups
+    the result once. Unlike `_synthetic_grouping_sets_query`, `query`
+    is only evaluated once, at the cost of aggregating a row per row
+    and grouping set. Set IDs match `_synthetic_grouping_sets_query`'s.
+
+    On SQLite, `benchmarks.run` finds that one large aggregation is
+    slower than many small ones, even for relations with expensive
+    window functions, so this is never chosen by default.
+    """
+    column_sets: Dict[Column, List[int]] = {}
+    set_index: Dict[int, Tuple[Column, ...]] = {}
+    for set_id, grouping_set in enumerate(sets):
+        set_index[set_id] = grouping_set
+        for column in grouping_set:
+            column_sets.setdefault(column, []).append(set_id)
+
+    group_expressions = [
+        f'CASE WHEN datools_grouping_sets.datools_set_id IN '
+        f'({", ".join(map(str, set_ids))}) '
+        f'THEN query.{quote(engine, column.name)} END'
+        for column, set_ids in column_sets.items()]
+    group_columns = ',\n'.join(
+        f'{expression} AS {quote(engine, column.name)}'
+        for expression, column in zip(group_expressions, column_sets))
+    group_by = ',\n'.join(
+        ['datools_grouping_sets.datools_set_id'] + group_expressions)
+    set_ids = ', '.join(f'({set_id})' for set_id in set_index)
+    aggregate_columns = ', '.join(
+        aggregate_sql(engine, agg) for agg in aggregates)
+    # SQLite always loops over the left side of a CROSS JOIN in the
+    # outer loop, so `query` is evaluated once.
+    return dedent(
+        f'''
+        WITH query AS ({query}),
+        datools_grouping_sets(datools_set_id) AS (VALUES {set_ids})
+        SELECT
+            datools_grouping_sets.datools_set_id
+                AS {quote(engine, grouping_id_key)},
+            {indent(group_columns, 3 * INDENT).lstrip()},
+            {aggregate_columns}
+        FROM query
+        CROSS JOIN datools_grouping_sets
+        GROUP BY
+            {indent(group_by, 3 * INDENT).lstrip()}
+        '''), set_index
+
+
 def grouping_sets_query(
         engine: sqlalchemy.engine.Engine,
         query: str,
         sets: Tuple[Tuple[Column, ...], ...],
         aggregates: Tuple[Aggregate, ...],
-        grouping_id_key: str = 'grouping_id'
+        grouping_id_key: str = 'grouping_id',
+        strategy: Optional[GroupingSetsStrategy] = None
 ) -> Tuple[str, Dict[int, Tuple[Column, ...]]]:
     """
 
@@ -180,13 +443,146 @@ def grouping_sets_query(
     If the database that `engine` is connected to natively supports
     grouping sets, utilize the standard SQL syntax for them. If it doesn't,
     implement the query by capturing the UNION ALL output of multiple
-    GROUP BY subqueries.
+    GROUP BY subqueries. `strategy` overrides this choice (see
+    `GroupingSetsStrategy`).
     """
-    if engine.url.get_backend_name() == 'sqlite':
+    if strategy is None:
+        strategy = (GroupingSetsStrategy.NATIVE
+                    if supports_grouping_sets(engine)
+                    else GroupingSetsStrategy.UNION_ALL)
+    if strategy == GroupingSetsStrategy.UNION_ALL:
         return _synthetic_grouping_sets_query(
             engine, query, sets, aggregates,
             grouping_id_key)
-    else:
+    elif strategy == GroupingSetsStrategy.UNPIVOT:
+        return _unpivoted_grouping_sets_query(
+            engine, query, sets, aggregates,
+            grouping_id_key)
+    elif strategy == GroupingSetsStrategy.NATIVE:
         return _native_grouping_sets_query(
             engine, query, sets, aggregates,
             grouping_id_key)
+    raise DatoolsError(f'{strategy} can not be expressed as a SQL query')
+
+
+def supports_grouping_sets(engine: sqlalchemy.engine.Connectable) -> bool:
+    return engine.engine.url.get_backend_name() != 'sqlite'
+
+
+def default_grouping_sets_strategy(
+        engine: sqlalchemy.engine.Connectable
+) -> GroupingSetsStrategy:
+    """
+    Databases without grouping sets would scan a relation once per
+    grouping set in a UNION ALL query, so for them we count in process
+    from a single scan instead.
+    """
+    if supports_grouping_sets(engine):
+        return GroupingSetsStrategy.NATIVE
+    return GroupingSetsStrategy.IN_PROCESS
+
+
+# Sampled rows are those whose hash, taken modulo this, falls below
+# the sampled fraction of it.
+SAMPLE_HASH_MODULUS = 2 ** 31
+# The name SQLite's row hash function is registered under (see
+# `sampled_query`).
+SQLITE_ROW_HASH_FUNCTION = 'datools_row_hash'
+
+
+def _sqlite_row_hash(*values: Any) -> int:
+    """
+    Hashes a seed, a row's position among its duplicates, and the row's
+    values (see `sampled_query`) onto [0, SAMPLE_HASH_MODULUS).
+    """
+    digest = hashlib.md5(repr(values).encode()).digest()
+    return int.from_bytes(digest[:4], 'big') % SAMPLE_HASH_MODULUS
+
+
+def _create_sqlite_row_hash(dbapi_connection: Any, *_: Any) -> None:
+    dbapi_connection.create_function(
+        SQLITE_ROW_HASH_FUNCTION, -1, _sqlite_row_hash, deterministic=True)
+
+
+def _register_sqlite_row_hash(engine: sqlalchemy.engine.Connectable) -> None:
+    """
+    Registers `_sqlite_row_hash` with `engine`'s current connections and
+    any it opens later.
+    """
+    if isinstance(engine, sqlalchemy.engine.Connection):
+        _create_sqlite_row_hash(engine.connection)
+        return
+    if not sqlalchemy.event.contains(
+            engine, 'connect', _create_sqlite_row_hash):
+        sqlalchemy.event.listen(engine, 'connect', _create_sqlite_row_hash)
+    with engine.connect() as connection:
+        _create_sqlite_row_hash(connection.connection)
+
+
+def sampled_query(
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        fraction: float,
+        seed: int = 0
+) -> str:
+    """
+    Returns a query for a random sample of approximately `fraction` of
+    the rows of `query`, with the same columns as `query`.
+
+    Databases that can sample arbitrary subqueries (e.g., DuckDB) use
+    TABLESAMPLE. PostgreSQL can only TABLESAMPLE tables, so we instead
+    keep the rows whose hashed contents and `seed` fall below a
+    threshold, which is deterministic for a given `seed`. Identical
+    rows would all hash alike, so each row's position among its
+    duplicates is hashed too, which costs sorting the rows of `query`.
+    SQLite has no hash function, so we register one in Python with
+    `engine`, and the returned query has to be run with `engine`.
+    """
+    backend = engine.engine.url.get_backend_name()
+    threshold = floor(fraction * SAMPLE_HASH_MODULUS)
+    if backend == 'duckdb':
+        return dedent(
+            f'''
+            SELECT *
+            FROM ({query}) AS sampled_query
+            TABLESAMPLE {100.0 * fraction}% (bernoulli, {seed})
+            ''')
+    elif backend == 'postgresql':
+        # The first 31 bits of the MD5 hash of the row's text and its
+        # position among identical rows. The row is carried as a single
+        # composite value so that only its own columns are returned.
+        duplicate = 'ROW_NUMBER() OVER (PARTITION BY sampled_query::text)'
+        row_hash = (
+            f"(('x' || SUBSTR(MD5('{seed}-' || {duplicate} || '-' "
+            f"|| sampled_query::text), 1, 8))"
+            f"::bit(32)::bigint % {SAMPLE_HASH_MODULUS})")
+        return dedent(
+            f'''
+            WITH hashed_query AS (
+                SELECT
+                    sampled_query AS sampled_row,
+                    {row_hash} AS datools_row_hash
+                FROM ({query}) AS sampled_query
+            )
+            SELECT (sampled_row).*
+            FROM hashed_query
+            WHERE datools_row_hash < {threshold}
+            ''')
+    else:
+        _register_sqlite_row_hash(engine)
+        columns = ', '.join(
+            quote(engine, name) for name in query_columns(engine, query))
+        return dedent(
+            f'''
+            WITH numbered_query AS (
+                SELECT
+                    {columns},
+                    ROW_NUMBER() OVER (PARTITION BY {columns})
+                        AS datools_duplicate
+                FROM ({query}) AS sampled_query
+            )
+            SELECT {columns}
+            FROM numbered_query
+            WHERE {SQLITE_ROW_HASH_FUNCTION}(
+                {seed}, datools_duplicate, {columns}) < {threshold}
+            ''')
@@ -0,0 +1,304 @@
+import json
+import sqlalchemy
+
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from decimal import Decimal
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from datools.models import Column
+from datools.models import StatisticsSource
+from datools.sqlalchemy_utils import execute_query
+from datools.sqlalchemy_utils import queried_table
+from datools.sqlalchemy_utils import quote
+from datools.table_statistics import ColumnStatistics
+from datools.table_statistics import RangeValuedStatistics
+from datools.table_statistics import SetValuedStatistics
+from datools.table_statistics import equi_width_statistics
+from datools.table_statistics import range_valued_statistics
+from datools.table_statistics import set_valued_statistics
+
+
+CATALOG_TABLE = 'datools_statistics'
+
+
+def relation_fingerprint(
+        engine: sqlalchemy.engine.Connectable,
+        relation: str,
+        fingerprint_column: Optional[Column] = None,
+        scan: bool = False
+) -> Optional[str]:
+    """
+    Returns a cheap summary of `relation`'s contents that changes when
+    they do, or None if `relation` can't be summarized cheaply. On
+    PostgreSQL, if `relation` reads a whole table, the table's insert,
+    update, and delete counters from `pg_stat_user_tables` are used
+    (these are updated shortly after each transaction commits).
+    Otherwise, the relation's row count and, if `fingerprint_column` is
+    provided, its largest value of that column (e.g., an
+    auto-incrementing ID or a modification time) are used. Updates that
+    keep the row count and maximum unchanged aren't detected.
+
+    Counting the rows of any relation other than a whole table scans
+    all of it, and so is only done if `scan` is set.
+    """
+    table_name = queried_table(relation)
+    if table_name is None and not scan:
+        return None
+    if (engine.engine.url.get_backend_name() == 'postgresql'
+            and table_name is not None):
+        results = engine.execute(
+            sqlalchemy.text(
+                'SELECT n_tup_ins, n_tup_upd, n_tup_del '
+                'FROM pg_stat_user_tables '
+                'WHERE relid = CAST(:table_name AS regclass)'),
+            table_name=table_name)
+        counters = results.fetchone()
+        results.close()
+        if counters is not None:
+            return 'pg_stat:' + ':'.join(str(counter) for counter in counters)
+    clauses = ['COUNT(*) AS num_rows']
+    if fingerprint_column is not None:
+        clauses.append(
+            f'MAX({quote(engine, fingerprint_column.name)}) AS maximum')
+    results = execute_query(
+        engine,
+        f'SELECT {", ".join(clauses)} FROM ({relation}) AS query')
+    row = results.fetchone()
+    results.close()
+    return json.dumps(_encode_value(list(row)))
+
+
+def _encode_value(value: Any) -> Any:
+    """
+    Encodes `value` as JSON, tagging the types JSON doesn't support so
+    that `_decode_value` can restore them.
+    """
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(item) for item in value]
+    # datetime is a subclass of date, so it has to be checked first.
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'date': value.isoformat()}
+    if isinstance(value, time):
+        return {'time': value.isoformat()}
+    if isinstance(value, timedelta):
+        return {'timedelta': [value.days, value.seconds, value.microseconds]}
+    if isinstance(value, Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, bytes):
+        return {'bytes': value.hex()}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_decode_value(item) for item in value]
+    if isinstance(value, dict):
+        [(value_type, encoded)] = value.items()
+        if value_type == 'datetime':
+            return datetime.fromisoformat(encoded)
+        if value_type == 'date':
+            return date.fromisoformat(encoded)
+        if value_type == 'time':
+            return time.fromisoformat(encoded)
+        if value_type == 'timedelta':
+            return timedelta(*encoded)
+        if value_type == 'decimal':
+            return Decimal(encoded)
+        if value_type == 'bytes':
+            return bytes.fromhex(encoded)
+    return value
+
+
+def _encode_statistic(statistic: ColumnStatistics) -> str:
+    if isinstance(statistic, SetValuedStatistics):
+        return json.dumps({
+            'distinct_values': statistic.distinct_values,
+            'most_common_values': _encode_value(
+                statistic.most_common_values),
+            'source': statistic.source.name})
+    if isinstance(statistic, RangeValuedStatistics):
+        return json.dumps({
+            'bucket_minimums': _encode_value(statistic.bucket_minimums),
+            'bucket_width': _encode_value(statistic.bucket_width),
+            'source': statistic.source.name})
+    raise TypeError(f'Can not store {statistic}')
+
+
+def _decode_statistic(encoded: str) -> ColumnStatistics:
+    fields = json.loads(encoded)
+    source = StatisticsSource[fields['source']]
+    if 'distinct_values' in fields:
+        return SetValuedStatistics(
+            fields['distinct_values'],
+            _decode_value(fields['most_common_values']), source)
+    return RangeValuedStatistics(
+        _decode_value(fields['bucket_minimums']),
+        _decode_value(fields['bucket_width']), source)
+
+
+class StatisticsCatalog:
+    """
+    Stores column statistics in a table on `catalog_engine`, which can
+    be the database the statistics describe or a separate one (e.g., a
+    local SQLite file). Statistics are stored per relation, column,
+    kind of statistic, and the parameters they were computed with,
+    along with a fingerprint of the relation (see
+    `relation_fingerprint`). Statistics are reused for as long as their
+    relation's fingerprint is unchanged.
+
+    Relations other than whole tables are only fingerprinted (by
+    scanning them on each lookup) if `scan_relations` is set. The
+    `*_statistics` methods also take a `fingerprint` that the caller
+    computed some other way (e.g., from the last load of the tables
+    the relation reads). Without either, the statistics of such
+    relations are computed each time and not stored.
+
+    The `*_statistics` methods mirror the functions of the same name
+    in `datools.table_statistics`, only computing statistics for
+    columns that aren't already in the catalog. Their `relation`
+    parameter names the relation that `query` computes statistics of,
+    if they differ (e.g., because `query` reads from a temporary copy
+    of `relation`).
+    """
+
+    def __init__(
+            self,
+            catalog_engine: sqlalchemy.engine.Engine,
+            fingerprint_column: Optional[Column] = None,
+            table_name: str = CATALOG_TABLE,
+            scan_relations: bool = False):
+        self.catalog_engine = catalog_engine
+        self.fingerprint_column = fingerprint_column
+        self.scan_relations = scan_relations
+        self.table = sqlalchemy.Table(
+            table_name,
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column('relation', sqlalchemy.Text, nullable=False),
+            sqlalchemy.Column('column_name', sqlalchemy.Text, nullable=False),
+            sqlalchemy.Column('kind', sqlalchemy.Text, nullable=False),
+            sqlalchemy.Column('parameters', sqlalchemy.Text, nullable=False),
+            sqlalchemy.Column('fingerprint', sqlalchemy.Text, nullable=False),
+            sqlalchemy.Column('statistics', sqlalchemy.Text, nullable=False))
+        self.table.create(catalog_engine, checkfirst=True)
+
+    def set_valued_statistics(
+            self,
+            engine: sqlalchemy.engine.Engine,
+            query: str,
+            columns: Set[Column],
+            num_most_common_values: int = 100,
+            relation: Optional[str] = None,
+            source: StatisticsSource = StatisticsSource.SCAN,
+            approximate: bool = False,
+            fingerprint: Optional[str] = None
+    ) -> List[Tuple[Column, SetValuedStatistics]]:
+        return self._statistics(
+            engine, relation or query, columns, 'set_valued',
+            {'num_most_common_values': num_most_common_values,
+             'source': source.name,
+             'approximate': approximate},
+            lambda missing_columns: set_valued_statistics(
+                engine, query, missing_columns, num_most_common_values,
+                source, approximate),
+            fingerprint)
+
+    def range_valued_statistics(
+            self,
+            engine: sqlalchemy.engine.Connectable,
+            query: str,
+            columns: Set[Column],
+            num_buckets: int = 3,
+            relation: Optional[str] = None,
+            source: StatisticsSource = StatisticsSource.SCAN,
+            fingerprint: Optional[str] = None
+    ) -> List[Tuple[Column, RangeValuedStatistics]]:
+        return self._statistics(
+            engine, relation or query, columns, 'range_valued',
+            {'num_buckets': num_buckets, 'source': source.name},
+            lambda missing_columns: range_valued_statistics(
+                engine, query, missing_columns, num_buckets, source),
+            fingerprint)
+
+    def equi_width_statistics(
+            self,
+            engine: sqlalchemy.engine.Connectable,
+            query: str,
+            columns: Set[Column],
+            num_buckets: int = 3,
+            relation: Optional[str] = None,
+            fingerprint: Optional[str] = None
+    ) -> List[Tuple[Column, RangeValuedStatistics]]:
+        return self._statistics(
+            engine, relation or query, columns, 'equi_width',
+            {'num_buckets': num_buckets},
+            lambda missing_columns: equi_width_statistics(
+                engine, query, missing_columns, num_buckets),
+            fingerprint)
+
+    def _statistics(
+            self,
+            engine: sqlalchemy.engine.Connectable,
+            relation: str,
+            columns: Set[Column],
+            kind: str,
+            parameters: Dict[str, Any],
+            compute: Callable[[Set[Column]], List[Tuple[Column, Any]]],
+            fingerprint: Optional[str] = None
+    ) -> List[Tuple[Column, Any]]:
+        if not columns:
+            return []
+        if fingerprint is None:
+            fingerprint = relation_fingerprint(
+                engine, relation, self.fingerprint_column,
+                self.scan_relations)
+        if fingerprint is None:
+            return compute(columns)
+        encoded_parameters = json.dumps(parameters, sort_keys=True)
+        matches_key = sqlalchemy.and_(
+            self.table.c.relation == relation,
+            self.table.c.kind == kind,
+            self.table.c.parameters == encoded_parameters)
+        statistics: Dict[Column, Any] = {}
+        with self.catalog_engine.connect() as connection:
+            results = connection.execute(
+                sqlalchemy.select(
+                    self.table.c.column_name, self.table.c.statistics)
+                .where(matches_key)
+                .where(self.table.c.fingerprint == fingerprint))
+            for row in results:
+                column = Column(row.column_name)
+                if column in columns:
+                    statistics[column] = _decode_statistic(row.statistics)
+            results.close()
+
+        missing_columns = {column for column in columns
+                           if column not in statistics}
+        if missing_columns:
+            computed = compute(missing_columns)
+            with self.catalog_engine.begin() as connection:
+                connection.execute(
+                    self.table.delete()
+                    .where(matches_key)
+                    .where(self.table.c.column_name.in_(
+                        [column.name for column in missing_columns])))
+                connection.execute(self.table.insert(), [
+                    {'relation': relation,
+                     'column_name': column.name,
+                     'kind': kind,
+                     'parameters': encoded_parameters,
+                     'fingerprint': fingerprint,
+                     'statistics': _encode_statistic(statistic)}
+                    for column, statistic in computed])
+            statistics.update(computed)
+        return [(column, statistics[column]) for column in columns]
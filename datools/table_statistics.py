@@ -1,15 +1,39 @@
+import json
 import sqlalchemy
 
 from collections import defaultdict
 from dataclasses import dataclass
+from dataclasses import field
+from decimal import Decimal
+from textwrap import dedent
+from textwrap import indent
 from typing import Any
 from typing import Dict
 from typing import List
+from typing import Optional
 from typing import Tuple
 from typing import Set
+from typing import TYPE_CHECKING
 
+from datools.errors import DatoolsError
+from datools.models import Aggregate
+from datools.models import AggregateFunction
 from datools.models import Column
+from datools.models import StatisticsSource
 from datools.models import Table
+from datools.in_process_counts import BATCH_SIZE
+from datools.sketches import HyperLogLog
+from datools.sketches import QuantileSketch
+from datools.sketches import SpaceSaving
+from datools.sqlalchemy_utils import INDENT
+from datools.sqlalchemy_utils import execute_query
+from datools.sqlalchemy_utils import grouping_sets_query
+from datools.sqlalchemy_utils import pinned_connection
+from datools.sqlalchemy_utils import queried_table
+from datools.sqlalchemy_utils import quote
+
+if TYPE_CHECKING:
+    from datools.statistics_catalog import StatisticsCatalog
 
 
 RANGE_VALUED_TYPES = {
@@ -33,16 +57,32 @@ SET_VALUED_TYPES = {
     sqlalchemy.sql.sqltypes.Unicode,
     sqlalchemy.sql.sqltypes.UnicodeText,
 }
+# The Python types of values that can be split into buckets of equal
+# width.
+NUMERIC_TYPES = (int, float, Decimal)
+# Approximate most common values are tracked with this many counters
+# per value we return.
+MOST_COMMON_VALUES_CAPACITY_FACTOR = 10
+# Discrete percentiles are offset by this much so that the fraction
+# where a bucket starts isn't rounded down to the value before it.
+# Larger than the floating point error of fractions of up to a billion
+# values, and smaller than the gap between buckets' fractions.
+PERCENTILE_OFFSET = 1e-12
+# `sampled_distinct_values` reads this many rows.
+DISTINCT_SAMPLE_ROWS = 10000
 
 
 class ColumnStatistics:
-    pass
+    # Where the statistics came from (see `StatisticsSource`).
+    source: StatisticsSource
 
 
 @dataclass
 class SetValuedStatistics(ColumnStatistics):
     distinct_values: int
     most_common_values: list
+    source: StatisticsSource = field(
+        default=StatisticsSource.SCAN, compare=False)
 
     def __repr__(self):
         return (
@@ -58,6 +98,11 @@ class SetValuedStatistics(ColumnStatistics):
 @dataclass
 class RangeValuedStatistics(ColumnStatistics):
     bucket_minimums: List[Any]
+    # Set when the buckets all have the same width (see
+    # `equi_width_statistics`).
+    bucket_width: Optional[Any] = field(default=None, compare=False)
+    source: StatisticsSource = field(
+        default=StatisticsSource.SCAN, compare=False)
 
     def __repr__(self):
         return (
@@ -65,98 +110,569 @@ class RangeValuedStatistics(ColumnStatistics):
             f'{[minimum for minimum in self.bucket_minimums]})')
 
 
+@dataclass
+class _PlannerStatistics:
+    """A column's statistics from PostgreSQL's `pg_stats` view."""
+    null_fraction: float
+    distinct_values: int
+    most_common_values: Optional[List[Any]]
+    most_common_frequencies: Optional[List[float]]
+    histogram_bounds: Optional[List[Any]]
+
+
+def _planner_statistics(
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        columns: Set[Column]
+) -> Dict[Column, _PlannerStatistics]:
+    """
+    Reads the statistics PostgreSQL's planner keeps about each of
+    `columns` (see `ANALYZE`) if `query` reads a whole table. Columns
+    without statistics are left out.
+    """
+    table_name = queried_table(query)
+    if (engine.engine.url.get_backend_name() != 'postgresql'
+            or table_name is None):
+        return {}
+    results = engine.execute(
+        sqlalchemy.text(dedent(
+            """
+            SELECT attname, format_type(atttypid, atttypmod) AS column_type
+            FROM pg_attribute
+            WHERE attrelid = CAST(:table_name AS regclass)
+                AND attnum > 0
+                AND NOT attisdropped
+            """)),
+        table_name=table_name)
+    column_types = {row.attname: row.column_type for row in results}
+    results.close()
+    num_rows = engine.execute(
+        sqlalchemy.text(
+            'SELECT reltuples FROM pg_class '
+            'WHERE oid = CAST(:table_name AS regclass)'),
+        table_name=table_name).scalar()
+
+    statistics: Dict[Column, _PlannerStatistics] = {}
+    for column in columns:
+        # Unquoted column names are folded to lower case.
+        column_name = (column.name if column.name in column_types
+                       else column.name.lower())
+        if column_name not in column_types:
+            continue
+        # `pg_stats` stores values in arrays of type `anyarray`, which
+        # we cast back to arrays of the column's type.
+        results = engine.execute(
+            sqlalchemy.text(dedent(
+                f"""
+                SELECT
+                    null_frac,
+                    n_distinct,
+                    most_common_freqs,
+                    CAST(CAST(most_common_vals AS TEXT)
+                         AS {column_types[column_name]}[])
+                        AS most_common_vals,
+                    CAST(CAST(histogram_bounds AS TEXT)
+                         AS {column_types[column_name]}[])
+                        AS histogram_bounds
+                FROM pg_stats
+                WHERE CAST(quote_ident(schemaname) || '.'
+                           || quote_ident(tablename) AS regclass)
+                        = CAST(:table_name AS regclass)
+                    AND attname = :column_name
+                ORDER BY inherited DESC
+                LIMIT 1
+                """)),
+            table_name=table_name, column_name=column_name)
+        row = results.fetchone()
+        results.close()
+        if row is None:
+            continue
+        # A negative `n_distinct` is a fraction of the table's rows.
+        distinct_values = (
+            row.n_distinct if row.n_distinct >= 0
+            else -row.n_distinct * num_rows)
+        statistics[column] = _PlannerStatistics(
+            row.null_frac, round(distinct_values), row.most_common_vals,
+            row.most_common_freqs, row.histogram_bounds)
+    return statistics
+
+
 def set_valued_statistics(
         engine: sqlalchemy.engine.Engine,
         query: str,
         columns: Set[Column],
-        num_most_common_values: int = 100
+        num_most_common_values: int = 100,
+        source: StatisticsSource = StatisticsSource.SCAN,
+        approximate: bool = False
 ) -> List[Tuple[Column, SetValuedStatistics]]:
-    clauses: List[str] = []
-    for column in columns:
-        clauses.append(
-            f'COUNT(DISTINCT {column.name})'
-            f'AS {column.name}_distinct_values')
-    results = engine.execute(
-        f'WITH query AS ( '
-        f'{query}'
-        f')'
-        f'SELECT {", ".join(clauses)} FROM query')
-    count_statistics = list(results)[0]
+    """
+    Counts the distinct values of each of `columns` and finds its
+    `num_most_common_values` most common values.
+
+    With `StatisticsSource.CATALOG`, these come from the database
+    planner's statistics where it has them (on PostgreSQL, when `query`
+    is `SELECT * FROM <table>` and the table has been analyzed). Each
+    statistic's `source` reports where it came from.
+
+    If `approximate` is True, scanned columns are summarized in a
+    single pass with memory that doesn't grow with their number of
+    distinct values (see `_sketched_set_valued_statistics`).
+    """
+    statistics: Dict[Column, SetValuedStatistics] = {}
+    if source == StatisticsSource.CATALOG:
+        for column, planner_statistics in _planner_statistics(
+                engine, query, columns).items():
+            # Without a list of most common values (e.g., because all
+            # values are equally common), we fall back to a scan.
+            if planner_statistics.most_common_values is not None:
+                statistics[column] = SetValuedStatistics(
+                    planner_statistics.distinct_values,
+                    planner_statistics.most_common_values[
+                        :num_most_common_values],
+                    StatisticsSource.CATALOG)
+    scan = (_sketched_set_valued_statistics if approximate
+            else _scanned_set_valued_statistics)
+    statistics.update(scan(
+        engine, query,
+        {column for column in columns if column not in statistics},
+        num_most_common_values))
+    return [(column, statistics[column]) for column in columns]
+
+
+def sampled_distinct_values(
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        columns: Set[Column],
+        num_rows: float,
+        sample_rows: int = DISTINCT_SAMPLE_ROWS,
+        parameters: Optional[Dict[str, Any]] = None
+) -> Dict[Column, float]:
+    """
+    Cheaply estimates the number of distinct values of each of
+    `columns` in `query`, which has about `num_rows` rows, from its
+    first `sample_rows` rows (binding `parameters` to it). Values that
+    appear once in the sample are assumed to be unique in all of
+    `query`, which overestimates rather than underestimates
+    high-cardinality columns, while columns with a few common values
+    are estimated exactly. Since the sample isn't random, a column
+    whose values `query` returns in order is underestimated.
+    """
+    if not columns:
+        return {}
+    ordered_columns = tuple(columns)
+    column_names = ', '.join(
+        quote(engine, column.name) for column in ordered_columns)
+    counts = '\nUNION ALL\n'.join(
+        dedent(
+            f'''
+            SELECT
+                {index} AS column_index,
+                COUNT(*) AS distinct_values,
+                SUM(CASE WHEN num_rows = 1 THEN 1 ELSE 0 END) AS singletons,
+                SUM(num_rows) AS num_rows
+            FROM (
+                SELECT COUNT(*) AS num_rows
+                FROM sampled_query
+                GROUP BY {quote(engine, column.name)}
+            ) AS values_{index}
+            ''')
+        for index, column in enumerate(ordered_columns))
+    results = execute_query(
+        engine,
+        f'WITH sampled_query AS (\n'
+        f'{INDENT}SELECT {column_names} FROM ({query}) AS query\n'
+        f'{INDENT}LIMIT :datools_sample_rows\n)\n{counts}',
+        {**(parameters or {}), 'datools_sample_rows': sample_rows})
+    estimates: Dict[Column, float] = {}
+    for row in results:
+        if not row.num_rows:
+            continue
+        # Some databases sum into DECIMALs.
+        distinct_values, singletons, sampled_rows = (
+            float(row.distinct_values), float(row.singletons),
+            float(row.num_rows))
+        scale = max(1.0, num_rows / sampled_rows)
+        estimates[ordered_columns[row.column_index]] = min(
+            max(num_rows, 1.0),
+            distinct_values - singletons + singletons * scale)
+    results.close()
+    return estimates
+
+
+def _scanned_set_valued_statistics(
+        engine: sqlalchemy.engine.Engine,
+        query: str,
+        columns: Set[Column],
+        num_most_common_values: int
+) -> Dict[Column, SetValuedStatistics]:
+    """
+    Computes set-valued statistics in a single grouping sets query,
+    with a grouping set for each column. The groups of each set are
+    ranked by their size with a window function, and counted to find
+    the number of distinct values.
+    """
+    statistics: Dict[Column, SetValuedStatistics] = {}
+    if not columns:
+        return statistics
+    ordered_columns = tuple(columns)
+    counts_query, set_index = grouping_sets_query(
+        engine,
+        query,
+        tuple((column, ) for column in ordered_columns),
+        (Aggregate(AggregateFunction.COUNT, Column('*'), Column('num_rows')),
+         ))
+    # Within a grouping set, the columns of other sets are NULL, so we
+    # can order and count each set's values without knowing which set
+    # a row belongs to.
+    column_names = ', '.join(
+        quote(engine, column.name) for column in ordered_columns)
+    distinct_values = ' + '.join(
+        f'COUNT({quote(engine, column.name)}) OVER (PARTITION BY grouping_id)'
+        for column in ordered_columns)
+    results = execute_query(engine, dedent(
+        f'''
+        WITH counts AS (
+            {indent(counts_query, 3 * INDENT)}
+        ),
+        ranked_counts AS (
+            SELECT
+                counts.*,
+                ROW_NUMBER() OVER (
+                    PARTITION BY grouping_id
+                    ORDER BY num_rows DESC, {column_names}
+                ) AS value_rank,
+                {distinct_values} AS distinct_values
+            FROM counts
+        )
+        SELECT *
+        FROM ranked_counts
+        WHERE value_rank <= :datools_num_most_common_values
+        ORDER BY grouping_id, value_rank
+        '''), {'datools_num_most_common_values': num_most_common_values})
+    column_values: Dict[Column, List[Any]] = defaultdict(list)
+    column_distinct_values: Dict[Column, int] = defaultdict(int)
+    for row in results:
+        [column] = set_index[row.grouping_id]
+        column_values[column].append(row[column.name])
+        column_distinct_values[column] = row.distinct_values
     results.close()
-    statistics: List[Tuple[Column, SetValuedStatistics]] = []
     for column in columns:
-        results = engine.execute(
-                f'WITH query AS ( '
-                f'{query}'
-                f')'
-                f'SELECT {column.name}, COUNT(*) AS num_rows '
-                f'FROM query '
-                f'GROUP BY {column.name} '
-                f'ORDER BY num_rows DESC, {column.name} '
-                f'LIMIT {num_most_common_values}')
-        values = [row[column.name] for row in results]
+        statistics[column] = SetValuedStatistics(
+            column_distinct_values[column], column_values[column])
+    return statistics
+
+
+def _sketched_set_valued_statistics(
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        columns: Set[Column],
+        num_most_common_values: int
+) -> Dict[Column, SetValuedStatistics]:
+    """
+    Approximates set-valued statistics from a single streaming fetch of
+    `columns`: most common values with a `SpaceSaving` sketch, and
+    distinct values with a `HyperLogLog` sketch.
+    """
+    statistics: Dict[Column, SetValuedStatistics] = {}
+    if not columns:
+        return statistics
+    ordered_columns = tuple(columns)
+    with pinned_connection(engine) as connection:
+        distinct_sketches = [HyperLogLog() for _ in ordered_columns]
+        value_sketches = [
+            SpaceSaving(
+                MOST_COMMON_VALUES_CAPACITY_FACTOR * num_most_common_values)
+            for _ in ordered_columns]
+        column_names = ', '.join(
+            quote(connection, column.name) for column in ordered_columns)
+        results = execute_query(
+            connection.execution_options(stream_results=True),
+            f'SELECT {column_names} FROM ({query}) AS query')
+        while True:
+            rows = results.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            for index, values in enumerate(zip(*rows)):
+                add_value = value_sketches[index].add
+                add_distinct = distinct_sketches[index].add
+                for value in values:
+                    add_value(value)
+                    # COUNT(DISTINCT ...) ignores NULLs.
+                    if value is not None:
+                        add_distinct(value)
         results.close()
-        statistics.append((
-            column,
-            SetValuedStatistics(
-                count_statistics[f'{column.name}_distinct_values'],
-                values)))
+    for index, column in enumerate(ordered_columns):
+        statistics[column] = SetValuedStatistics(
+            distinct_sketches[index].count(),
+            value_sketches[index].most_common(
+                num_most_common_values,
+                key=lambda value: (value is None, _sqlite_sort_key(value))))
+    return statistics
+
+
+def _bucket_start_ranks(num_values: int, num_buckets: int) -> List[int]:
+    """
+    The 0-based rank of the first of `num_values` sorted values in each
+    of `num_buckets` equal-height buckets, which is where the bucket's
+    fraction of the values starts (see `_quantile_bucket_minimums`).
+    """
+    return sorted({bucket * num_values // num_buckets
+                   for bucket in range(num_buckets)
+                   if bucket * num_values // num_buckets < num_values})
+
+
+def _sqlite_sort_key(value: Any) -> Tuple[int, Any]:
+    # SQLite sorts numbers before text, and text before blobs.
+    if isinstance(value, (int, float)):
+        return (0, value)
+    if isinstance(value, str):
+        return (1, value)
+    return (2, value)
+
+
+class _SqliteBucketMinimums:
+    """
+    A SQLite aggregate that sketches a column's non-NULL values (see
+    `QuantileSketch`) and returns a JSON list of the values that start
+    each of `num_buckets` equal-height buckets.
+    """
+
+    def __init__(self):
+        self.sketch = QuantileSketch(key=_sqlite_sort_key)
+        self.num_buckets = 1
+
+    def step(self, value: Any, num_buckets: int):
+        self.num_buckets = num_buckets
+        if value is not None:
+            self.sketch.add(value)
+
+    def finalize(self) -> str:
+        return json.dumps(self.sketch.ranked_values(
+            _bucket_start_ranks(self.sketch.count, self.num_buckets)))
+
+
+def _sketched_bucket_minimums(
+        connection: sqlalchemy.engine.Connection,
+        query: str,
+        columns: Set[Column],
+        num_buckets: int,
+        parameters: Dict[str, Any]
+) -> Dict[Column, List[Any]]:
+    connection.connection.create_aggregate(
+        'datools_bucket_minimums', 2, _SqliteBucketMinimums)
+    ordered_columns = tuple(columns)
+    clauses = [
+        f'datools_bucket_minimums({quote(connection, column.name)}, '
+        f':datools_num_buckets) AS bucket_minimums_{index}'
+        for index, column in enumerate(ordered_columns)]
+    results = execute_query(
+        connection, f'SELECT {", ".join(clauses)} FROM ({query}) AS query',
+        {**parameters, 'datools_num_buckets': num_buckets})
+    row = list(results)[0]
+    results.close()
+    return {column: json.loads(row[f'bucket_minimums_{index}'])
+            for index, column in enumerate(ordered_columns)}
+
+
+def _quantile_bucket_minimums(
+        connection: sqlalchemy.engine.Connection,
+        query: str,
+        columns: Set[Column],
+        num_buckets: int,
+        parameters: Dict[str, Any]
+) -> Dict[Column, List[Any]]:
+    """
+    Computes every column's bucket minimums with discrete percentiles in
+    a single aggregate pass over `query`. Bucket `i` starts at fraction
+    `i / num_buckets` of a column's values, which doesn't depend on how
+    many values there are. The fractions are nudged up by
+    `PERCENTILE_OFFSET` so that floating point error doesn't round a
+    bucket's start down to the last value of the bucket before it.
+    """
+    ordered_columns = tuple(columns)
+    parameters = dict(parameters)
+    percentiles: List[str] = []
+    for bucket in range(num_buckets):
+        name = f'datools_percentile_{bucket}'
+        parameters[name] = bucket / num_buckets + PERCENTILE_OFFSET
+        percentiles.append(f'CAST(:{name} AS DOUBLE PRECISION)')
+    clauses = [
+        f'COUNT({quote(connection, column.name)}) AS count_{index}, '
+        f'percentile_disc(ARRAY[{", ".join(percentiles)}]) '
+        f'WITHIN GROUP (ORDER BY {quote(connection, column.name)}) '
+        f'AS bucket_minimums_{index}'
+        for index, column in enumerate(ordered_columns)]
+    results = execute_query(
+        connection,
+        f'SELECT {", ".join(clauses)} FROM ({query}) AS query',
+        parameters)
+    row = list(results)[0]
+    results.close()
+    return {column: (row[f'bucket_minimums_{index}']
+                     if row[f'count_{index}'] else [])
+            for index, column in enumerate(ordered_columns)}
+
+
+def _weighted_bucket_minimums(
+        weighted_values: List[Tuple[Any, float]],
+        num_buckets: int
+) -> List[Any]:
+    """
+    The value that starts each of `num_buckets` equal-height buckets of
+    `weighted_values`, a list of (value, weight) pairs in which each
+    value stands in for a `weight` fraction of the rows.
+    """
+    weighted_values = sorted(
+        weighted_values, key=lambda weighted_value: weighted_value[0])
+    total_weight = sum(weight for _, weight in weighted_values)
+    minimums: List[Any] = []
+    seen = 0.0
+    for value, weight in weighted_values:
+        seen += weight
+        while (len(minimums) < num_buckets
+               and len(minimums) * total_weight / num_buckets < seen):
+            minimums.append(value)
+    return minimums or [weighted_values[0][0]]
+
+
+def _planner_bucket_minimums(
+        statistics: _PlannerStatistics,
+        num_buckets: int
+) -> Optional[List[Any]]:
+    """
+    Approximates equal-height buckets from a column's most common
+    values and their frequencies, and a histogram that splits the
+    remaining values into bins that each hold an equal fraction of
+    them. Returns None if there are neither.
+    """
+    weighted_values = list(zip(
+        statistics.most_common_values or [],
+        statistics.most_common_frequencies or []))
+    bounds = statistics.histogram_bounds or []
+    if len(bounds) > 1:
+        histogram_fraction = max(
+            1.0 - statistics.null_fraction
+            - sum(statistics.most_common_frequencies or []), 0.0)
+        weighted_values += [
+            (bound, histogram_fraction / (len(bounds) - 1))
+            for bound in bounds[:-1]]
+    if not weighted_values:
+        return None
+    return _weighted_bucket_minimums(weighted_values, num_buckets)
+
+
+def planner_range_valued_statistics(
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        columns: Set[Column],
+        num_buckets: int
+) -> Dict[Column, RangeValuedStatistics]:
+    """
+    Approximates the range-valued statistics of those of `columns` that
+    the database planner has statistics for, without scanning `query`.
+    """
+    statistics: Dict[Column, RangeValuedStatistics] = {}
+    for column, planner_statistics in _planner_statistics(
+            engine, query, columns).items():
+        bucket_minimums = _planner_bucket_minimums(
+            planner_statistics, num_buckets)
+        if bucket_minimums is not None:
+            statistics[column] = RangeValuedStatistics(
+                sorted(set(bucket_minimums)),
+                source=StatisticsSource.CATALOG)
     return statistics
 
 
 def range_valued_statistics(
-        engine: sqlalchemy.engine.Engine,
+        engine: sqlalchemy.engine.Connectable,
         query: str,
         columns: Set[Column],
-        num_buckets: int = 3
+        num_buckets: int = 3,
+        source: StatisticsSource = StatisticsSource.SCAN,
+        parameters: Optional[Dict[str, Any]] = None
 ) -> List[Tuple[Column, RangeValuedStatistics]]:
-    bucket_clauses: List[str] = []
-    first_clauses: List[str] = []
-    for column in columns:
-        bucket_clauses.append(
-            f'{column.name}, '
-            f'NTILE({num_buckets}) OVER (ORDER BY {column.name} ASC) '
-            f'AS {column.name}_bucket')
-        first_clauses.append(
-            f'first_value({column.name}) OVER '
-            f'(PARTITION BY {column.name}_bucket '
-            f' ORDER BY {column.name} ASC '
-            f' RANGE BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) '
-            f'AS {column.name}_bucket_value')
+    """
+    Splits the non-NULL values of each of `columns` into `num_buckets`
+    equal-height buckets, and returns the smallest value in each.
+    `parameters` are bound to `query`'s `:name` parameters.
 
+    Each column's boundaries are computed with aggregates over `query`
+    rather than by ranking its rows: discrete percentiles on databases
+    that support them, and a streaming quantile sketch on SQLite
+    (see `datools.sketches.QuantileSketch`). With
+    `StatisticsSource.CATALOG`, they are instead approximated from the
+    database planner's statistics where it has them (see
+    `set_valued_statistics`).
+    """
+    if not columns:
+        return []
+    statistics = (
+        planner_range_valued_statistics(engine, query, columns, num_buckets)
+        if source == StatisticsSource.CATALOG else {})
+    scanned_columns = {column for column in columns
+                       if column not in statistics}
+    if scanned_columns:
+        with pinned_connection(engine) as connection:
+            if connection.engine.url.get_backend_name() == 'sqlite':
+                column_values = _sketched_bucket_minimums(
+                    connection, query, scanned_columns, num_buckets,
+                    parameters or {})
+            else:
+                column_values = _quantile_bucket_minimums(
+                    connection, query, scanned_columns, num_buckets,
+                    parameters or {})
+    for column in scanned_columns:
+        # Some engines (e.g., SQLite) happily store strings in
+        # numeric columns, so we have to be a bit defensive of
+        # the values we get back.
+        values = {value for value in column_values[column]
+                  if not value == ''}
+        statistics[column] = RangeValuedStatistics(sorted(values))
+    return [(column, statistics[column]) for column in columns]
+
+
+def equi_width_statistics(
+        engine: sqlalchemy.engine.Connectable,
+        query: str,
+        columns: Set[Column],
+        num_buckets: int = 3,
+        parameters: Optional[Dict[str, Any]] = None
+) -> List[Tuple[Column, RangeValuedStatistics]]:
+    """
+    Splits the range between the smallest and largest value of each of
+    `columns` into `num_buckets` buckets of equal width, and returns
+    the smallest value in each. Only numeric columns can be split this
+    way. `parameters` are bound to `query`.
+    """
     statistics: List[Tuple[Column, RangeValuedStatistics]] = []
-    if bucket_clauses:
-        results = engine.execute(
-            f'WITH query AS ( '
-            f'{query}'
-            f'), '
-            f'buckets AS ( '
-            f'SELECT {", ".join(bucket_clauses)} '
-            f'FROM query '
-            f')'
-            f'SELECT {", ".join(first_clauses)} '
-            f'FROM buckets ')
-        # The output of the window function is the number of rows in the
-        # input rather than the number of range buckets. Because we have a
-        # single query across multiple columns, we can't `GROUP BY
-        # column_name_bucket` and get the `MIN` NTILE value for each
-        # bucket. Since sqlite doesn't support CUBE/ROLLUP/GROUPING SETS,
-        # we do this grouping manually by creating a `set` of the
-        # `first_value` for each bucket.
-        column_values: Dict[Column, Set[Any]] = defaultdict(set)
-        for row in results:
-            for column in columns:
-                value = row[f'{column.name}_bucket_value']
-                # Some engines (e.g., SQLite) happily store strings in
-                # numeric columns, so we have to be a bit defensive of
-                # the values we get back.
-                if column is not None and not value == '':
-                    column_values[column].add(value)
-        results.close()
-        for column in columns:
-            statistics.append((
-                column,
-                RangeValuedStatistics(sorted(column_values[column]))))
+    if not columns:
+        return statistics
+    ordered_columns = tuple(columns)
+    clauses = [f'MIN({quote(engine, column.name)}) AS minimum_{index}, '
+               f'MAX({quote(engine, column.name)}) AS maximum_{index}'
+               for index, column in enumerate(ordered_columns)]
+    results = execute_query(
+        engine, f'SELECT {", ".join(clauses)} FROM ({query}) AS query',
+        parameters)
+    row = list(results)[0]
+    results.close()
+    for index, column in enumerate(ordered_columns):
+        minimum = row[f'minimum_{index}']
+        maximum = row[f'maximum_{index}']
+        if minimum is None:
+            statistics.append((column, RangeValuedStatistics([])))
+            continue
+        if not all(isinstance(value, NUMERIC_TYPES)
+                   for value in (minimum, maximum)):
+            raise DatoolsError(
+                f'Column {column.name} is not numeric, so it can not be '
+                f'split into buckets of equal width')
+        width = (maximum - minimum) / num_buckets
+        bucket_minimums = (
+            [minimum + bucket * width for bucket in range(num_buckets)]
+            if width else [minimum])
+        statistics.append((
+            column, RangeValuedStatistics(bucket_minimums, width)))
     return statistics
 
 
@@ -164,23 +680,43 @@ def column_statistics(
         engine: sqlalchemy.engine.Engine,
         table: Table,
         columns_to_ignore: Set[Column],
+        catalog: Optional['StatisticsCatalog'] = None,
+        source: StatisticsSource = StatisticsSource.SCAN,
+        approximate: bool = False
 ) -> Dict[Column, List[ColumnStatistics]]:
+    """
+    Computes set-valued statistics for `table`'s categorical columns and
+    range-valued statistics for its ordered ones. If `catalog` is
+    provided, statistics are reused from (or stored in) it for as long
+    as `table` is unchanged. `source` is passed on to
+    `set_valued_statistics` and `range_valued_statistics`, and
+    `approximate` to `set_valued_statistics`.
+    """
     metadata = sqlalchemy.MetaData()
     table_metadata = sqlalchemy.Table(
         table.name, metadata, autoload_with=engine)
     candidate_columns = [column for column in table_metadata.columns
                          if Column(column.name) not in columns_to_ignore]
     statistics: Dict[Column, List[ColumnStatistics]] = defaultdict(list)
-    for column, set_statistic in set_valued_statistics(
+    compute_set_valued = (
+        set_valued_statistics if catalog is None
+        else catalog.set_valued_statistics)
+    compute_range_valued = (
+        range_valued_statistics if catalog is None
+        else catalog.range_valued_statistics)
+    relation = f'SELECT * FROM {quote(engine, table.name)}'
+    for column, set_statistic in compute_set_valued(
             engine,
-            f'SELECT * FROM {table.name}',
+            relation,
             {Column(column.name) for column in candidate_columns if
-             type(column.type.as_generic()) in SET_VALUED_TYPES}):
+             type(column.type.as_generic()) in SET_VALUED_TYPES},
+            source=source, approximate=approximate):
         statistics[column].append(set_statistic)
-    for column, range_statistic in range_valued_statistics(
+    for column, range_statistic in compute_range_valued(
             engine,
-            f'SELECT * FROM {table.name}',
+            relation,
             {Column(column.name) for column in candidate_columns if
-             type(column.type.as_generic()) in RANGE_VALUED_TYPES}):
+             type(column.type.as_generic()) in RANGE_VALUED_TYPES},
+            source=source):
         statistics[column].append(range_statistic)
     return statistics
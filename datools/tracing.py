@@ -0,0 +1,210 @@
+import sqlalchemy
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dataclasses import field
+from time import perf_counter
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import TypeVar
+
+
+# Only statements that read data are explained, since EXPLAIN ANALYZE
+# executes the statement it explains.
+EXPLAINED_STATEMENT_PREFIXES = ('SELECT', 'WITH')
+EXPLAIN_ANALYZE_BACKENDS = {'duckdb', 'postgresql'}
+RowType = TypeVar('RowType')
+
+
+@dataclass
+class StatementTrace:
+    """
+    A SQL statement that ran during a phase. `seconds` is how long the
+    database took to execute it, not counting fetching its results, and
+    `rows` counts the rows fetched from it so far where datools counts
+    them (see `Tracer.fetched`). `plan` holds its
+    `EXPLAIN ANALYZE` output if the tracer was asked to record it.
+    """
+    statement: str
+    phase: Optional[str]
+    seconds: float = 0.0
+    rows: int = 0
+    plan: Optional[str] = None
+
+
+@dataclass
+class PhaseTrace:
+    """A named phase of work, and the statements it ran."""
+    name: str
+    seconds: float = 0.0
+    statements: List[StatementTrace] = field(default_factory=list)
+
+
+class Tracer:
+    """
+    Records how long each phase of an operation like
+    `datools.explanations.diff` takes, along with every SQL statement
+    it runs, how long the statement took to execute, and how many rows
+    were fetched from it. Pass a `Tracer` to an operation's `tracer`
+    parameter, and read `phases` (or `statements`) once it returns.
+
+    `on_statement` is called with each statement as it is executed, and
+    `on_phase` with each phase as it ends. If `explain_analyze` is True,
+    each statement that reads data is first run with `EXPLAIN ANALYZE`
+    on PostgreSQL and DuckDB, and its plan is recorded. This runs each
+    such statement twice.
+    """
+
+    def __init__(
+            self,
+            explain_analyze: bool = False,
+            on_statement: Optional[Callable[[StatementTrace], None]] = None,
+            on_phase: Optional[Callable[[PhaseTrace], None]] = None):
+        self.explain_analyze = explain_analyze
+        self.on_statement = on_statement
+        self.on_phase = on_phase
+        self.phases: List[PhaseTrace] = []
+        self.statements: List[StatementTrace] = []
+        self._open_phases: List[PhaseTrace] = []
+        self._start_time = 0.0
+        self._plan: Optional[str] = None
+        self._statement: Optional[StatementTrace] = None
+        self._explaining = False
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[PhaseTrace]:
+        """
+        Records the work done in the `with` block as phase `name`.
+        Statements run in nested phases are recorded in the innermost
+        one.
+        """
+        phase = PhaseTrace(name)
+        self.phases.append(phase)
+        self._open_phases.append(phase)
+        start = perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds = perf_counter() - start
+            self._open_phases.pop()
+            if self.on_phase is not None:
+                self.on_phase(phase)
+
+    def fetched(self, num_rows: int) -> None:
+        """
+        Counts `num_rows` rows as fetched from the statement that ran
+        last. SQLAlchemy has no event for fetching rows, so datools calls
+        this where it fetches row counts, rows to count in process, and
+        explanations. Rows fetched elsewhere (e.g., statistics) aren't
+        counted.
+        """
+        if self._statement is not None:
+            self._statement.rows += num_rows
+
+    @contextmanager
+    def listen(
+            self, engine: sqlalchemy.engine.Connectable) -> Iterator[None]:
+        """
+        Records the statements run on `engine` in the `with` block.
+        Connections should be opened inside the block, since they only
+        see event listeners that their engine had when they opened.
+        """
+        sqlalchemy.event.listen(
+            engine, 'before_cursor_execute', self._before_cursor_execute)
+        sqlalchemy.event.listen(
+            engine, 'after_cursor_execute', self._after_cursor_execute)
+        try:
+            yield
+        finally:
+            sqlalchemy.event.remove(
+                engine, 'before_cursor_execute', self._before_cursor_execute)
+            sqlalchemy.event.remove(
+                engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _before_cursor_execute(
+            self, connection, cursor, statement, parameters, context,
+            executemany):
+        if self._explaining:
+            return
+        self._plan = None
+        if (self.explain_analyze
+                and not executemany
+                and connection.engine.url.get_backend_name()
+                in EXPLAIN_ANALYZE_BACKENDS
+                and statement.lstrip().upper().startswith(
+                    EXPLAINED_STATEMENT_PREFIXES)):
+            self._explaining = True
+            try:
+                results = connection.exec_driver_sql(
+                    f'EXPLAIN ANALYZE {statement}', parameters)
+                self._plan = '\n'.join(
+                    str(row[-1]) for row in results.fetchall())
+            finally:
+                self._explaining = False
+        self._start_time = perf_counter()
+
+    def _after_cursor_execute(
+            self, connection, cursor, statement, parameters, context,
+            executemany):
+        if self._explaining:
+            return
+        phase = self._open_phases[-1] if self._open_phases else None
+        trace = StatementTrace(
+            statement, phase.name if phase else None,
+            perf_counter() - self._start_time, plan=self._plan)
+        self.statements.append(trace)
+        if phase is not None:
+            phase.statements.append(trace)
+        self._statement = trace
+        if self.on_statement is not None:
+            self.on_statement(trace)
+
+
+@contextmanager
+def traced_phase(tracer: Optional[Tracer], name: str) -> Iterator[None]:
+    """Records phase `name` with `tracer`, if there is one."""
+    if tracer is None:
+        yield
+        return
+    with tracer.phase(name):
+        yield
+
+
+@contextmanager
+def listening(
+        tracer: Optional[Tracer],
+        engine: sqlalchemy.engine.Connectable) -> Iterator[None]:
+    """Records statements run on `engine` with `tracer`, if there is one."""
+    if tracer is None:
+        yield
+        return
+    with tracer.listen(engine):
+        yield
+
+
+def count_fetched(tracer: Optional[Tracer], num_rows: int) -> None:
+    """Counts `num_rows` fetched rows with `tracer`, if there is one."""
+    if tracer is not None:
+        tracer.fetched(num_rows)
+
+
+def counted_rows(
+        tracer: Optional[Tracer], rows: Iterable[RowType]
+) -> Iterable[RowType]:
+    """
+    Yields `rows` as they are fetched, counting them with `tracer`, if
+    there is one.
+    """
+    if tracer is None:
+        return rows
+    return _counted_rows(tracer, rows)
+
+
+def _counted_rows(
+        tracer: Tracer, rows: Iterable[RowType]) -> Iterator[RowType]:
+    for row in rows:
+        tracer.fetched(1)
+        yield row
@@ -13,6 +13,7 @@ with open('HISTORY.md') as history_file:
 requirements = [
     'Click>=7.0',
     'dataclasses; python_version<"3.7"',
+    'numpy>=1.19',
     'sqlalchemy==1.4.17',
     'tabulate==0.9.0',
 ]
@@ -42,6 +43,10 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={
+        'arrow': ['pyarrow'],
+        'pandas': ['pandas'],
+    },
     license="Apache Software License 2.0",
     long_description=readme + '\n\n' + history,
     long_description_content_type='text/markdown',
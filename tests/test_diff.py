@@ -1,15 +1,42 @@
 #!/usr/bin/env python
 
+import pickle
+import sqlalchemy
+
+
+from datetime import datetime
+from datetime import timedelta
+
 from pytest import approx
+from pytest import importorskip
+from pytest import skip
 from sqlalchemy.engine import Engine
 
+from datools.models import AdaptiveRanges
 from datools.models import Column
 from datools.models import Constant
 from datools.models import Explanation
+from datools.models import GroupingSetsStrategy
 from datools.models import Operator
 from datools.models import Predicate
+from datools.models import RangeBucketing
+from datools.models import Sample
+from datools.explanations import ExplanationFrame
+from datools.explanations import IncrementalDiff
+from datools.explanations import _diff_query
+from datools.explanations import build_count_cube
+from datools.explanations import compile_diff
+from datools.explanations import compile_diff_by_condition
 from datools.explanations import diff
+from datools.explanations import diff_by_condition
+from datools.explanations import diff_by_segment
+from datools.explanations import diff_by_window
+from datools.explanations import diff_frame
+from datools.explanations import iter_diff
+from datools.sqlalchemy_utils import query_rows
+from datools.tracing import Tracer
 from .fixtures import generate_scorpion_testdb
+from .fixtures import generate_synthetic_testdb
 
 
 def test_diff(db_engine: Engine):
@@ -32,3 +59,660 @@ def test_diff(db_engine: Engine):
         Explanation(
             (Predicate(Column('sensor_id'), Operator.EQUALS, Constant('3')), ),
             risk_ratio=5 + (1.0 / 3))])
+
+
+def test_diff_max_order(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    candidates = diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        {Column('created_at'), Column('sensor_id'), Column('voltage'),
+         Column('humidity')},
+        {Column('voltage'), Column('humidity')},
+        0.5,
+        2.0,
+        2)
+    assert(candidates == [
+        Explanation(
+            (Predicate(
+                Column('voltage'), Operator.EQUALS, Constant(approx(2.3))), ),
+            risk_ratio=9.0),
+        Explanation(
+            (Predicate(Column('sensor_id'), Operator.EQUALS, Constant('3')),
+             Predicate(
+                 Column('voltage'), Operator.EQUALS, Constant(approx(2.3)))),
+            risk_ratio=9.0),
+        Explanation(
+            (Predicate(Column('sensor_id'), Operator.EQUALS, Constant('3')), ),
+            risk_ratio=5 + (1.0 / 3))])
+
+
+def test_diff_by_condition(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    candidates = diff_by_condition(
+        db_engine,
+        'SELECT * FROM sensor_readings',
+        'temperature > 50',
+        {Column('created_at'), Column('sensor_id'), Column('voltage'),
+         Column('humidity')},
+        {Column('voltage'), Column('humidity')},
+        0.05,
+        2.0,
+        1)
+    assert(candidates == [
+        Explanation(
+            (Predicate(
+                Column('voltage'), Operator.EQUALS, Constant(approx(2.3))), ),
+            risk_ratio=9.0),
+        Explanation(
+            (Predicate(Column('sensor_id'), Operator.EQUALS, Constant('3')), ),
+            risk_ratio=5 + (1.0 / 3))])
+
+
+def test_diff_materialize(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    on_column_values = {Column('created_at'), Column('sensor_id'),
+                        Column('voltage'), Column('humidity')}
+    on_column_ranges = {Column('voltage'), Column('humidity')}
+    # Explanations with the same risk ratio can come back in any order.
+    expected = sorted(diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        on_column_values, on_column_ranges, 0.05, 1.0, 2), key=repr)
+    assert(sorted(diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        on_column_values, on_column_ranges, 0.05, 1.0, 2,
+        materialize=True), key=repr) == expected)
+    assert(sorted(diff_by_condition(
+        db_engine,
+        'SELECT * FROM sensor_readings',
+        'temperature > 50',
+        on_column_values, on_column_ranges, 0.05, 1.0, 2,
+        materialize=True), key=repr) == expected)
+
+
+def test_diff_in_process(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    on_column_values = {Column('created_at'), Column('sensor_id'),
+                        Column('voltage'), Column('humidity')}
+    on_column_ranges = {Column('voltage'), Column('humidity')}
+    sql_strategy = (GroupingSetsStrategy.UNION_ALL
+                    if db_engine.url.get_backend_name() == 'sqlite'
+                    else GroupingSetsStrategy.NATIVE)
+    # Explanations with the same risk ratio can come back in any order.
+    expected = sorted(diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        on_column_values, on_column_ranges, 0.05, 1.0, 3,
+        strategy=sql_strategy), key=repr)
+    assert(sorted(diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        on_column_values, on_column_ranges, 0.05, 1.0, 3,
+        strategy=GroupingSetsStrategy.IN_PROCESS), key=repr) == expected)
+    assert(sorted(diff_by_condition(
+        db_engine,
+        'SELECT * FROM sensor_readings',
+        'temperature > 50',
+        on_column_values, on_column_ranges, 0.05, 1.0, 3,
+        strategy=GroupingSetsStrategy.IN_PROCESS), key=repr) == expected)
+    assert(sorted(diff_by_condition(
+        db_engine,
+        'SELECT * FROM sensor_readings',
+        'temperature > 50',
+        on_column_values, on_column_ranges, 0.05, 1.0, 3,
+        strategy=GroupingSetsStrategy.UNPIVOT), key=repr) == expected)
+
+
+def test_diff_range_bucketing(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    test_relation = 'SELECT * FROM sensor_readings WHERE temperature > 50'
+    control_relation = (
+        'SELECT * FROM sensor_readings WHERE temperature <= 50')
+    on_columns = {Column('voltage'), Column('humidity')}
+    # Explanations with the same risk ratio can come back in any order.
+    expected = sorted(diff(
+        db_engine, test_relation, control_relation, on_columns, on_columns,
+        0.05, 1.0, 2, num_range_buckets=50), key=repr)
+    assert(sorted(diff(
+        db_engine, test_relation, control_relation, on_columns, on_columns,
+        0.05, 1.0, 2, num_range_buckets=50,
+        range_bucketing=RangeBucketing.BOUNDARY_JOIN), key=repr) == expected)
+
+    # Equal-width buckets differ from the default equal-height ones, so
+    # we check that rows were assigned to the bucket their predicates
+    # describe.
+    generate_synthetic_testdb(db_engine)
+    test_relation = 'SELECT * FROM synthetic_data WHERE bucket_unique_int >= 7'
+    candidates = diff_by_condition(
+        db_engine, 'SELECT * FROM synthetic_data', 'bucket_unique_int >= 7',
+        set(), {Column('unique_float'), Column('bucket_unique_float'),
+                Column('unique_int')},
+        0.05, 1.0, 2, num_range_buckets=10,
+        range_bucketing=RangeBucketing.EQUI_WIDTH)
+    assert(candidates)
+    for candidate in candidates:
+        conditions = ' AND '.join(
+            predicate.to_sql() for predicate in candidate.predicates)
+        assert(query_rows(
+            db_engine, f'{test_relation} AND {conditions}')
+            == candidate.test_support)
+
+
+def test_diff_adaptive_ranges(db_engine: Engine):
+    # A minute-long reading fails every 100 minutes, and for each of
+    # the 50 minutes of an incident that starts at minute 6000.
+    readings = sqlalchemy.Table(
+        'readings', sqlalchemy.MetaData(),
+        sqlalchemy.Column('minute', sqlalchemy.Integer),
+        sqlalchemy.Column('failed', sqlalchemy.Integer))
+    readings.create(db_engine)
+    db_engine.execute(readings.insert(), [
+        {'minute': minute,
+         'failed': int(6000 <= minute < 6050 or minute % 100 == 0)}
+        for minute in range(10000)])
+
+    # Equal-height buckets that are fine enough to isolate the incident
+    # are too small to meet the minimum support.
+    assert(diff_by_condition(
+        db_engine, 'SELECT * FROM readings', 'failed = 1',
+        set(), {Column('minute')}, 0.05, 10.0, 1,
+        num_range_buckets=64) == [])
+    candidates = diff_by_condition(
+        db_engine, 'SELECT * FROM readings', 'failed = 1',
+        set(), {Column('minute')}, 0.05, 10.0, 1,
+        adaptive_ranges=AdaptiveRanges())
+    # Explanations with the same risk ratio can come back in any order.
+    assert(sorted(((candidate.predicates, candidate.risk_ratio)
+                   for candidate in candidates), key=repr) == [
+        ((Predicate(Column('minute'), Operator.GTEQ, Constant(6014)),
+          Predicate(Column('minute'), Operator.LT, Constant(6023))),
+         approx(70.87234042553192)),
+        ((Predicate(Column('minute'), Operator.GTEQ, Constant(6023)),
+          Predicate(Column('minute'), Operator.LT, Constant(6032))),
+         approx(70.87234042553192)),
+        ((Predicate(Column('minute'), Operator.GTEQ, Constant(6032)),
+          Predicate(Column('minute'), Operator.LT, Constant(6041))),
+         approx(70.87234042553192)),
+    ])
+
+
+def test_diff_sample(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    candidates = diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        {Column('created_at'), Column('sensor_id'), Column('voltage'),
+         Column('humidity')},
+        {Column('voltage'), Column('humidity')},
+        0.05,
+        2.0,
+        1,
+        sample=Sample(rows=100))
+    # A sample that's larger than the relations contains every row.
+    assert(candidates == [
+        Explanation(
+            (Predicate(
+                Column('voltage'), Operator.EQUALS, Constant(approx(2.3))), ),
+            risk_ratio=9.0),
+        Explanation(
+            (Predicate(Column('sensor_id'), Operator.EQUALS, Constant('3')), ),
+            risk_ratio=5 + (1.0 / 3))])
+    assert([(candidate.test_support, candidate.control_support,
+             candidate.test_support_interval)
+            for candidate in candidates] == [
+                (2.0, 0.0, (2.0, 2.0)), (2.0, 1.0, (2.0, 2.0))])
+    for candidate in candidates:
+        assert(candidate.risk_ratio_interval is not None)
+        lower, upper = candidate.risk_ratio_interval
+        assert(lower < candidate.risk_ratio < upper)
+
+
+def test_diff_sample_fraction(db_engine: Engine):
+    # Readings from sensor a fail half the time, and the others 5% of
+    # the time.
+    readings = sqlalchemy.Table(
+        'readings', sqlalchemy.MetaData(),
+        sqlalchemy.Column('sensor', sqlalchemy.String),
+        sqlalchemy.Column('failed', sqlalchemy.Integer))
+    readings.create(db_engine)
+    db_engine.execute(readings.insert(), [
+        {'sensor': sensor,
+         'failed': int(reading % (2 if sensor == 'a' else 20) == 0)}
+        for sensor in ('a', 'b', 'c', 'd')
+        for reading in range(1000)])
+    exact = {repr(candidate.predicates): candidate
+             for candidate in diff_by_condition(
+                 db_engine, 'SELECT * FROM readings', 'failed = 1',
+                 {Column('sensor')}, set(), 0.01, 0.0, 1)}
+    sampled = diff_by_condition(
+        db_engine, 'SELECT * FROM readings', 'failed = 1',
+        {Column('sensor')}, set(), 0.01, 0.0, 1,
+        sample=Sample(fraction=0.5, seed=3))
+    assert({repr(candidate.predicates) for candidate in sampled}
+           == exact.keys())
+    for candidate in sampled:
+        expected = exact[repr(candidate.predicates)]
+        # Supports are counted on half of the rows and scaled back up.
+        assert(candidate.test_support is not None)
+        assert(expected.test_support is not None)
+        assert((candidate.test_support * 0.5).is_integer())
+        assert(candidate.test_support == approx(
+            expected.test_support, rel=0.5))
+        assert(candidate.test_support_interval is not None)
+        assert(candidate.risk_ratio_interval is not None)
+        lower, upper = candidate.test_support_interval
+        assert(lower <= expected.test_support <= upper)
+        lower, upper = candidate.risk_ratio_interval
+        assert(lower <= expected.risk_ratio <= upper)
+
+
+def test_diff_plan(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    on_column_values = {Column('created_at'), Column('sensor_id'),
+                        Column('voltage'), Column('humidity')}
+    on_column_ranges = {Column('voltage'), Column('humidity')}
+    plan = compile_diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > :threshold',
+        'SELECT * FROM sensor_readings WHERE temperature <= :threshold',
+        on_column_values, on_column_ranges, 2, {'threshold': 50})
+    condition_plan = compile_diff_by_condition(
+        db_engine, 'SELECT * FROM sensor_readings',
+        'temperature > :threshold',
+        on_column_values, on_column_ranges, 2, {'threshold': 50})
+    for min_support, min_risk_ratio in ((0.05, 1.0), (0.5, 2.0)):
+        # Explanations with the same risk ratio can come back in any
+        # order.
+        expected = sorted(diff(
+            db_engine,
+            'SELECT * FROM sensor_readings WHERE temperature > 50',
+            'SELECT * FROM sensor_readings WHERE temperature <= 50',
+            on_column_values, on_column_ranges, min_support,
+            min_risk_ratio, 2), key=repr)
+        assert(sorted(plan.execute(
+            db_engine, min_support, min_risk_ratio, {'threshold': 50}),
+            key=repr) == expected)
+        assert(sorted(condition_plan.execute(
+            db_engine, min_support, min_risk_ratio, {'threshold': 50}),
+            key=repr) == expected)
+
+    # Other parameters reuse the range buckets the plan was compiled
+    # with.
+    explanations = plan.execute(db_engine, 0.05, 1.0, {'threshold': 90})
+    assert(Explanation(
+        (Predicate(Column('voltage'), Operator.EQUALS, Constant(approx(2.3))),
+         ), risk_ratio=4.5) in explanations)
+    assert(any(
+        explanation.predicates == (
+            Predicate(Column('humidity'), Operator.LT, Constant(0.5)), )
+        and explanation.risk_ratio == approx(1.2)
+        for explanation in explanations))
+    assert(sorted(explanations, key=repr) == sorted(
+        condition_plan.execute(db_engine, 0.05, 1.0, {'threshold': 90}),
+        key=repr))
+
+
+def test_diff_by_segment(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    # In the west, the cold readings are the anomalies.
+    db_engine.execute('DROP TABLE IF EXISTS segmented_readings')
+    db_engine.execute(
+        "CREATE TABLE segmented_readings AS "
+        "SELECT 'east' AS region, sensor_id, voltage, humidity, "
+        "temperature FROM sensor_readings "
+        "UNION ALL "
+        "SELECT 'west' AS region, sensor_id, voltage, humidity, "
+        "130 - temperature AS temperature FROM sensor_readings "
+        "UNION ALL "
+        "SELECT CAST(NULL AS TEXT) AS region, sensor_id, voltage, "
+        "humidity, temperature FROM sensor_readings "
+        "WHERE sensor_id <> '1'")
+    on_column_values = {Column('sensor_id'), Column('voltage'),
+                        Column('humidity')}
+    segments = diff_by_segment(
+        db_engine, 'SELECT * FROM segmented_readings', Column('region'),
+        'temperature > 50', on_column_values, set(), 0.05, 1.0, 3)
+    assert set(segments) == {'east', 'west', None}
+    for segment, condition in (('east', "region = 'east'"),
+                               ('west', "region = 'west'"),
+                               (None, 'region IS NULL')):
+        # Explanations with the same risk ratio can come back in any
+        # order, and risk ratios can be rounded differently (e.g., on
+        # PostgreSQL).
+        assert(sorted(((explanation.predicates, explanation.risk_ratio)
+                       for explanation in segments[segment]),
+                      key=lambda pair: repr(pair[0]))
+               == sorted(((explanation.predicates,
+                           approx(explanation.risk_ratio))
+                          for explanation in diff_by_condition(
+                              db_engine,
+                              'SELECT * FROM segmented_readings '
+                              f'WHERE {condition}',
+                              'temperature > 50', on_column_values, set(),
+                              0.05, 1.0, 3)), key=lambda pair: repr(pair[0])))
+        assert([explanation.risk_ratio
+                for explanation in segments[segment]] == sorted(
+                    (explanation.risk_ratio
+                     for explanation in segments[segment]), reverse=True))
+
+    # Range buckets are shared by all segments.
+    segments = diff_by_segment(
+        db_engine, 'SELECT * FROM segmented_readings', Column('region'),
+        'temperature > 50', {Column('sensor_id')}, {Column('voltage')},
+        0.05, 2.0, 1)
+    assert(segments['east'] == [
+        Explanation(
+            (Predicate(
+                Column('voltage'), Operator.LT, Constant(approx(2.63))), ),
+            risk_ratio=9.0),
+        Explanation(
+            (Predicate(Column('sensor_id'), Operator.EQUALS, Constant('3')), ),
+            risk_ratio=5 + (1.0 / 3))])
+
+
+def test_diff_by_window(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    on_column_values = {Column('sensor_id'), Column('voltage'),
+                        Column('humidity')}
+    for range_bucketing in (RangeBucketing.CASE,
+                            RangeBucketing.BOUNDARY_JOIN,
+                            RangeBucketing.EQUI_WIDTH):
+        windows = diff_by_window(
+            db_engine, 'SELECT * FROM sensor_readings',
+            Column('created_at'), timedelta(hours=1), 2, on_column_values,
+            set(), 0.05, 1.0, 2, range_bucketing=range_bucketing)
+        # The first window has no baseline to compare it to.
+        assert set(windows) == {datetime(2021, 5, 5, 12),
+                                datetime(2021, 5, 5, 13)}
+        for window_start, window in windows.items():
+            baseline_start = max(
+                window_start - timedelta(hours=2), datetime(2021, 5, 5, 11))
+            # Explanations with the same risk ratio can come back in any
+            # order.
+            assert(sorted(window, key=repr) == sorted(diff(
+                db_engine,
+                f"SELECT * FROM sensor_readings "
+                f"WHERE created_at >= '{window_start}' "
+                f"AND created_at < '{window_start + timedelta(hours=1)}'",
+                f"SELECT * FROM sensor_readings "
+                f"WHERE created_at >= '{baseline_start}' "
+                f"AND created_at < '{window_start}'",
+                on_column_values, set(), 0.05, 1.0, 2), key=repr))
+    assert(windows[datetime(2021, 5, 5, 12)][0] == Explanation(
+        (Predicate(
+            Column('voltage'), Operator.EQUALS, Constant(approx(2.7))), ),
+        risk_ratio=3.0))
+
+    # Numeric windows have a known width, so `RangeBucketing.EQUI_WIDTH`
+    # assigns them arithmetically.
+    windows_by_bucketing = [
+        diff_by_window(
+            db_engine, 'SELECT * FROM sensor_readings', Column('id'), 4, 1,
+            on_column_values, set(), 0.05, 1.0, 2,
+            range_bucketing=range_bucketing)
+        for range_bucketing in (RangeBucketing.CASE,
+                                RangeBucketing.EQUI_WIDTH)]
+    assert(windows_by_bucketing[0])
+    assert({window_start: sorted(window, key=repr)
+            for window_start, window in windows_by_bucketing[0].items()}
+           == {window_start: sorted(window, key=repr)
+               for window_start, window in windows_by_bucketing[1].items()})
+
+
+def test_diff_by_window_start(db_engine: Engine):
+    # Each hour has 10 rows in group a, and the second hour also has a
+    # spike of 10 rows in group x. Group x was common long before the
+    # first window starts.
+    start = datetime(2021, 5, 5)
+    events = sqlalchemy.Table(
+        'events', sqlalchemy.MetaData(),
+        sqlalchemy.Column('created_at', sqlalchemy.DateTime),
+        sqlalchemy.Column('grp', sqlalchemy.String))
+    events.create(db_engine)
+    db_engine.execute(events.insert(), [
+        {'created_at': start + timedelta(hours=hour, minutes=minute),
+         'grp': grp}
+        for hour, grp, num_rows in ((0, 'a', 10), (1, 'a', 10), (1, 'x', 10),
+                                    (2, 'a', 10), (-5, 'x', 100))
+        for minute in range(num_rows)])
+    windows = diff_by_window(
+        db_engine, 'SELECT * FROM events', Column('created_at'),
+        timedelta(hours=1), 1, {Column('grp')}, set(), 0.05, 1.0, 1,
+        start=start)
+    assert set(windows) == {start + timedelta(hours=1),
+                            start + timedelta(hours=2)}
+    assert windows[start + timedelta(hours=1)][0].predicates == (
+        Predicate(Column('grp'), Operator.EQUALS, Constant('x')), )
+
+
+def test_incremental_diff(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    on_column_values = {Column('created_at'), Column('sensor_id'),
+                        Column('voltage'), Column('humidity')}
+    on_column_ranges = {Column('voltage'), Column('humidity')}
+    state = IncrementalDiff(
+        'SELECT * FROM sensor_readings', 'temperature > 50', Column('id'),
+        on_column_values, on_column_ranges, 2)
+    assert state.refresh(db_engine) == 9
+    assert state.refresh(db_engine) == 0
+    # Explanations with the same risk ratio can come back in any order.
+    for min_support, min_risk_ratio in ((0.05, 1.0), (0.5, 2.0)):
+        assert(sorted(state.explanations(min_support, min_risk_ratio),
+                      key=repr) == sorted(diff_by_condition(
+                          db_engine, 'SELECT * FROM sensor_readings',
+                          'temperature > 50', on_column_values,
+                          on_column_ranges, min_support, min_risk_ratio, 2),
+                          key=repr))
+
+    # Appended rows are counted with the range buckets of the first
+    # refresh, so we compare without them.
+    state = IncrementalDiff(
+        'SELECT * FROM sensor_readings', 'temperature > 50', Column('id'),
+        on_column_values, set(), 3)
+    state.refresh(db_engine)
+    state = pickle.loads(pickle.dumps(state))
+    db_engine.execute(
+        'INSERT INTO sensor_readings '
+        '(created_at, sensor_id, voltage, humidity, temperature) '
+        'SELECT created_at, sensor_id, voltage - 0.1, humidity, '
+        'temperature + 20 FROM sensor_readings')
+    assert state.refresh(db_engine) == 9
+    assert(sorted(state.explanations(0.05, 1.0), key=repr) == sorted(
+        diff_by_condition(
+            db_engine, 'SELECT * FROM sensor_readings', 'temperature > 50',
+            on_column_values, set(), 0.05, 1.0, 3), key=repr))
+    assert (state.num_test_rows, state.num_control_rows) == (11, 7)
+
+
+def test_count_cube(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    relation = ('SELECT *, CASE WHEN temperature > 50 THEN 1 ELSE 0 END '
+                'AS hot FROM sensor_readings')
+    on_column_values = {Column('created_at'), Column('voltage'),
+                        Column('humidity')}
+    cube = build_count_cube(
+        db_engine, relation, on_column_values, set(), 3,
+        dimensions={Column('hot'), Column('sensor_id')})
+    cube = pickle.loads(pickle.dumps(cube))
+    # Diffs with different thresholds, orders, and splits along the
+    # cube's dimensions are answered from the cube. Explanations with
+    # the same risk ratio can come back in any order.
+    for test_condition, min_support, min_risk_ratio, max_order in (
+            ('hot = 1', 0.05, 1.0, 3),
+            ('hot = 1', 0.5, 2.0, 1),
+            ("sensor_id = '3'", 0.2, 1.0, 2)):
+        assert(sorted(cube.diff(
+            db_engine, test_condition, min_support, min_risk_ratio,
+            max_order), key=repr) == sorted(diff_by_condition(
+                db_engine, relation, test_condition, on_column_values,
+                set(), min_support, min_risk_ratio, max_order), key=repr))
+    cube.drop(db_engine)
+
+
+def test_diff_query_hash_join(db_engine: Engine):
+    backend = db_engine.url.get_backend_name()
+    if backend == 'sqlite':
+        skip('SQLite only has nested loop joins')
+    row_numbers = ('SELECT range AS i FROM range(1000000)'
+                   if backend == 'duckdb'
+                   else 'SELECT generate_series(0, 999999) AS i')
+    # A million groups, a tenth of which have a NULL value.
+    for table_name in ('test_groups', 'control_groups'):
+        # Text clauses escape the modulo operator for drivers (e.g.,
+        # psycopg2) that use it to mark parameters.
+        db_engine.execute(sqlalchemy.text(
+            f'CREATE TABLE {table_name} AS '
+            f'SELECT i % 3 AS grouping_id, '
+            f'CASE WHEN i % 10 = 0 THEN NULL ELSE i END AS value, '
+            f'1 AS explanation_size '
+            f'FROM ({row_numbers}) AS row_numbers'))
+        if backend == 'postgresql':
+            db_engine.execute(f'ANALYZE {table_name}')
+    query = _diff_query(
+        db_engine, 'SELECT * FROM test_groups',
+        'SELECT * FROM control_groups', 1000000, 1000000,
+        (Column('value'), ), 1.0)
+    plan = [str(row[-1]) for row in db_engine.execute(f'EXPLAIN {query}')]
+    if backend == 'duckdb':
+        assert any('HASH_JOIN' in line for line in plan)
+        assert not any('NL_JOIN' in line for line in plan)
+    else:
+        # PostgreSQL hashes or sorts on every join condition, rather
+        # than filtering the pairs of rows that match on some of them.
+        conditions = [line for line in plan
+                      if 'Hash Cond' in line or 'Merge Cond' in line]
+        assert len(conditions) == 1 and 'value' in conditions[0]
+        assert not any('Join Filter' in line or 'Nested Loop' in line
+                       for line in plan)
+
+
+def test_diff_bound_parameters(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    # Colons in relations aren't mistaken for parameters.
+    relation = "SELECT *, 'reading :1' AS label FROM sensor_readings"
+    strategy = (GroupingSetsStrategy.UNION_ALL
+                if db_engine.url.get_backend_name() == 'sqlite'
+                else GroupingSetsStrategy.NATIVE)
+    statements = []
+    for min_support, min_risk_ratio in ((0.05, 1.0), (0.5, 2.0)):
+        tracer = Tracer()
+        explanations = diff_by_condition(
+            db_engine, relation, 'temperature > 50',
+            {Column('sensor_id'), Column('label')}, {Column('voltage')},
+            min_support, min_risk_ratio, 2, strategy=strategy,
+            tracer=tracer)
+        assert explanations
+        assert any(predicate.right.value == 'reading :1'
+                   for explanation in explanations
+                   for predicate in explanation.predicates)
+        statements.append([
+            statement.statement for statement in tracer.statements
+            if statement.phase in ('order_1', 'order_2')])
+    # Different thresholds run the same statements.
+    assert len(statements[0]) == 2
+    assert statements[0] == statements[1]
+
+    # Plans only bind the parameters they're given.
+    plan = compile_diff_by_condition(
+        db_engine, relation, 'temperature > :threshold',
+        {Column('sensor_id'), Column('label')}, {Column('voltage')}, 2,
+        {'threshold': 50}, strategy=strategy)
+    assert(sorted(plan.execute(db_engine, 0.05, 1.0, {'threshold': 50}),
+                  key=repr) == sorted(diff_by_condition(
+                      db_engine, relation, 'temperature > 50',
+                      {Column('sensor_id'), Column('label')},
+                      {Column('voltage')}, 0.05, 1.0, 2), key=repr))
+
+
+def test_iter_diff(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    arguments = (
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        {Column('created_at'), Column('sensor_id'), Column('voltage'),
+         Column('humidity')},
+        {Column('voltage'), Column('humidity')}, 0.05, 1.0, 3)
+    expected = diff(db_engine, *arguments)
+    explanations = list(iter_diff(db_engine, *arguments, batch_size=2))
+    risk_ratios = [explanation.risk_ratio for explanation in explanations]
+    assert risk_ratios == sorted(risk_ratios, reverse=True)
+    # Explanations with the same risk ratio can come back in any order.
+    assert sorted(explanations, key=repr) == sorted(expected, key=repr)
+
+    top_explanations = list(iter_diff(db_engine, *arguments, top_k=3))
+    assert ([explanation.risk_ratio for explanation in top_explanations]
+            == risk_ratios[:3])
+    assert all(explanation in expected for explanation in top_explanations)
+
+
+def test_diff_frame(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    arguments = (
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        {Column('created_at'), Column('sensor_id'), Column('voltage'),
+         Column('humidity')},
+        {Column('voltage'), Column('humidity')}, 0.05, 1.0, 3)
+    expected = list(iter_diff(db_engine, *arguments))
+    frame = diff_frame(db_engine, *arguments, batch_size=4)
+    assert len(frame) == len(expected)
+    assert list(frame.risk_ratio) == [
+        explanation.risk_ratio for explanation in expected]
+    # Explanations with the same risk ratio can come back in any order.
+    assert sorted(frame, key=repr) == sorted(expected, key=repr)
+    assert frame[0].test_support == expected[0].test_support
+    assert set(frame.columns()) == {
+        'grouping_set', 'risk_ratio', 'test_support', 'control_support',
+        'created_at', 'sensor_id', 'voltage', 'humidity',
+        'humidity__bucket'}
+
+    assert len(diff_frame(db_engine, *arguments, top_k=0)) == 0
+
+
+def _scorpion_frame(db_engine: Engine) -> ExplanationFrame:
+    generate_scorpion_testdb(db_engine)
+    return diff_frame(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        {Column('created_at'), Column('sensor_id'), Column('voltage'),
+         Column('humidity')},
+        {Column('voltage'), Column('humidity')}, 0.05, 1.0, 3)
+
+
+def test_diff_frame_to_arrow(db_engine: Engine):
+    pyarrow = importorskip('pyarrow')
+    frame = _scorpion_frame(db_engine)
+    table = frame.to_arrow()
+    assert table.column_names == list(frame.columns())
+    assert [table.schema.field(name).type for name in (
+        'grouping_set', 'risk_ratio', 'test_support', 'control_support')] == [
+            pyarrow.int64(), pyarrow.float64(), pyarrow.int64(),
+            pyarrow.int64()]
+    for name, values in frame.columns().items():
+        assert table.column(name).to_pylist() == list(values)
+
+
+def test_diff_frame_to_pandas(db_engine: Engine):
+    importorskip('pandas')
+    frame = _scorpion_frame(db_engine)
+    data_frame = frame.to_pandas()
+    assert list(data_frame.columns) == list(frame.columns())
+    assert [str(data_frame[name].dtype) for name in (
+        'grouping_set', 'risk_ratio', 'test_support', 'control_support')] == [
+            'int64', 'float64', 'int64', 'int64']
+    for name, values in frame.columns().items():
+        # pandas might store missing values as NaN rather than None.
+        missing = list(data_frame[name].isna())
+        assert missing == [value is None for value in values]
+        assert [value for value, is_missing in zip(data_frame[name], missing)
+                if not is_missing] == [
+                    value for value in values if value is not None]
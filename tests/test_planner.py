@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import logging
+
+from sqlalchemy.engine import Engine
+
+from datools.models import Column
+from datools.models import GroupingSetsStrategy
+from datools.planner import plan_grouping_sets
+
+
+def test_plan_grouping_sets(db_engine: Engine, caplog):
+    columns = [Column(f'column_{index}') for index in range(4)]
+    single_set = ((columns[0], ), )
+    many_sets = tuple((column, ) for column in columns) + tuple(
+        (left, right) for index, left in enumerate(columns)
+        for right in columns[index + 1:])
+    distinct_values = {column: 100 for column in columns}
+
+    caplog.set_level(logging.INFO, logger='datools.planner')
+    plans = [
+        plan_grouping_sets(db_engine, 100000, single_set, distinct_values),
+        plan_grouping_sets(db_engine, 100000, many_sets, distinct_values,
+                           100),
+        # Without distinct value estimates, each column might have a
+        # value per row.
+        plan_grouping_sets(db_engine, 10000000, many_sets, {}, 100),
+        # Few groups, but too many rows to encode in memory.
+        plan_grouping_sets(db_engine, 50000000, many_sets, distinct_values,
+                           100),
+        # Costs tie, and few distinct values fit in memory.
+        plan_grouping_sets(
+            db_engine, 5000000,
+            ((columns[0], ), (columns[1], ), (columns[0], columns[1])),
+            {columns[0]: 5, columns[1]: 5}, 100)]
+    if db_engine.url.get_backend_name() == 'sqlite':
+        assert [plan.strategy for plan in plans] == [
+            GroupingSetsStrategy.UNION_ALL,
+            GroupingSetsStrategy.IN_PROCESS,
+            GroupingSetsStrategy.UNION_ALL,
+            GroupingSetsStrategy.UNION_ALL,
+            GroupingSetsStrategy.IN_PROCESS]
+        assert 'groups might not fit in memory' in plans[2].reason
+        assert 'encoded rows might not fit in memory' in plans[3].reason
+        assert set(plans[0].costs) == {
+            GroupingSetsStrategy.UNION_ALL, GroupingSetsStrategy.IN_PROCESS}
+    else:
+        assert all(plan.strategy == GroupingSetsStrategy.NATIVE
+                   for plan in plans)
+    assert [record.getMessage().split(',')[0]
+            for record in caplog.records] == [
+        'Counting 1 grouping sets over 100000 rows with '
+        f'{plans[0].strategy.name}',
+        'Counting 10 grouping sets over 100000 rows with '
+        f'{plans[1].strategy.name}',
+        'Counting 10 grouping sets over 10000000 rows with '
+        f'{plans[2].strategy.name}',
+        'Counting 10 grouping sets over 50000000 rows with '
+        f'{plans[3].strategy.name}',
+        'Counting 3 grouping sets over 5000000 rows with '
+        f'{plans[4].strategy.name}']
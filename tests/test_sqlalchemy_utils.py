@@ -6,8 +6,13 @@ from sqlalchemy.engine import Engine
 from datools.models import Aggregate
 from datools.models import AggregateFunction
 from datools.models import Column
+from datools.models import GroupingSetsStrategy
 from datools.sqlalchemy_utils import grouping_sets_query
+from datools.sqlalchemy_utils import query_columns
+from datools.sqlalchemy_utils import query_rows
+from datools.sqlalchemy_utils import sampled_query
 from .fixtures import generate_scorpion_testdb
+from .fixtures import generate_synthetic_testdb
 from .utils import engine_based_datetime
 
 
@@ -34,6 +39,11 @@ def test_grouping_sets(db_engine: Engine):
     sort_keys = ('grouping_id', 'created_at', 'sensor_id', 'num_rows')
     all_rows = [dict(row) for row in result]
     all_rows.sort(key=itemgetter(*sort_keys))
+    for row in all_rows:
+        grouped_names = {column.name
+                         for column in set_index[row['grouping_id']]}
+        assert(all(row[name] is None
+                   for name in {'created_at', 'sensor_id'} - grouped_names))
 
     def dt(datetime_string):
         return engine_based_datetime(db_engine, datetime_string)
@@ -73,3 +83,57 @@ def test_grouping_sets(db_engine: Engine):
     ]
     expected.sort(key=itemgetter(*sort_keys))
     assert(all_rows == expected)
+
+
+def test_grouping_sets_unpivot(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    sets = (
+        (Column('created_at'), Column('sensor_id')),
+        (Column('sensor_id'),),
+        (),
+    )
+    aggregates = (
+        Aggregate(AggregateFunction.COUNT, Column('*'), Column('num_rows')),
+        Aggregate(AggregateFunction.SUM, Column('temperature'),
+                  Column('total_temperature')))
+    rows = {}
+    for strategy in (GroupingSetsStrategy.UNION_ALL,
+                     GroupingSetsStrategy.UNPIVOT):
+        query, set_index = grouping_sets_query(
+            db_engine, 'SELECT * FROM sensor_readings', sets, aggregates,
+            strategy=strategy)
+        result = db_engine.execute(query)
+        rows[strategy] = sorted((
+            (set_index[row.grouping_id], row.created_at, row.sensor_id,
+             row.num_rows, row.total_temperature)
+            for row in result), key=repr)
+        result.close()
+    assert 'UNION ALL' not in query
+    assert len(rows[GroupingSetsStrategy.UNPIVOT]) == 13
+    assert (rows[GroupingSetsStrategy.UNPIVOT]
+            == rows[GroupingSetsStrategy.UNION_ALL])
+
+
+def test_sampled_query(db_engine: Engine):
+    generate_synthetic_testdb(db_engine)
+    query = sampled_query(
+        db_engine, 'SELECT * FROM synthetic_data', 0.5, seed=1)
+    num_rows = query_rows(db_engine, query)
+    # 171 rows sampled at 50% should leave roughly half of them.
+    assert(40 < num_rows < 130)
+    assert(query_rows(db_engine, query) == num_rows)
+    # Only the sampled query's own columns are returned.
+    assert(query_columns(db_engine, query)
+           == query_columns(db_engine, 'SELECT * FROM synthetic_data'))
+    # Different seeds sample different rows.
+    other_query = sampled_query(
+        db_engine, 'SELECT * FROM synthetic_data', 0.5, seed=2)
+    assert(query_rows(
+        db_engine,
+        f'SELECT * FROM ({query}) AS sample '
+        f'INTERSECT SELECT * FROM ({other_query}) AS other_sample')
+        < num_rows)
+    # Identical rows are sampled independently of each other.
+    query = sampled_query(
+        db_engine, 'SELECT same_string FROM synthetic_data', 0.5, seed=1)
+    assert(40 < query_rows(db_engine, query) < 130)
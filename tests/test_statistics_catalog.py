@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import sqlalchemy
+
+from sqlalchemy.engine import Engine
+
+from datools.explanations import diff
+from datools.models import Column
+from datools.models import Table
+from datools.sqlalchemy_utils import query_rows
+from datools.statistics_catalog import CATALOG_TABLE
+from datools.statistics_catalog import StatisticsCatalog
+from datools.table_statistics import column_statistics
+from datools.table_statistics import RangeValuedStatistics
+from .fixtures import generate_scorpion_testdb
+from .fixtures import generate_synthetic_testdb
+from .utils import execute_and_flush_statistics
+
+
+def test_statistics_catalog_local_file(db_engine: Engine, tmp_path):
+    """Statistics stored in a local SQLite file match freshly computed
+    ones, including their datetimes."""
+    generate_synthetic_testdb(db_engine)
+    catalog = StatisticsCatalog(
+        sqlalchemy.create_engine(f'sqlite:///{tmp_path / "catalog.db"}'))
+    expected = column_statistics(
+        db_engine, Table('synthetic_data'), set())
+    assert column_statistics(
+        db_engine, Table('synthetic_data'), set(), catalog) == expected
+    assert column_statistics(
+        db_engine, Table('synthetic_data'), set(), catalog) == expected
+
+
+def test_statistics_catalog_fingerprint(db_engine: Engine):
+    """Statistics are reused until the row count or the maximum of the
+    fingerprint column changes. On PostgreSQL, the table's counters
+    change with any insert, update, or delete."""
+    db_engine.execute('DROP TABLE IF EXISTS readings')
+    db_engine.execute('CREATE TABLE readings (id INTEGER, reading INTEGER)')
+    execute_and_flush_statistics(
+        db_engine,
+        'INSERT INTO readings VALUES '
+        + ', '.join(f'({index}, {index})' for index in range(1, 10)))
+    catalog = StatisticsCatalog(db_engine, fingerprint_column=Column('id'))
+    [(_, statistics)] = catalog.range_valued_statistics(
+        db_engine, 'SELECT * FROM readings', {Column('reading')})
+    assert statistics == RangeValuedStatistics([1, 4, 7])
+
+    # Elsewhere, an update that the fingerprint doesn't see returns
+    # stale statistics.
+    execute_and_flush_statistics(
+        db_engine, 'UPDATE readings SET reading = reading + 10')
+    [(_, statistics)] = catalog.range_valued_statistics(
+        db_engine, 'SELECT * FROM readings', {Column('reading')})
+    if db_engine.url.get_backend_name() == 'postgresql':
+        assert statistics == RangeValuedStatistics([11, 14, 17])
+    else:
+        assert statistics == RangeValuedStatistics([1, 4, 7])
+
+    execute_and_flush_statistics(
+        db_engine, 'INSERT INTO readings VALUES (10, 20)')
+    [(_, statistics)] = catalog.range_valued_statistics(
+        db_engine, 'SELECT * FROM readings', {Column('reading')})
+    assert statistics == RangeValuedStatistics([11, 14, 17])
+
+    # Filtered relations are only fingerprinted by scanning them if
+    # the catalog opts in.
+    generate_scorpion_testdb(db_engine)
+    query = 'SELECT * FROM sensor_readings WHERE temperature > 50'
+    catalog.range_valued_statistics(db_engine, query, {Column('voltage')})
+    assert query_rows(
+        db_engine, f"SELECT * FROM {CATALOG_TABLE} WHERE relation = '{query}'"
+    ) == 0
+    catalog = StatisticsCatalog(
+        db_engine, fingerprint_column=Column('id'), scan_relations=True)
+    catalog.range_valued_statistics(db_engine, query, {Column('voltage')})
+    assert query_rows(
+        db_engine, f"SELECT * FROM {CATALOG_TABLE} WHERE relation = '{query}'"
+    ) == 1
+
+    arguments = (
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        {Column('sensor_id'), Column('voltage')},
+        {Column('voltage')}, 0.05, 2.0, 1)
+    assert (diff(db_engine, *arguments, catalog=catalog)
+            == diff(db_engine, *arguments, catalog=catalog)
+            == diff(db_engine, *arguments))
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 
+import sqlalchemy
+
 from pytest import approx
 from sqlalchemy.engine import Engine
 
 from datools.models import Column
+from datools.models import StatisticsSource
 from datools.models import Table
+from datools.table_statistics import _PlannerStatistics
+from datools.table_statistics import _planner_bucket_minimums
 from datools.table_statistics import column_statistics
+from datools.table_statistics import range_valued_statistics
+from datools.table_statistics import sampled_distinct_values
+from datools.table_statistics import set_valued_statistics
 from datools.table_statistics import RangeValuedStatistics
 from datools.table_statistics import SetValuedStatistics
 from .fixtures import generate_synthetic_testdb
@@ -73,3 +81,103 @@ def test_table_statistics(db_engine: Engine):
             [SetValuedStatistics(9, list(range(1, 10))),
              RangeValuedStatistics([1, 4, 7])],
     } == statistics
+
+
+def test_range_valued_statistics_large(db_engine: Engine):
+    """Tests `range_valued_statistics` on more values than SQLite's
+    quantile sketch holds exactly, interspersed with NULLs.
+    """
+    numbers = sqlalchemy.Table(
+        'numbers', sqlalchemy.MetaData(),
+        sqlalchemy.Column('number', sqlalchemy.Integer))
+    numbers.create(db_engine)
+    db_engine.execute(numbers.insert(), [
+        {'number': number if number % 10 else None}
+        for number in range(40000)])
+    [(column, statistics)] = range_valued_statistics(
+        db_engine, 'SELECT * FROM numbers', {Column('number')}, 4)
+    # The 36000 non-NULL values start a bucket every 10000 numbers.
+    assert column == Column('number')
+    assert statistics.bucket_minimums == [
+        approx(expected, abs=200) for expected in (1, 10001, 20001, 30001)]
+
+
+def test_table_statistics_catalog_source(db_engine: Engine):
+    """Without planner statistics (e.g., on SQLite and DuckDB),
+    `StatisticsSource.CATALOG` falls back to scanning each column, and
+    reports that it did.
+    """
+    generate_synthetic_testdb(db_engine)
+    statistics = column_statistics(
+        db_engine, Table('synthetic_data'), set(),
+        source=StatisticsSource.CATALOG)
+    assert statistics == column_statistics(
+        db_engine, Table('synthetic_data'), set())
+    assert {statistic.source
+            for column_statistics in statistics.values()
+            for statistic in column_statistics} == {StatisticsSource.SCAN}
+
+
+def test_planner_bucket_minimums():
+    """Buckets are approximated from PostgreSQL's most common values
+    and the histogram of the remaining values."""
+    statistics = _PlannerStatistics(
+        null_fraction=0.0, distinct_values=6, most_common_values=[5],
+        most_common_frequencies=[0.5], histogram_bounds=[1, 2, 3, 4, 6])
+    # Values 1 through 4 each hold an eighth of the rows, and 5 half.
+    assert _planner_bucket_minimums(statistics, 4) == [1, 3, 5, 5]
+    assert _planner_bucket_minimums(statistics, 2) == [1, 5]
+
+
+def test_table_statistics_approximate(db_engine: Engine):
+    """Most common values and distinct values are exact on columns with
+    few distinct values, and distinct values are approximate on columns
+    with many."""
+    generate_synthetic_testdb(db_engine)
+    exact = column_statistics(db_engine, Table('synthetic_data'), set())
+    approximate = column_statistics(
+        db_engine, Table('synthetic_data'), set(), approximate=True)
+    assert approximate.keys() == exact.keys()
+    for column, exact_statistics in exact.items():
+        assert len(approximate[column]) == len(exact_statistics)
+        for statistic, approximate_statistic in zip(
+                exact_statistics, approximate[column]):
+            if isinstance(statistic, SetValuedStatistics):
+                assert isinstance(approximate_statistic, SetValuedStatistics)
+                assert (approximate_statistic.distinct_values
+                        == statistic.distinct_values)
+                assert set(approximate_statistic.most_common_values) == set(
+                    statistic.most_common_values)
+            else:
+                assert approximate_statistic == statistic
+
+    values = sqlalchemy.Table(
+        'many_values', sqlalchemy.MetaData(),
+        sqlalchemy.Column('value', sqlalchemy.Integer))
+    values.create(db_engine)
+    db_engine.execute(values.insert(), [
+        {'value': value if value % 3 else 0} for value in range(30000)])
+    [(_, statistics)] = set_valued_statistics(
+        db_engine, 'SELECT * FROM many_values', {Column('value')}, 1,
+        approximate=True)
+    assert statistics.distinct_values == approx(20001, rel=0.05)
+    assert statistics.most_common_values == [0]
+
+
+def test_sampled_distinct_values(db_engine: Engine):
+    """Columns with a few common values are estimated exactly from a
+    sample, and values seen once are assumed to be unique."""
+    generate_synthetic_testdb(db_engine)
+    columns = {Column('same_string'), Column('bucket_unique_int'),
+               Column('unique_int')}
+    assert sampled_distinct_values(
+        db_engine, 'SELECT * FROM synthetic_data', columns, 171) == {
+            Column('same_string'): 1, Column('bucket_unique_int'): 9,
+            Column('unique_int'): 171}
+    # A sample of 90 rows sees each of the 9 values of
+    # bucket_unique_int, and 90 unique_ints, which are scaled up to the
+    # 1710 rows the query is said to have.
+    assert sampled_distinct_values(
+        db_engine, 'SELECT * FROM synthetic_data', columns, 1710, 90) == {
+            Column('same_string'): 1, Column('bucket_unique_int'): 9,
+            Column('unique_int'): approx(1710)}
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+from sqlalchemy.engine import Engine
+from typing import List
+
+from datools.explanations import diff
+from datools.explanations import diff_by_condition
+from datools.models import Column
+from datools.tracing import PhaseTrace
+from datools.tracing import Tracer
+from .fixtures import generate_scorpion_testdb
+
+
+def test_tracer_diff(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    arguments = (
+        {Column('sensor_id'), Column('voltage')},
+        {Column('voltage')}, 0.05, 2.0, 2)
+    finished_phases: List[PhaseTrace] = []
+    tracer = Tracer(on_phase=finished_phases.append)
+    expected = diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        *arguments)
+    assert diff(
+        db_engine,
+        'SELECT * FROM sensor_readings WHERE temperature > 50',
+        'SELECT * FROM sensor_readings WHERE temperature <= 50',
+        *arguments, materialize=True, tracer=tracer) == expected
+    # Engines without grouping sets also encode rows in the
+    # `explanations` phase, before counting them in process.
+    assert [phase.name for phase in tracer.phases
+            if phase.name != 'encode'] == [
+        'validate', 'materialize', 'count_rows', 'range_statistics',
+        'materialize_buckets', 'count_rows', 'explanations', 'order_1',
+        'order_2']
+    # Phases finish innermost first.
+    assert [phase.name for phase in finished_phases[-3:]] == [
+        'order_1', 'order_2', 'explanations']
+    # Temporary tables are dropped after the last phase.
+    assert [statement for statement in tracer.statements
+            if statement.phase is not None] == [
+        statement for phase in tracer.phases
+        for statement in phase.statements]
+    [count_test_rows, count_control_rows] = [
+        phase.statements[-1] for phase in tracer.phases
+        if phase.name == 'count_rows']
+    assert count_test_rows.rows == count_control_rows.rows == 1
+    assert all(statement.plan is None for statement in tracer.statements)
+
+    # Statements run outside of the tracer aren't recorded.
+    num_statements = len(tracer.statements)
+    diff_by_condition(
+        db_engine, 'SELECT * FROM sensor_readings', 'temperature > 50',
+        *arguments)
+    assert len(tracer.statements) == num_statements
+
+
+def test_tracer_explain_analyze(db_engine: Engine):
+    generate_scorpion_testdb(db_engine)
+    tracer = Tracer(explain_analyze=True)
+    diff_by_condition(
+        db_engine, 'SELECT * FROM sensor_readings', 'temperature > 50',
+        {Column('sensor_id')}, set(), 0.05, 2.0, 1, tracer=tracer)
+    [statement] = [statement for statement in tracer.statements
+                   if statement.phase in ('encode', 'order_1')]
+    assert statement.rows > 0
+    if db_engine.url.get_backend_name() in ('duckdb', 'postgresql'):
+        assert statement.plan
+    else:
+        assert statement.plan is None
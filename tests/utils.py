@@ -2,6 +2,7 @@ from datetime import datetime
 from typing import Union
 
 from sqlalchemy.engine import Engine
+from time import sleep
 
 
 def engine_based_datetime(engine: Engine, string: str) -> Union[str, datetime]:
@@ -14,3 +15,20 @@ def engine_based_datetime(engine: Engine, string: str) -> Union[str, datetime]:
         return string
 
     return datetime.strptime(string, '%Y-%m-%d %H:%M:%S.%f')
+
+
+def execute_and_flush_statistics(engine: Engine, statement: str):
+    """
+    Executes `statement`, and on PostgreSQL, waits for the table
+    counters in `pg_stat_user_tables` to reflect it. PostgreSQL 15 and
+    later flush a connection's counters when asked to, and earlier
+    versions send them to the statistics collector every 500ms.
+    """
+    with engine.connect() as connection:
+        connection.execute(statement)
+        if engine.url.get_backend_name() != 'postgresql':
+            return
+        if engine.dialect.server_version_info >= (15, ):
+            connection.execute('SELECT pg_stat_force_next_flush()')
+        else:
+            sleep(1)